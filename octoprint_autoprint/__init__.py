@@ -11,15 +11,49 @@ import imp
 # Take a look at the documentation on what other plugin mixins are available.
 
 import octoprint.plugin
+import os
 
 from .printercontrol import PrinterControl
 from octoprint.printer import PrinterInterface
-from datetime import datetime
-from .printjob import PrintJob, PrintJobTooEarly
+from datetime import datetime, timedelta
+from threading import Lock, active_count
+from time import perf_counter
+from .printjob import PrintJob, PrintJobTooEarly, readEstimate, BED_CLEAR_MODES
 from .autoprinter import AutoPrinterTimer
+from .gcodeinfo import GcodeScanner
+from .fileindex import FileIndex
+from .journal import JobJournal
+from .dryrun import DryRun
+from .metrics import Metrics
+from .warmup import WarmupHistory
+from .heating import HeatupPredictor, HeatWait
+from .durations import DurationHistory
+from .gpiobackend import GpioUnavailable, createGpio
+from .scheduler import Scheduler
+from .recurrence import InvalidRecurrence, RecurringJob, RecurringSchedule
+from .ical import renderCalendar
+from .preflight import Preflight
+from .events import EventLog, QUERY_LIMIT
+from .watchfolder import WatchFolder
+from .clock import SystemClock
+
+
+# events which may change the index of folders and files
+INDEX_EVENTS = ("FileAdded", "FileRemoved", "FileMoved", "FolderAdded", "FolderRemoved", "FolderMoved",
+                "MetadataAnalysisFinished")
+
+# events which may change the state pushed to the clients
+STATE_EVENTS = ("Connected", "Disconnected", "PrinterStateChanged", "Error",
+                "PrintStarted", "PrintDone", "PrintFailed", "PrintCancelled", "PrintPaused", "PrintResumed")
+
+# number of days the calendar of upcoming jobs covers
+CALENDAR_DAYS = 60
+# number of files whose last pre-flight result is kept for the state sent to the clients
+PREFLIGHT_RESULTS_KEPT = 100
 
 
 class AutoprintPlugin(octoprint.plugin.StartupPlugin,
+                      octoprint.plugin.ShutdownPlugin,
                       octoprint.plugin.SettingsPlugin,
                       octoprint.plugin.AssetPlugin,
                       octoprint.plugin.TemplatePlugin,
@@ -29,14 +63,133 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
 
     def __init__(self) -> None:
         super().__init__()
+        self._stateLock = Lock()
+        self._stateVersion = 0
+        self._lastState = {}
+        self._publishing = False
+        self._stateDirty = False
+        # created in on_after_startup
+        self._printerControl = None
+        self._scheduler = None
+        self._events = None
+        self._journal = None
+        self._autoprinterTimer = None
+        self._recurring = None
+        self._fileIndex = None
+        self._heatup = None
+        self._heatWait = None
+        self._durations = None
+        self._preflight = None
+        self._watchFolder = None
+        self._started = False
+        # last pre-flight result by file path
+        self._preflightResults = {}
+        self._gpioError = None
+        self._gcodeScanner = GcodeScanner()
+        self._metrics = Metrics()
+        self._apiLatency = self._metrics.histogram(
+            "autoprint_api_get_seconds", "Time taken to answer a GET request of the plugin API")
+        self._metrics.gauge("autoprint_threads", "Number of live threads of the OctoPrint process", active_count)
 
     # ~~ Startup Plugin
 
     def on_after_startup(self):
-        self._printerControl = PrinterControl(self._logger, self._printer)
-        self.assignSettings()
+        # all timers of the plugin run on the thread of this scheduler
+        self._scheduler = Scheduler(self._logger, self._metrics)
+        clock = SystemClock(self._scheduler)
+        self._events = EventLog(self._logger, self.get_plugin_data_folder(), clock)
+        self._printerControl = PrinterControl(
+            self._logger, self._printer, self._publishState, gpio=self._createGpio(), clock=clock,
+            metrics=self._metrics,
+            warmup=WarmupHistory(self._logger, os.path.join(self.get_plugin_data_folder(), "warmup.json")),
+            events=self._events)
+        self._journal = JobJournal(self._logger, os.path.join(
+            self.get_plugin_data_folder(), "jobs.journal"))
         self._autoprinterTimer = AutoPrinterTimer(
-            self._logger, self._printer, self._printerControl)
+            self._logger, self._printer, self._printerControl, self._publishState, self._journal,
+            clock=clock, metrics=self._metrics,
+            onJobStarted=lambda job: self._recurring.onJobStarted(job), events=self._events,
+            analyse=self._prioritizeAnalysis)
+        self._recurring = RecurringSchedule(
+            self._logger, self._autoprinterTimer, self._createJob, self._journal, clock)
+        self._fileIndex = FileIndex(
+            self._logger, self._file_manager, self._gcodeScanner)
+        self._heatup = HeatupPredictor(
+            self._logger, os.path.join(self.get_plugin_data_folder(), "heating.json"),
+            lambda: self._printerControl.connectWait, clock)
+        self._heatWait = HeatWait(clock)
+        self._durations = DurationHistory(
+            self._logger, os.path.join(self.get_plugin_data_folder(), "durations.json"),
+            lambda: self._printer_profile_manager.get_current_or_default()["id"])
+        self._preflight = Preflight(
+            self._logger, self._file_manager, self._printer_profile_manager.get_current_or_default,
+            self._sendPreflightResult)
+        self._watchFolder = WatchFolder(self._logger, self._file_manager, self._ingestWatched, clock, self._events,
+                                        self._preflight.execute)
+        self.assignSettings()
+        self._restoreJobs()
+        self._started = True
+
+    # ~~ Shutdown Plugin
+
+    def on_shutdown(self):
+        if None != self._scheduler:
+            self._scheduler.shutdown()
+            self._preflight.shutdown()
+
+    def _createGpio(self):
+        """
+        Creates the configured GPIO backend, falling back to the in-memory one if it is not available. The
+        clients are told about the fallback with the state, as the relays of scheduled jobs are not switched
+        """
+        try:
+            return createGpio(self._settings.get(["gpio", "backend"]), self._settings.get(["gpio", "chip"]),
+                              self._metrics, self._settings.get(["gpio", "socket"]))
+        except (GpioUnavailable, OSError) as e:
+            self._gpioError = f"{e} - the relays are not switched, select another GPIO backend"
+            self._logger.error(self._gpioError)
+            self._events.record("gpioUnavailable", error=str(e))
+            return createGpio("mock", metrics=self._metrics)
+
+    def _restoreJobs(self):
+        """Re-schedules the jobs of the journal and applies the missed job policy to overdue ones"""
+        pending, interrupted = self._journal.replay()
+        policy = self._settings.get(["scheduler", "missedJobPolicy"])
+
+        for data in interrupted:
+            self._logger.warn(f"Printjob {data['id']} for {data['file']} was interrupted by a restart")
+            self._journal.ended(data["id"])
+
+        for data in pending:
+            job = PrintJob.fromDict(data, self._logger, self._file_manager, self._gcodeScanner)
+            persist = self._reestimateRestored(job)
+            if job.secondsToStart < 0:
+                if "skip" == policy:
+                    self._logger.warn(f"Skipping printjob {job.id} for {job.fileToPrint} missed during downtime")
+                    self._journal.cancelled(job.id)
+                    continue
+                elif "shift" == policy:
+                    job.shiftToFuture()
+                    self._logger.info(f"Shifted printjob {job.id} for {job.fileToPrint} missed during downtime")
+                    self._autoprinterTimer.scheduleJob(job)
+                    continue
+                self._logger.info(f"Starting printjob {job.id} for {job.fileToPrint} missed during downtime")
+
+            self._autoprinterTimer.scheduleJob(job, persist, True)
+
+        self._recurring.restore(self._journal.recurringJobs)
+
+    def _reestimateRestored(self, job):
+        """
+        Re-estimates a restored finish job with files OctoPrint analysed during the downtime, as no
+        MetadataAnalysisFinished event comes for them anymore. The analysis of the files the job still
+        waits for is requested again when it is scheduled. Returns True if the job was re-estimated
+        """
+        analysed = [path for path in job.pendingAnalysis if self._file_manager.has_analysis("local", path)]
+        if not (analysed and job.analysisFinished(analysed[0])):
+            return False
+        self._logger.info(f"Re-estimated printjob {job.id} for {job.fileToPrint} analysed during the downtime")
+        return True
 
     # ~  TemplatePlugin mixin
     def get_template_configs(self):
@@ -62,7 +215,7 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
             )
         )
 
-        self._logger.info(result)
+        self._logger.debug(result)
         return result
 
     # ~~ SettingsPlugin mixin
@@ -70,17 +223,46 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
     def get_settings_defaults(self):
         return {
             "gpio": {
+                "backend": "rpigpio",
+                "chip": "/dev/gpiochip0",
+                "socket": "/run/autoprint/gpio.sock",
                 "printer": 17,
                 "light": 18
             },
             "printer": {
-                "startupTime": 5
+                "startupTime": 5,
+                "learnStartupTime": True,
+                "connectTimeout": 120,
+                "disconnectTimeout": 10
+            },
+            "relays": {
+                "additional": [],
+                "powerOnSequence": [{"on": ["printer", "light"], "delay": 0}],
+                "powerOffSequence": [{"off": ["printer", "light"], "delay": 0}]
             },
             "nozzle": {
                 "cooldownTemp": 60
             },
             "defaults": {
                 "turnOffAfterPrint": False,
+            },
+            "scheduler": {
+                "missedJobPolicy": "start"
+            },
+            "batch": {
+                "bedClear": "timer",
+                "bedClearDelay": 300,
+                "bedClearTemp": 30
+            },
+            "preflight": {
+                "maxToolTemp": 260,
+                "maxBedTemp": 110,
+                "spoolLength": 0
+            },
+            "watch": {
+                "enabled": False,
+                "folder": "autoprint",
+                "debounce": 3
             }
         }
 
@@ -92,13 +274,28 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
         self._printerControl.printerGpio = self._settings.get(
             ["gpio", "printer"])
         self._printerControl.lightGpio = self._settings.get(["gpio", "light"])
+        self._printerControl.relays = self._settings.get(["relays", "additional"])
+        self._printerControl.powerOnSequence = self._settings.get(["relays", "powerOnSequence"])
+        self._printerControl.powerOffSequence = self._settings.get(["relays", "powerOffSequence"])
         self._printerControl.startupTime = self._settings.get(
             ["printer", "startupTime"])
+        self._printerControl.learnStartupTime = self._settings.get(
+            ["printer", "learnStartupTime"])
         self._printerControl.cooldownTemp = self._settings.get(
             ["nozzle", "cooldownTemp"])
         self._printerControl.turnOffAfterPrint = self._settings.get(
             ["defaults", "turnOffAfterPrint"]
         )
+        self._autoprinterTimer.connectTimeout = self._settings.get(
+            ["printer", "connectTimeout"])
+        self._printerControl.disconnectTimeout = self._settings.get(
+            ["printer", "disconnectTimeout"])
+        self._preflight.maxToolTemp = self._settings.get(["preflight", "maxToolTemp"])
+        self._preflight.maxBedTemp = self._settings.get(["preflight", "maxBedTemp"])
+        self._preflight.spoolLength = self._settings.get(["preflight", "spoolLength"])
+        self._watchFolder.folder = self._settings.get(["watch", "folder"]) \
+            if self._settings.get(["watch", "enabled"]) else None
+        self._watchFolder.debounce = self._settings.get(["watch", "debounce"])
 
     # ~~ AssetPlugin mixin
 
@@ -120,10 +317,15 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
             "cancelShutDown": [],
             "printWaiting": [],
             "toggleLight": [],
+            "switchRelay": ["name", "state"],
             "scheduleJob": [
                 "file", "folder", "time", "startFinish", "turnOffAfterPrint"
             ],
-            "cancelJob": []
+            "cancelJob": [],
+            "cancelRecurrence": ["id"],
+            "bedCleared": [],
+            "listJobs": [],
+            "dryRun": ["jobs"]
         }
 
     def on_api_command(self, command, data):
@@ -135,27 +337,176 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
             self._printerControl.cancelShutDown()
         elif "toggleLight" == command:
             self._printerControl.toggleLight()
+        elif "switchRelay" == command:
+            return self._switchRelay(data["name"], data["state"])
         elif "scheduleJob" == command:
             return self._handleScheduleJob(data)
         elif "cancelJob" == command:
-            return self._cancelScheduledJob()
+            return self._cancelScheduledJob(data.get("id"))
+        elif "cancelRecurrence" == command:
+            return self._cancelRecurrence(data["id"])
+        elif "bedCleared" == command:
+            return self._bedCleared()
+        elif "listJobs" == command:
+            return self._listScheduledJobs()
+        elif "dryRun" == command:
+            return self._dryRun(data["jobs"])
 
     def on_api_get(self, request):
+        if "metrics" in request.args:
+            from flask import make_response
+            response = make_response(self._metrics.render())
+            response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+            return response
+
+        started = perf_counter()
+        try:
+            if "index" in request.args:
+                return self._queryFileIndex(request.args)
+            if "relays" in request.args:
+                return {"relays": self._relayList(self._printerControl.readRelays())}
+            if "ical" in request.args:
+                return self._calendar()
+            if "events" in request.args:
+                return self._queryEvents(request.args)
+
+            self._publishState()
+            with self._stateLock:
+                return dict(self._lastState, version=self._stateVersion)
+        finally:
+            self._apiLatency.observe(perf_counter() - started)
+
+    def _collectState(self):
         result = {
             'state': {
                 'printer': self._printerControl.isPrinterOn,
                 'light': self._printerControl.isLightOn,
                 'cooldown': self._printerControl.isCoolingDown,
+                'cooldownEta': self._printerControl.cooldownEta,
                 'connected': self._printer.is_operational(),
                 'printInProgress': self._printer.is_printing() or self._printer.is_pausing() or self._printer.is_paused()
-            }
+            },
+            'relays': self._relayList(self._printerControl.relays),
+            'lastShutdown': self._printerControl.lastShutdown,
+            'gpioError': self._gpioError
         }
 
-        if None != self._autoprinterTimer.job:
-            result['scheduledJob'] = self._autoprinterTimer.job.__dict__()
+        result['scheduledJobs'] = [job.__dict__() for job in self._autoprinterTimer.jobs]
+        result['activeJob'] = self._autoprinterTimer.activeJob.__dict__() \
+            if None != self._autoprinterTimer.activeJob else None
+        result['failedJobs'] = [job.__dict__() for job in self._autoprinterTimer.failedJobs]
+        result['recurringJobs'] = [series.__dict__() for series in self._recurring.series]
+
+        jobs = result['scheduledJobs'] + ([result['activeJob']] if None != result['activeJob'] else [])
+        paths = {path for job in jobs for path in [job["file"]] + job["batch"]}
+        with self._stateLock:
+            result['preflightResults'] = {path: check for path, check in self._preflightResults.items()
+                                          if path in paths}
 
         return result
 
+    @staticmethod
+    def _relayList(relays):
+        return [dict(relay, name=name) for name, relay in relays.items()]
+
+    def _switchRelay(self, name, state):
+        from flask import make_response
+        if not self._printerControl.switchRelay(name, state):
+            return make_response({"errors": [{
+                'msg': f"No relay with the name {name}",
+                'parameter': "name"
+            }]}, 404)
+        return {"relays": self._relayList(self._printerControl.relays)}
+
+    def _queryFileIndex(self, args):
+        from flask import make_response
+        try:
+            offset = int(args.get("offset", 0))
+            limit = int(args.get("limit", 100))
+        except ValueError:
+            return make_response({"errors": [{
+                'msg': "offset and limit must be numbers",
+                'parameter': "offset"
+            }]}, 400)
+
+        if "folders" == args["index"]:
+            return self._fileIndex.queryFolders(args.get("prefix", ""), offset, limit)
+        elif "files" == args["index"]:
+            return self._fileIndex.queryFiles(args.get("folder", ""), args.get("prefix", ""), offset, limit)
+
+        return make_response({"errors": [{
+            'msg': "index must be either folders or files",
+            'parameter': "index"
+        }]}, 400)
+
+    def _queryEvents(self, args):
+        """Events of the plugin in the time range since/until (milliseconds) of the comma separated types"""
+        from flask import make_response
+        try:
+            since = int(args["since"]) if "since" in args else None
+            until = int(args["until"]) if "until" in args else None
+            limit = int(args.get("limit", QUERY_LIMIT))
+        except ValueError:
+            return make_response({"errors": [{
+                'msg': "since, until and limit must be numbers",
+                'parameter': "since"
+            }]}, 400)
+
+        types = [t for t in args.get("type", "").split(",") if t]
+        return {"events": self._events.query(since, until, types, min(limit, QUERY_LIMIT))}
+
+    def _publishState(self):
+        """
+        Sends the parts of the state which changed since the last message to the clients. Concurrent
+        calls are coalesced: the thread currently publishing collects the state again instead.
+        """
+        with self._stateLock:
+            if self._publishing:
+                self._stateDirty = True
+                return
+            self._publishing = True
+
+        while True:
+            try:
+                state = self._collectState()
+            except Exception:
+                with self._stateLock:
+                    self._publishing = False
+                raise
+
+            with self._stateLock:
+                delta = self._diffState(self._lastState, state)
+                if delta:
+                    self._stateVersion += 1
+                    self._lastState = state
+                    self._plugin_manager.send_plugin_message(self._identifier, {
+                        "type": "state",
+                        "version": self._stateVersion,
+                        "delta": delta
+                    })
+
+                if not self._stateDirty:
+                    self._publishing = False
+                    return
+                self._stateDirty = False
+
+    @staticmethod
+    def _diffState(old, new):
+        """
+        Changed entries of the state. Only the flags of "state" are sent one by one, as the clients
+        replace the other entries (e.g. the active job) as a whole
+        """
+        delta = {}
+        for key, value in new.items():
+            previous = old.get(key)
+            if previous == value:
+                continue
+            if ("state" == key) and isinstance(value, dict) and isinstance(previous, dict):
+                delta[key] = {k: v for k, v in value.items() if previous.get(k) != v}
+            else:
+                delta[key] = value
+        return delta
+
     def _handleScheduleJob(self, jobData):
         from flask import make_response
         time = datetime.fromtimestamp(jobData["time"]/1000)
@@ -167,43 +518,315 @@ class AutoprintPlugin(octoprint.plugin.StartupPlugin,
                 'parameter': "file"
             })
         else:
-            if ("" != jobData["folder"]):
-                path = f'{jobData["folder"]}/{jobData["file"]}'
+            template = {
+                "path": self._jobPath(jobData),
+                "batch": [self._jobPath(dict(jobData, file=file)) for file in jobData.get("batch", [])],
+                "bedClear": self._bedClearCondition(jobData.get("bedClear")),
+                "turnOffAfterPrint": jobData["turnOffAfterPrint"],
+                "startFinish": jobData["startFinish"],
+                "startWithLights": jobData["startWithLights"]
+            }
+            if None == template["bedClear"]:
+                errors.append({
+                    'msg': f"The bed clear condition must be one of {', '.join(BED_CLEAR_MODES)} "
+                           "with a valid delay and temperature",
+                    'parameter': "bedClear"
+                })
+            elif jobData.get("recurrence"):
+                return self._scheduleRecurrence(jobData["recurrence"], time, template)
             else:
-                path = jobData["file"]
-            try:
-                pj = PrintJob(path,
-                              time, jobData["turnOffAfterPrint"],
-                              jobData["startFinish"],
-                              jobData["startWithLights"],
-                              self._logger,
-                              self._file_manager)
+                try:
+                    pj = self._createJob(template, time)
+                    self._autoprinterTimer.scheduleJob(pj)
+                    self._checkFiles(template, pj.id)
 
-                if (None != self._autoprinterTimer.job):
-                    self._autoprinterTimer.cancelJob()
-                self._autoprinterTimer.scheduleJob(pj)
+                except PrintJobTooEarly as e:
+                    errors.append({
+                        'msg': e.message,
+                        'parameter': 'time'
+                    })
 
+        if len(errors) > 0:
+            return make_response({"errors": errors}, 400)
+        else:
+            return make_response(pj.__dict__(), 200)
+
+    def _checkFiles(self, template, jobId):
+        """Starts the pre-flight checks of the files of a job, their results are sent with the state"""
+        for path in [template["path"]] + template["batch"]:
+            self._preflight.submit(path, jobId)
+
+    def _sendPreflightResult(self, jobId, path, result):
+        with self._stateLock:
+            self._preflightResults.pop(path, None)
+            self._preflightResults[path] = result
+            if len(self._preflightResults) > PREFLIGHT_RESULTS_KEPT:
+                del self._preflightResults[next(iter(self._preflightResults))]
+        self._publishState()
+
+    def _ingestWatched(self, entries):
+        """
+        Schedules the files uploaded into the watch folder, the files of one batch as one job. Runs on a
+        worker of the pre-flight pool, the jobs are queued for the timer thread without waiting for it
+        """
+        batches = {}
+        for path, directives in sorted(entries, key=lambda entry: entry[0]):
+            batches.setdefault(directives.get("batch") or path, []).append((path, directives))
+
+        jobs = []
+        for files in batches.values():
+            path, directives = files[0]
+            template = {
+                "path": path,
+                "batch": [file for file, _ in files[1:]],
+                "bedClear": self._bedClearCondition(
+                    {"mode": directives["bedClear"]} if "bedClear" in directives else None),
+                "turnOffAfterPrint": directives.get(
+                    "turnOffAfterPrint", self._settings.get(["defaults", "turnOffAfterPrint"])),
+                "startFinish": directives["startFinish"],
+                "startWithLights": directives.get("startWithLights", True)
+            }
+            try:
+                if None == template["bedClear"]:
+                    raise ValueError(f"The bed clear condition must be one of {', '.join(BED_CLEAR_MODES)}")
+                jobs.append((self._createJob(template, directives["time"]), template))
             except PrintJobTooEarly as e:
+                self._logger.warn(f"Could not schedule {path} from the watch folder: {e.message}")
+                self._events.record("ingestError", file=path, error=e.message)
+            except ValueError as e:
+                self._logger.warn(f"Could not schedule {path} from the watch folder: {e}")
+                self._events.record("ingestError", file=path, error=str(e))
+
+        if jobs:
+            self._autoprinterTimer.scheduleJobs([job for job, _ in jobs])
+            for job, template in jobs:
+                self._checkFiles(template, job.id)
+
+    def _createJob(self, template, time):
+        """Creates a print job from the parameters of scheduleJob"""
+        return PrintJob(template["path"],
+                        time, template["turnOffAfterPrint"],
+                        template["startFinish"],
+                        template["startWithLights"],
+                        self._logger,
+                        self._file_manager,
+                        self._gcodeScanner,
+                        heatup=self._heatup,
+                        durations=self._durations,
+                        batch=template["batch"],
+                        bedClear=template["bedClear"])
+
+    def _scheduleRecurrence(self, rule, time, template):
+        from flask import make_response
+        errors = []
+        if "asap" == template["startFinish"]:
+            errors.append({
+                'msg': "A recurring print job must start or finish at the times of its recurrence",
+                'parameter': "recurrence"
+            })
+        else:
+            try:
+                series = RecurringJob(rule, time, template)
+                if not self._recurring.add(series):
+                    errors.append({
+                        'msg': "The recurrence has no upcoming occurrence",
+                        'parameter': "recurrence"
+                    })
+                else:
+                    self._checkFiles(template, series.id)
+            except InvalidRecurrence as e:
                 errors.append({
                     'msg': e.message,
-                    'parameter': 'time'
+                    'parameter': "recurrence"
                 })
 
         if len(errors) > 0:
             return make_response({"errors": errors}, 400)
-        else:
-            return make_response(self._autoprinterTimer.job.__dict__(), 200)
+        return make_response(series.__dict__(), 200)
 
-    def _cancelScheduledJob(self):
-        if (None != self._autoprinterTimer.job):
-            self._autoprinterTimer.cancelJob()
+    def _cancelRecurrence(self, seriesId):
+        from flask import make_response
+        if not self._recurring.remove(seriesId):
+            return make_response({"errors": [{
+                'msg': f"No recurring print job with id {seriesId}",
+                'parameter': "id"
+            }]}, 404)
+        return make_response({
+            "recurringJobs": [series.__dict__() for series in self._recurring.series]
+        }, 200)
+
+    def _calendar(self):
+        """Scheduled, active and recurring jobs of the next days as iCalendar"""
+        from flask import make_response
+        until = datetime.now() + timedelta(days=CALENDAR_DAYS)
+        jobs = list(self._autoprinterTimer.jobs)
+        if None != self._autoprinterTimer.activeJob:
+            jobs.append(self._autoprinterTimer.activeJob)
+
+        events = [{
+            "uid": f"{job.id}@autoprint",
+            "start": job.startTime,
+            "end": job.endTime,
+            "summary": f"Printing {os.path.basename(job.fileToPrint)}",
+            "description": "\n".join(job.files)
+        } for job in jobs if job.startTime <= until]
+        events.extend({
+            "uid": f"{event['series'].id}-{event['start'].strftime('%Y%m%dT%H%M')}@autoprint",
+            "start": event["start"],
+            "end": event["end"],
+            "summary": f"Printing {os.path.basename(event['series'].template['path'])}",
+            "description": "\n".join([event['series'].template['path']] + event['series'].template['batch'])
+        } for event in self._recurring.upcoming(until))
+
+        response = make_response(renderCalendar(sorted(events, key=lambda event: event["start"]),
+                                                self._printer_profile_manager.get_current_or_default()["name"]))
+        response.headers["Content-Type"] = "text/calendar; charset=utf-8"
+        return response
+
+    def _bedClearCondition(self, condition):
+        """Bed clear condition of a batch with the settings as defaults, None if it is not valid"""
+        condition = dict({
+            "mode": self._settings.get(["batch", "bedClear"]),
+            "delay": self._settings.get(["batch", "bedClearDelay"]),
+            "temperature": self._settings.get(["batch", "bedClearTemp"])
+        }, **(condition or {}))
+
+        for key in ("delay", "temperature"):
+            value = condition[key]
+            if not ((type(value) == int) or (type(value) == str and value.isnumeric())):
+                return None
+            condition[key] = int(value)
+        return condition if condition["mode"] in BED_CLEAR_MODES else None
+
+    def _bedCleared(self):
+        from flask import make_response
+        if not self._autoprinterTimer.bedCleared():
+            return make_response({"errors": [{
+                'msg': "No print job is waiting for the bed to be cleared",
+                'parameter': "command"
+            }]}, 409)
+        job = self._autoprinterTimer.activeJob
+        return make_response({"activeJob": job.__dict__() if None != job else None}, 200)
+
+    @staticmethod
+    def _jobPath(jobData):
+        if ("" != jobData.get("folder", "")):
+            return f'{jobData["folder"]}/{jobData["file"]}'
+        return jobData["file"]
+
+    def _dryRun(self, jobs):
+        """Replays the proposed jobs on a simulated clock and returns the predicted timeline"""
+        from flask import make_response
+        dryRun = DryRun(self._logger, self._file_manager, self._gcodeScanner, self._heatup, self._durations, {
+            "startupTime": self._settings.get(["printer", "startupTime"]),
+            "connectTimeout": self._settings.get(["printer", "connectTimeout"]),
+            "disconnectTimeout": self._settings.get(["printer", "disconnectTimeout"]),
+            "cooldownTemp": self._settings.get(["nozzle", "cooldownTemp"])
+        })
+        return make_response(dryRun.run([
+            dict(job, path=self._jobPath(job), bedClear=self._bedClearCondition(job.get("bedClear")),
+                 batch=[self._jobPath(dict(job, file=file)) for file in job.get("batch", [])])
+            for job in jobs]), 200)
+
+    def _cancelScheduledJob(self, jobId=None):
+        """
+        Cancels the job with the given id, skipping the occurrence if it belongs to a recurring series,
+        or all scheduled jobs and recurring series if no id is provided
+        """
+        from flask import make_response
+        if None == jobId:
+            self._recurring.removeAll()
+        if not self._autoprinterTimer.cancelJob(jobId):
+            return make_response({"errors": [{
+                'msg': f"No scheduled print job with id {jobId}",
+                'parameter': "id"
+            }]}, 404)
+        if None != jobId:
+            self._recurring.skip(jobId)
+        return self._listScheduledJobs()
+
+    def _listScheduledJobs(self):
+        from flask import make_response
+        return make_response({
+            "jobs": [job.__dict__() for job in self._autoprinterTimer.jobs]
+        }, 200)
 
     def on_event(self, event, payload):
-        if (("PrintFailed" == event) or ("PrintDone" == event)) and (None != self._autoprinterTimer.job):
+        if not self._started:
+            # events OctoPrint delivers before the startup of the plugin has completed
+            return super().on_event(event, payload)
+        if ("Connected" == event) or ("PrinterStateChanged" == event):
+            self._autoprinterTimer.onPrinterStateChanged()
+        if ("Disconnected" == event) or ("PrinterStateChanged" == event) or ("Error" == event):
+            self._printerControl.onPrinterStateChanged()
+        if (("PrintFailed" == event) or ("PrintDone" == event)) and (None != self._autoprinterTimer.activeJob):
             self._logger.debug(payload)
-            self._autoprinterTimer.processPrintJobEnd(payload)
+            self._autoprinterTimer.processPrintJobEnd(payload, "PrintFailed" == event)
+        if ("PrintStarted" == event) and ("local" == payload.get("origin")):
+            self._measureHeatWait(payload["path"])
+        if ("PrintDone" == event) and ("local" == payload.get("origin")):
+            self._recordPrintDuration(payload)
+        elif ("PrintFailed" == event) or ("PrintCancelled" == event):
+            self._heatWait.stop()
+        if ("MetadataAnalysisFinished" == event) and ("local" == payload.get("origin")):
+            self._processAnalysis(payload["path"])
+        if "FileAdded" == event:
+            self._watchFolder.processEvent(event, payload)
+        if (event in INDEX_EVENTS) and self._fileIndex.processEvent(event, payload) \
+                and ("MetadataAnalysisFinished" != event):
+            self._plugin_manager.send_plugin_message(self._identifier, {"type": "index"})
+        if event in STATE_EVENTS:
+            self._publishState()
         return super().on_event(event, payload)
 
+    def _prioritizeAnalysis(self, paths):
+        """Moves files a finish job was scheduled for without an analysis to the front of OctoPrint's analysis queue"""
+        for path in paths:
+            try:
+                self._file_manager.analyse("local", path)
+                self._logger.debug(f"Requested the analysis of {path} with high priority")
+            except Exception as e:
+                self._logger.warn(f"Could not request the analysis of {path}: {e}")
+
+    def _processAnalysis(self, path):
+        """Recalculates the jobs waiting for the analysis of the file and tells the clients about the new times"""
+        for job in self._autoprinterTimer.analysisFinished(path):
+            self._plugin_manager.send_plugin_message(self._identifier, {
+                "type": "estimate",
+                "job": job.__dict__()
+            })
+
+    def _measureHeatWait(self, path):
+        """Measures the wait of a started print for the heater temperatures of its preamble"""
+        try:
+            info = self._gcodeScanner.scan(self._file_manager.path_on_disk("local", path))
+        except OSError as e:
+            self._logger.warn(f"Could not scan {path} for heater targets: {e}")
+            info = {}
+        self._heatWait.start({"B": info.get("bedTemperature"), "T0": info.get("toolTemperature")})
+
+    def _recordPrintDuration(self, payload):
+        """
+        Adds the actual duration of a finished print to the history correcting the estimates. The wait
+        for the heaters is not counted, as the lead time of a job covers it
+        """
+        estimate = readEstimate(payload["path"], self._file_manager, self._gcodeScanner, self._logger)
+        actual = payload.get("time")
+        if actual:
+            actual -= self._heatWait.stop()
+        self._durations.record(estimate["slicer"], estimate["estimateSource"],
+                               estimate["estimatedPrintTime"], actual)
+
+    # ~~ Temperatures received hook
+
+    def on_temperatures_received(self, comm, parsed_temperatures, *args, **kwargs):
+        if self._started:
+            self._printerControl.processTemperatures(parsed_temperatures)
+            self._heatup.processTemperatures(parsed_temperatures)
+            self._heatWait.processTemperatures(parsed_temperatures)
+            self._autoprinterTimer.processTemperatures(parsed_temperatures)
+        return parsed_temperatures
+
     # ~~ Softwareupdate hook
 
     def get_update_information(self):
@@ -245,5 +868,6 @@ def __plugin_load__():
 
     global __plugin_hooks__
     __plugin_hooks__ = {
-        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information
+        "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.on_temperatures_received
     }
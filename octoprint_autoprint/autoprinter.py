@@ -1,72 +1,527 @@
-from time import sleep
-from octoprint.util import ResettableTimer
+from collections import deque
+from heapq import heappush, heappop, heapify
+from itertools import count
+from threading import RLock
 from octoprint.printer import PrinterInterface
 from logging import Logger
 from .printjob import PrintJob
 from .printercontrol import PrinterControl
+from .journal import JobJournal
+from .clock import SystemClock
+from .events import EventLog
+from .metrics import Metrics
 
+# number of stale (cancelled) heap entries tolerated before the heap is rebuilt
+STALE_ENTRY_SLACK = 16
+# default time to wait for the printer to become operational after connecting
+CONNECT_TIMEOUT = 120
+# number of failed jobs kept for reporting through the API
+FAILED_JOBS_KEPT = 10
+# a heater is considered at its target within this tolerance
+TARGET_TOLERANCE = 2
+# keys of the heaters in the temperatures reported by the printer
+REPORTED_HEATERS = {"bed": "B", "tool0": "T0"}
+# seconds between the checks of the wall clock against the monotonic clock the wake-up timer runs on
+RECONCILE_INTERVAL = 15
+# seconds the two clocks may diverge before the wake-up timer is re-armed
+CLOCK_TOLERANCE = 0.5
 
 
 class AutoPrinterTimer:
     """
-    Controller that waits until the time is ready and then starts the printer as well as the selected print
+    Controller that keeps a queue of scheduled print jobs ordered by their start time. A single
+    wake-up timer is armed for the earliest job only and re-armed whenever the head of the queue
+    changes. When a job is due it starts the printer as well as the selected print. The files of a
+    batch are printed back to back, waiting only for the bed to be cleared in between.
+
+    The wake-up timer runs on the monotonic clock. While it is armed the wall clock is compared with
+    it periodically, and the timer is re-armed if the wall clock was stepped (NTP after boot, DST) or
+    drifted away
     """
 
-    def __init__(self, logger: Logger, printer: PrinterInterface, printerControl : PrinterControl) -> None:
+    def __init__(self, logger: Logger, printer: PrinterInterface, printerControl : PrinterControl,
+                 onStateChange = None, journal: JobJournal = None, clock = None, metrics: Metrics = None,
+                 onJobStarted = None, events: EventLog = None, analyse = None) -> None:
         self._logger = logger
+        self._analyse = analyse
+        self._events = events or EventLog(logger)
+        self._onJobStarted = onJobStarted
+        self._clock = clock or SystemClock()
+        self._onStateChange = onStateChange
+        self._journal = journal
         self._printer = printer
         self._controller = printerControl
+        self._lock = RLock()
+        self._queue = []
+        self._jobs = {}
+        # ids of the scheduled jobs kept in the journal, occurrences of a recurring series are not
+        self._journaled = set()
+        self._sequence = count()
         self._timer = None
+        self._armedFor = None
+        self._armedOffset = None
+        self._reconcileTimer = None
         self._job = None
         self._printing = False
+        self._awaitingPrinter = False
+        self._connectTimeout = CONNECT_TIMEOUT
+        self._connectTimer = None
+        self._bedClearTimer = None
+        self._failedJobs = deque(maxlen=FAILED_JOBS_KEPT)
 
-    def scheduleJob(self, job: PrintJob) -> bool:
+        metrics = metrics or Metrics()
+        self._fireLag = metrics.histogram(
+            "autoprint_timer_fire_lag_seconds", "Delay between the start time of a job and the timer firing for it",
+            buckets=(-60, -10, -1, -0.1, 0, 0.01, 0.1, 0.5, 1, 5, 10, 60, 300))
+        self._clockSteps = metrics.counter(
+            "autoprint_clock_steps_total", "Re-arms of the wake-up timer because the wall clock diverged")
+        self._jobsStarted = metrics.counter("autoprint_jobs_started_total", "Print jobs started by the scheduler")
+        self._jobsFailed = metrics.counter("autoprint_jobs_failed_total", "Print jobs which could not be started")
+        self._leadDeviation = metrics.histogram(
+            "autoprint_lead_deviation_seconds", "Seconds the printer was heated up later than predicted",
+            buckets=(-300, -120, -60, -30, -10, 0, 10, 30, 60, 120, 300, 600))
 
-        if (self._timer != None):
-            self._timer.cancel()
+    def scheduleJob(self, job: PrintJob, persist: bool = True, journaled: bool = False) -> bool:
+        """Adds a job to the queue and re-arms the wake-up timer if it became the earliest one"""
+        return self.scheduleJobs([job], persist, journaled)
 
-        self._job = job
-        self._logger.info(f"Trigger  autoprint timer in {job.secondsToStart}")
-        self._timer = ResettableTimer(job.secondsToStart, self.startPrintJob)
-        self._timer.start()
+    def scheduleJobs(self, jobs: list, persist: bool = True, journaled: bool = False) -> bool:
+        """
+        Adds several jobs to the queue, re-arming the wake-up timer and notifying the clients only once.
+        The jobs are written to the journal if persist is set, journaled tells that they are already in it
+        """
 
+        with self._lock:
+            if persist and (None != self._journal):
+                self._journal.scheduledAll([job.__dict__() for job in jobs])
+            for job in jobs:
+                self._jobs[job.id] = job
+                if persist or journaled:
+                    self._journaled.add(job.id)
+                heappush(self._queue, (job.startTime.timestamp(), next(self._sequence), job))
+                self._logger.info(f"Scheduled printjob {job.id} for {job.fileToPrint} to start in {job.secondsToStart} seconds")
+                self._events.record("schedule", job=job.id, file=job.fileToPrint, start=job.startTime.timestamp() * 1000)
+            self._arm()
 
-    def cancelJob(self) -> bool:
+        pending = [path for job in jobs for path in job.pendingAnalysis]
+        if pending and (None != self._analyse):
+            self._analyse(pending)
+        self._notifyStateChange()
+        return True
 
-        if (self._timer != None):
-            self._timer.cancel();
-            self._logger.info(f"Cancelling printjob for {self._job.fileToPrint} to be started in {self._job.secondsToStart} seconds.")
-            self._timer = None
-            self._job = None
+    def analysisFinished(self, path: str) -> list:
+        """
+        Recalculates the start times of the scheduled jobs estimated provisionally because OctoPrint had
+        not analysed the given file yet, returns the updated jobs
+        """
+        with self._lock:
+            updated = []
+            for job in list(self._jobs.values()):
+                previous = job.startTime
+                if not job.analysisFinished(path):
+                    continue
+                updated.append(job)
+                self._logger.info(f"Printjob {job.id} for {job.fileToPrint} re-estimated after the analysis of "
+                                  f"{path} ({job.estimateAccuracy}), starts in {job.secondsToStart} seconds")
+                self._events.record("estimate", job=job.id, file=path, start=job.startTime.timestamp() * 1000,
+                                    accuracy=job.estimateAccuracy)
+                if (None != self._journal) and (job.id in self._journaled):
+                    self._journal.scheduled(job.__dict__())
+                if job.startTime != previous:
+                    # the entry with the previous start time becomes stale
+                    heappush(self._queue, (job.startTime.timestamp(), next(self._sequence), job))
+            if updated:
+                self._compact()
+                self._arm(True)
 
+        if updated:
+            self._notifyStateChange()
+        return updated
 
-    def processPrintJobEnd(self, printEvent: dict):
-        if (self._printing) and (self._job != None) and (self._job.fileToPrint == printEvent.get("path")):
-            self._logger.info("Printjob ended will %s the printer" % ("shutdown" if self._job.turnOffAfter else "leave on"))
-            self._printing = False
-            if self._job.turnOffAfter:
-                self._controller.shutDownPrinter();
-            
-            self._timer = None
+    def cancelJob(self, jobId: str = None) -> bool:
+        """
+        Cancels the job with the given id or all scheduled jobs if no id is provided. The active job can
+        only be cancelled by its id while it waits for the printer to start up
+        """
+        active = self._job
+        if (None != jobId) and (None != active) and (active.id == jobId):
+            return self._cancelStartingJob(jobId)
+
+        with self._lock:
+            if jobId is None:
+                cancelled = list(self._jobs.values())
+                for job in cancelled:
+                    self._logger.info(f"Cancelling printjob for {job.fileToPrint} to be started in {job.secondsToStart} seconds.")
+                    self._journalEntry("cancelled", job.id)
+                self._jobs.clear()
+                self._journaled.clear()
+                self._queue = []
+            else:
+                job = self._jobs.pop(jobId, None)
+                if job is None:
+                    return False
+                cancelled = [job]
+                self._journaled.discard(job.id)
+                self._journalEntry("cancelled", job.id)
+                self._logger.info(f"Cancelling printjob for {job.fileToPrint} to be started in {job.secondsToStart} seconds.")
+                self._compact()
+
+            self._arm()
+
+        for job in cancelled:
+            self._events.record("cancel", job=job.id, file=job.fileToPrint)
+        self._notifyStateChange()
+        return True
+
+    def _cancelStartingJob(self, jobId: str) -> bool:
+        """Cancels the active job while it waits for the printer to start up, a printing job is not cancelled"""
+        with self._lock:
+            job = self._job
+            if (None == job) or (job.id != jobId) or ("starting" != job.state):
+                return False
+            self._stopAwaiting()
+            self._logger.info(f"Cancelling printjob {job.id} for {job.fileToPrint} while starting the printer")
+            self._journalEntry("ended", job.id)
             self._job = None
+            if job.turnOffAfter:
+                self._controller.shutDownPrinter()
+            self._arm()
+
+        self._events.record("cancel", job=job.id, file=job.fileToPrint)
+        self._notifyStateChange()
+        return True
+
+    def processPrintJobEnd(self, printEvent: dict, failed: bool = False):
+        """Ends the active job when its file has been printed, or waits for the bed of a batch to be cleared"""
+        with self._lock:
+            if (self._printing) and (self._job != None) and (self._job.fileToPrint == printEvent.get("path")):
+                self._printing = False
+                self._events.record("printEnd", job=self._job.id, file=self._job.fileToPrint, failed=failed,
+                                    duration=printEvent.get("time"))
+                if (not failed) and self._job.hasNextFile:
+                    self._awaitBedClear()
+                else:
+                    self._endJob()
+
+        self._notifyStateChange()
+
+    def bedCleared(self) -> bool:
+        """Starts the next file of the active batch, returns False if no batch waits for its bed to be cleared"""
+        with self._lock:
+            job = self._job
+            self._cancelBedClearTimer()
+            if (None == job) or ("clearingBed" != job.state):
+                return False
+            nextFile = job.nextFile()
+            self._logger.info(f"Bed cleared, printjob {job.id} continues with {nextFile}")
+            self._events.record("bedCleared", job=job.id, file=job.fileToPrint)
+
+        self.startPrintJob()
+        return True
+
+    def _endJob(self) -> None:
+        # keep the printer running if the next job is already waiting for it
+        turnOff = self._job.turnOffAfter and not self._isJobDue()
+        self._logger.info("Printjob ended will %s the printer" % ("shutdown" if turnOff else "leave on"))
+        if turnOff:
+            self._controller.shutDownPrinter();
+
+        self._journalEntry("ended", self._job.id)
+        self._job = None
+        self._arm()
+
+    def _awaitBedClear(self) -> None:
+        """Keeps the printer on and hot until the bed clear condition of the batch is met"""
+        job = self._job
+        job.state = "clearingBed"
+        condition = job.bedClear
+        self._logger.info(f"Printjob {job.id} printed {job.fileToPrint}, waiting for the bed to be cleared "
+                          f"({condition['mode']})")
+        if "timer" == condition["mode"]:
+            self._bedClearTimer = self._clock.timer(int(condition["delay"]), self._bedClearTimedOut, [job])
+            self._bedClearTimer.start()
+
+    def _bedClearTimedOut(self, job: PrintJob) -> None:
+        with self._lock:
+            self._bedClearTimer = None
+            if job is not self._job:
+                return
+        self.bedCleared()
+
+    def _cancelBedClearTimer(self) -> None:
+        if self._bedClearTimer is not None:
+            self._bedClearTimer.cancel()
+            self._bedClearTimer = None
 
-            
     def startPrintJob(self) -> None:
 
-        if (not self._printer.is_operational()):
-            self._controller.startUpPrinter(self._runJob, self._job.startWithLights)
+        with self._lock:
+            job = self._job
+            job.state = "starting"
+            operational = self._printer.is_operational()
+            if not operational:
+                # the timeout runs from powering on, so the job fails even if the startup is abandoned early
+                self._awaitingPrinter = True
+                self._connectTimer = self._clock.timer(self._controller.connectWait + self._connectTimeout,
+                                                       self._connectTimedOut)
+                self._connectTimer.start()
+
+        if (not operational):
+            self._controller.startUpPrinter(self._awaitPrinter, job.startWithLights, self._startupAborted)
         else:
             self._controller.cancelShutDown();
             self._runJob()
-    
+        self._notifyStateChange()
+
+    def onPrinterStateChanged(self) -> None:
+        """Starts a job waiting for the printer as soon as the printer reports to be operational"""
+        with self._lock:
+            if (not self._awaitingPrinter) or (not self._printer.is_operational()):
+                return
+            self._stopAwaiting()
+
+        self._runJob()
+
+    def processTemperatures(self, temperatures: dict) -> None:
+        """
+        Records when the printer reached the heater targets of the active job and clears the bed of a
+        batch waiting for it to cool down
+        """
+        if self._isBedCool(temperatures):
+            with self._lock:
+                if None == self._bedClearTimer:
+                    # do not start the next file from within the communication thread reporting the temperatures
+                    self._bedClearTimer = self._clock.timer(0, self.bedCleared)
+                    self._bedClearTimer.start()
+            return
+
+        with self._lock:
+            job = self._job
+            if (not self._printing) or (None == job) or (None != job.actualLeadTime):
+                return
+            for heater, target in job.heatTargets.items():
+                actual, _ = temperatures.get(REPORTED_HEATERS[heater], (None, None))
+                if (actual is None) or (actual < target - TARGET_TOLERANCE):
+                    return
+            self._jobHeated(job)
+
+        self._notifyStateChange()
+
+    def _isBedCool(self, temperatures: dict) -> bool:
+        with self._lock:
+            job = self._job
+            if (None == job) or ("clearingBed" != job.state):
+                return False
+            condition = job.bedClear
+            if "temperature" != condition["mode"]:
+                return False
+            actual, _ = temperatures.get(REPORTED_HEATERS["bed"], (None, None))
+            return (actual is not None) and (actual <= float(condition["temperature"]))
+
+    def _jobHeated(self, job: PrintJob) -> None:
+        job.markHeated()
+        self._leadDeviation.observe(job.actualLeadTime - job.leadTime)
+        self._logger.info(
+            f"Printjob {job.id} heated up {job.actualLeadTime} seconds after its start time ({job.leadTime} predicted)")
+
+    def _awaitPrinter(self) -> None:
+        """Called after the connection to the printer has been initiated"""
+        # the printer might have become operational before the connection attempt
+        self.onPrinterStateChanged()
+
+    def _startupAborted(self, reason: str) -> None:
+        """Fails the starting job if the printer control gave up starting up the printer"""
+        with self._lock:
+            if not self._awaitingPrinter:
+                return
+            self._stopAwaiting()
+            self._failStartingJob(reason)
+
+        self._notifyStateChange()
+
+    def _stopAwaiting(self) -> None:
+        self._awaitingPrinter = False
+        if self._connectTimer is not None:
+            self._connectTimer.cancel()
+            self._connectTimer = None
+
+    def _connectTimedOut(self) -> None:
+        with self._lock:
+            if not self._awaitingPrinter:
+                return
+            self._connectTimer = None
+            self._awaitingPrinter = False
+            self._failStartingJob(f"Printer did not become operational within {self._connectTimeout} seconds "
+                                  f"after starting it up")
+
+        self._notifyStateChange()
+
+    def _failStartingJob(self, error: str) -> None:
+        job = self._job
+        job.fail(error)
+        self._logger.error(f"Printjob {job.id} for {job.fileToPrint} failed: {job.error}")
+        self._events.record("jobFailed", job=job.id, file=job.fileToPrint, error=job.error)
+        self._failedJobs.append(job)
+        self._jobsFailed.inc()
+        self._journalEntry("ended", job.id)
+        self._job = None
+
+        if job.turnOffAfter:
+            self._controller.shutDownPrinter()
+        self._arm()
+
     def _runJob(self) -> None:
-            while not self._printer.is_operational():
-                sleep(1)
             self._logger.info("Starting Print Job")
+            # pre-heat bed and tool together, the preamble of the file may wait for them one after the other
+            for heater, target in self._job.heatTargets.items():
+                self._printer.set_temperature(heater, target)
             self._printer.select_file(self._job.fileToPrint, False, True)
+            self._job.state = "printing"
             self._printing = True
+            if (not self._job.heatTargets) and (None == self._job.actualLeadTime):
+                self._jobHeated(self._job)
+            self._notifyStateChange()
+
+    def _notifyJobStarted(self, job: PrintJob) -> None:
+        if (None != self._onJobStarted):
+            self._onJobStarted(job)
+
+    def _journalEntry(self, event: str, jobId: str) -> None:
+        if (None != self._journal):
+            getattr(self._journal, event)(jobId)
+
+    def _notifyStateChange(self) -> None:
+        if (None != self._onStateChange):
+            self._onStateChange()
+
+# ~~ Queue handling
+
+    def _isStale(self, entry) -> bool:
+        job = entry[2]
+        return (self._jobs.get(job.id) is not job) or (entry[0] != job.startTime.timestamp())
+
+    def _compact(self):
+        """Drops cancelled entries from the heap once they outnumber the live ones"""
+        if len(self._queue) > 2 * len(self._jobs) + STALE_ENTRY_SLACK:
+            self._queue = [e for e in self._queue if not self._isStale(e)]
+            heapify(self._queue)
+
+    def _head(self):
+        while self._queue and self._isStale(self._queue[0]):
+            heappop(self._queue)
+        return self._queue[0][2] if self._queue else None
+
+    def _isJobDue(self) -> bool:
+        head = self._head()
+        return (head is not None) and (head.secondsToStart <= 0)
+
+    def _arm(self, force: bool = False):
+        """Arms the wake-up timer for the earliest job in the queue"""
+        head = self._head()
+
+        if (head is self._armedFor) and (self._timer is not None) and (not force):
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._reconcileTimer is not None:
+            self._reconcileTimer.cancel()
+            self._reconcileTimer = None
+        self._armedFor = None
+
+        # a due job waits until the active job has ended
+        if (head is None) or (self._job is not None):
+            return
+
+        self._armedFor = head
+        self._armedOffset = self._clockOffset()
+        delay = max(0, head.secondsToStart)
+        self._timer = self._clock.timer(delay, self._wakeUp)
+        self._timer.start()
+        if delay > RECONCILE_INTERVAL:
+            self._reconcileTimer = self._clock.timer(RECONCILE_INTERVAL, self._reconcile)
+            self._reconcileTimer.start()
 
-    def _getJob(self):
+    def _clockOffset(self) -> float:
+        """Seconds between the wall clock and the monotonic clock"""
+        return self._clock.now().timestamp() - self._clock.monotonic()
+
+    def _reconcile(self):
+        """Re-arms the wake-up timer if the wall clock moved against the monotonic clock since arming it"""
+        with self._lock:
+            self._reconcileTimer = None
+            if self._timer is None:
+                return
+            step = self._clockOffset() - self._armedOffset
+            if abs(step) <= CLOCK_TOLERANCE:
+                if self._armedFor.secondsToStart > RECONCILE_INTERVAL:
+                    self._reconcileTimer = self._clock.timer(RECONCILE_INTERVAL, self._reconcile)
+                    self._reconcileTimer.start()
+                return
+
+            self._logger.info(f"Wall clock moved by {step:.3f} seconds, re-arming the timer for printjob "
+                              f"{self._armedFor.id} to start in {self._armedFor.secondsToStart} seconds")
+            self._clockSteps.inc()
+            self._events.record("clockStep", step=round(step, 3), job=self._armedFor.id)
+            self._arm(True)
+
+    def _wakeUp(self):
+        with self._lock:
+            self._timer = None
+            self._armedFor = None
+
+            if (self._job is not None) or (not self._isJobDue()):
+                self._arm()
+                return
+
+            _, _, job = heappop(self._queue)
+            del self._jobs[job.id]
+            self._journaled.discard(job.id)
+            job.markFired()
+            if None != job.fireError:
+                self._fireLag.observe(job.fireError)
+            self._events.record("fire", job=job.id, file=job.fileToPrint, error=job.fireError)
+            self._jobsStarted.inc()
+            self._journalEntry("started", job.id)
+            self._job = job
+
+        self._logger.info(f"Printjob {job.id} for {job.fileToPrint} is due")
+        self._notifyJobStarted(job)
+        self.startPrintJob()
+
+# ~~ Properties
+
+    def _getJobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.startTime)
+
+    jobs = property(_getJobs, None, None, "Scheduled jobs ordered by their start time")
+
+    def _getActiveJob(self):
         return self._job
 
-    job = property(_getJob, scheduleJob, None, "Job to be scheduled")
+    activeJob = property(_getActiveJob, None, None, "Job which has been started and is not finished yet")
+
+    def _getFailedJobs(self):
+        return list(self._failedJobs)
+
+    failedJobs = property(_getFailedJobs, None, None, "Most recent jobs which could not be started")
+
+    def _getConnectTimeout(self):
+        return self._connectTimeout
+
+    def _setConnectTimeout(self, timeout):
+        if ((type(timeout) == int) or (type(timeout) == str and timeout.isnumeric())) and (int(timeout) > 0):
+            self._connectTimeout = int(timeout)
+            self._logger.debug(f"Set printer connect timeout to {timeout} sec.")
+        else:
+            self._logger.warn(
+                f"Could not assign '{timeout}' as printer connect timeout: Not a valid number > 0")
+
+    connectTimeout = property(_getConnectTimeout, _setConnectTimeout, None,
+                              "Time to wait for the printer to become operational after connecting")
+
+    def getJob(self, jobId: str) -> PrintJob:
+        with self._lock:
+            return self._jobs.get(jobId)
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+
+from .scheduler import Scheduler, sharedScheduler
+
+
+class SystemClock:
+    """
+    Time source and timer factory backed by the system clock. All timers run on the thread of the
+    given scheduler, or of the one shared by the plugin's modules
+    """
+
+    simulated = False
+
+    def __init__(self, scheduler: Scheduler = None) -> None:
+        self._scheduler = scheduler
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def monotonic(self) -> float:
+        return monotonic()
+
+    def timer(self, delay: float, callback, args: list = None):
+        """Returns a not yet started timer calling the callback after the delay in seconds"""
+        return (self._scheduler or sharedScheduler()).timer(delay, callback, args)
+
+
+class SimulatedTimer:
+
+    def __init__(self, clock, delay: float, callback, args: list = None) -> None:
+        self._clock = clock
+        self._delay = delay
+        self._callback = callback
+        self._args = args or []
+        self.cancelled = False
+
+    def start(self) -> None:
+        self._clock._add(self._delay, self)
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def _fire(self) -> None:
+        if not self.cancelled:
+            self._callback(*self._args)
+
+
+class SimulatedClock:
+    """
+    Clock whose time only advances when the due timers are run. Timers fire in the order of their
+    due time (and of their start for equal times) on the thread calling run, so days of schedules
+    can be replayed in a fraction of a second.
+    """
+
+    simulated = True
+
+    def __init__(self, start: datetime = None) -> None:
+        self._start = start or datetime.now()
+        self._elapsed = 0.0
+        self._step = 0.0
+        self._timers = []
+        self._sequence = count()
+
+    def now(self) -> datetime:
+        return self._start + timedelta(seconds=self._elapsed + self._step)
+
+    def monotonic(self) -> float:
+        return self._elapsed
+
+    def stepWallClock(self, seconds: float) -> None:
+        """Moves the wall clock without moving the monotonic time, like an NTP correction does"""
+        self._step += seconds
+
+    def timer(self, delay: float, callback, args: list = None) -> SimulatedTimer:
+        return SimulatedTimer(self, delay, callback, args)
+
+    def advance(self, seconds: float) -> None:
+        """Runs all timers due within the given number of seconds and moves the time forward"""
+        until = self._elapsed + seconds
+        self.run(until)
+        self._elapsed = max(self._elapsed, until)
+
+    def run(self, until: float = None, maxTimers: int = 1000000) -> int:
+        """
+        Runs the timers in order of their due time until there are none left, the next one is due after
+        the given time (in seconds since the start) or maxTimers have fired. Returns the number of fired timers
+        """
+        fired = 0
+        while self._timers and (fired < maxTimers):
+            due, _, timer = self._timers[0]
+            if (until is not None) and (due > until):
+                break
+            heappop(self._timers)
+            if timer.cancelled:
+                continue
+            self._elapsed = max(self._elapsed, due)
+            timer._fire()
+            fired += 1
+        return fired
+
+    def _add(self, delay: float, timer: SimulatedTimer) -> None:
+        heappush(self._timers, (self._elapsed + max(0, delay), next(self._sequence), timer))
+
+    pending = property(lambda self: sum(1 for _, _, t in self._timers if not t.cancelled), None, None,
+                       "Number of timers which have not fired yet")
@@ -0,0 +1,71 @@
+from math import log
+
+AMBIENT_TEMP = 25
+MIN_SAMPLES = 3
+
+
+class CoolingCurve:
+    """
+    Fits Newton's law of cooling T(t) = Ta + (T0 - Ta) * exp(-k * t) to temperature samples of a
+    cooling hotend. The fit is a running least squares regression of ln(T - Ta) over time, so each
+    sample is processed in constant time and memory.
+    """
+
+    def __init__(self, ambient: float = AMBIENT_TEMP) -> None:
+        self._ambient = ambient
+        self._start = None
+        self._last = None
+        self._n = 0
+        self._sumT = 0.0
+        self._sumY = 0.0
+        self._sumTT = 0.0
+        self._sumTY = 0.0
+
+    def addSample(self, time: float, temp: float) -> None:
+        """Adds a temperature sample taken at the given (monotonic) time in seconds"""
+        if temp <= self._ambient:
+            return
+
+        if self._start is None:
+            self._start = time
+        t = time - self._start
+        y = log(temp - self._ambient)
+
+        self._n += 1
+        self._sumT += t
+        self._sumY += y
+        self._sumTT += t * t
+        self._sumTY += t * y
+        self._last = t
+
+    def eta(self, temp: float):
+        """Estimated seconds from the last sample until the curve falls below the given temperature"""
+        fit = self._fit()
+        if (fit is None) or (temp <= self._ambient):
+            return None
+
+        slope, intercept = fit
+        target = (log(temp - self._ambient) - intercept) / slope
+        return max(0.0, target - self._last)
+
+    def _fit(self):
+        """Returns slope and intercept of the regression line or None if the samples do not show cooling"""
+        if self._n < MIN_SAMPLES:
+            return None
+
+        denominator = self._n * self._sumTT - self._sumT * self._sumT
+        if denominator == 0:
+            return None
+
+        slope = (self._n * self._sumTY - self._sumT * self._sumY) / denominator
+        if slope >= 0:
+            return None
+
+        return slope, (self._sumY - slope * self._sumT) / self._n
+
+    def _getCoolingRate(self):
+        fit = self._fit()
+        return -fit[0] if fit is not None else None
+
+    coolingRate = property(_getCoolingRate, None, None,
+                           "Fitted cooling constant k in 1/s")
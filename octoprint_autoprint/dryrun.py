@@ -0,0 +1,168 @@
+from datetime import datetime, timedelta
+from logging import Logger, WARNING
+
+from octoprint.filemanager import FileManager
+from .autoprinter import AutoPrinterTimer
+from .clock import SimulatedClock
+from .gcodeinfo import GcodeScanner
+from .heating import HeatupPredictor
+from .durations import DurationHistory
+from .printercontrol import PrinterControl
+from .printjob import PrintJob, PrintJobTooEarly, readEstimate
+from .simulation import FakeGPIO, VirtualPrinter
+
+PRINTER_PIN = 1
+LIGHT_PIN = 2
+# print duration assumed for files without any estimate
+DEFAULT_PRINT_DURATION = 3600
+# temperature of the nozzle at the end of a print
+PRINT_TEMPERATURE = 210
+# interval of the simulated temperature reports
+REPORT_INTERVAL = 5
+# simulated printer behaviour
+CONNECT_DELAY = 2
+DISCONNECT_DELAY = 1
+COOLING_RATE = 0.005
+# upper bound of the simulated time span
+HORIZON = timedelta(days=60)
+# timers run between two checks if the simulation is done
+IDLE_CHECK_INTERVAL = 100
+
+RECORDED_EVENTS = ("Connected", "Disconnected", "Error", "PrintStarted", "PrintDone", "PrintFailed")
+
+
+class DryRun:
+    """
+    Replays a proposed schedule with the real AutoPrinterTimer and PrinterControl on a simulated
+    clock, fake GPIO and virtual printer and returns the predicted timeline. Batches waiting for an
+    acknowledgement that their bed has been cleared are acknowledged right away
+    """
+
+    def __init__(self, logger: Logger, fileManager: FileManager, scanner: GcodeScanner, heatup: HeatupPredictor,
+                 durations: DurationHistory, settings: dict) -> None:
+        self._logger = logger.getChild("dryrun")
+        self._logger.setLevel(WARNING)
+        self._fileManager = fileManager
+        self._scanner = scanner
+        self._heatup = heatup
+        self._durations = durations
+        self._settings = settings
+        self._timeline = []
+
+    def run(self, jobs: list) -> dict:
+        """
+        Simulates the given jobs (dicts with path, time, startFinish, turnOffAfterPrint, startWithLights
+        and optionally the batch and bedClear as for scheduleJob) and returns the scheduled jobs, errors
+        and the timeline
+        """
+        self._start = datetime.now()
+        self._clock = SimulatedClock(self._start)
+        self._gpio = FakeGPIO(clock=self._clock)
+        self._printer = VirtualPrinter(self._gpio, PRINTER_PIN,
+                                       connectDelay=CONNECT_DELAY,
+                                       disconnectDelay=DISCONNECT_DELAY,
+                                       coolingRate=COOLING_RATE,
+                                       reportInterval=REPORT_INTERVAL,
+                                       printTemperature=PRINT_TEMPERATURE,
+                                       onEvent=self._onEvent,
+                                       onTemperatures=self._onTemperatures,
+                                       clock=self._clock,
+                                       reportWhile=self._needsTemperatures)
+        self._control = PrinterControl(self._logger, self._printer, gpio=self._gpio, clock=self._clock)
+        self._control.printerGpio = PRINTER_PIN
+        self._control.lightGpio = LIGHT_PIN
+        self._control.startupTime = self._settings["startupTime"]
+        self._control.cooldownTemp = self._settings["cooldownTemp"]
+        self._control.disconnectTimeout = self._settings["disconnectTimeout"]
+        self._timer = AutoPrinterTimer(self._logger, self._printer, self._control, clock=self._clock)
+        self._timer.connectTimeout = self._settings["connectTimeout"]
+        self._timeline = []
+        setupWrites = len(self._gpio.writes)
+
+        scheduled = []
+        errors = []
+        for index, data in enumerate(jobs):
+            try:
+                job = PrintJob(data["path"],
+                               datetime.fromtimestamp(data["time"] / 1000),
+                               data.get("turnOffAfterPrint", False),
+                               data.get("startFinish", "start"),
+                               data.get("startWithLights", False),
+                               self._logger, self._fileManager, self._scanner, self._clock, self._heatup,
+                               self._durations, data.get("batch"), data.get("bedClear"))
+            except PrintJobTooEarly as e:
+                errors.append({"index": index, "msg": e.message, "parameter": "time"})
+                continue
+
+            self._setPrintDurations(job)
+            self._timer.scheduleJob(job)
+            scheduled.append(job)
+
+        # a printer left on after the last print would report temperatures until the horizon, so the
+        # simulation ends once all jobs are done, only finishing the relay sequences still running
+        horizon = HORIZON.total_seconds()
+        while (not self._isIdle()) and self._clock.run(horizon, IDLE_CHECK_INTERVAL):
+            pass
+        self._printer.close()
+        self._clock.run(horizon)
+
+        relays = {PRINTER_PIN: "printer", LIGHT_PIN: "light"}
+        self._timeline.extend({
+            "time": self._at(time),
+            "event": "relay",
+            "relay": relays[pin],
+            "state": state
+        } for time, pin, state in self._gpio.writes[setupWrites:])
+        self._timeline.sort(key=lambda entry: entry["time"])
+
+        return {
+            "jobs": [job.__dict__() for job in scheduled],
+            "failedJobs": [job.__dict__() for job in self._timer.failedJobs],
+            "errors": errors,
+            "timeline": self._timeline
+        }
+
+    def _setPrintDurations(self, job: PrintJob) -> None:
+        duration = job.correctedPrintTime
+        if 1 == len(job.files):
+            self._printer.printDurations[job.fileToPrint] = duration if duration else DEFAULT_PRINT_DURATION
+            return
+
+        # the correction of the whole batch applies to each of its files
+        factor = (duration / job.estimatedPrintTime) if duration else 1
+        for path in job.files:
+            estimate = readEstimate(path, self._fileManager, self._scanner)["estimatedPrintTime"]
+            self._printer.printDurations[path] = estimate * factor if estimate else DEFAULT_PRINT_DURATION
+
+    def _needsTemperatures(self) -> bool:
+        """Temperatures are only processed for heating up, clearing the bed and cooling down"""
+        return self._control.isCoolingDown or (None != self._timer.activeJob)
+
+    def _isIdle(self) -> bool:
+        """If all jobs are done and the printer is neither cooling down nor being shut down"""
+        return (not self._timer.jobs) and (None == self._timer.activeJob) and (not self._control.isCoolingDown) \
+            and (not self._control.isShuttingDown)
+
+    def _at(self, monotonic: float) -> float:
+        return (self._start + timedelta(seconds=monotonic)).timestamp() * 1000
+
+    def _onEvent(self, event, payload):
+        if ("Connected" == event) or ("PrinterStateChanged" == event):
+            self._timer.onPrinterStateChanged()
+        if ("Disconnected" == event) or ("PrinterStateChanged" == event) or ("Error" == event):
+            self._control.onPrinterStateChanged()
+        if (("PrintFailed" == event) or ("PrintDone" == event)) and (None != self._timer.activeJob):
+            self._timer.processPrintJobEnd(payload, "PrintFailed" == event)
+            job = self._timer.activeJob
+            if (None != job) and ("clearingBed" == job.state) and ("ack" == job.bedClear["mode"]):
+                self._timer.bedCleared()
+
+        if event in RECORDED_EVENTS:
+            entry = {"time": self._at(self._clock.monotonic()), "event": event}
+            if "path" in payload:
+                entry["file"] = payload["path"]
+            self._timeline.append(entry)
+
+    def _onTemperatures(self, temperatures):
+        self._control.processTemperatures(temperatures)
+        self._timer.processTemperatures(temperatures)
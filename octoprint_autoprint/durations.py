@@ -0,0 +1,94 @@
+from array import array
+from logging import Logger
+from math import exp, log, sqrt
+from threading import Lock
+
+from .storage import JsonFile
+
+# number of recent prints per printer, slicer and estimate source the correction is based on
+HISTORY_SIZE = 32
+# weight of the uncorrected estimate, in prints, when only a few prints have been recorded
+PRIOR_SAMPLES = 2
+# spread of the logarithmic ratios at which the confidence drops to 0
+MAX_SPREAD = 0.5
+# ratios of actual to estimated duration outside these bounds are not considered to be a real print
+MIN_RATIO = 0.2
+MAX_RATIO = 5
+
+
+class DurationHistory:
+    """
+    Ring buffers of the ratio between actual and estimated print duration per printer profile,
+    slicer and source of the estimate (OctoPrint's analysis or the slicer header). The correction
+    factor is the geometric mean of the ratios, shrunk towards 1 while only a few prints have been
+    recorded. Its confidence grows with the number of prints and drops with the spread of the
+    ratios
+    """
+
+    def __init__(self, logger: Logger, path: str = None, printer = None, size: int = HISTORY_SIZE) -> None:
+        self._logger = logger
+        self._file = JsonFile(logger, path, "print duration history")
+        self._printer = printer
+        self._size = size
+        self._lock = Lock()
+        self._ratios = {}
+        self._writes = {}
+        self._file.load(self._apply)
+
+    def record(self, slicer: str, source: str, estimate: float, actual: float) -> bool:
+        """Records the actual duration of a print of the given slicer with the given estimate and its source"""
+        if (not estimate) or (not actual) or (estimate <= 0) or (actual <= 0):
+            return False
+        ratio = actual / estimate
+        if not (MIN_RATIO <= ratio <= MAX_RATIO):
+            self._logger.debug(f"Ignoring print of {actual} sec. with an estimate of {estimate} sec.")
+            return False
+
+        key = self._key(slicer, source)
+        with self._lock:
+            ratios = self._ratios.setdefault(key, array("d"))
+            writes = self._writes.get(key, 0)
+            if len(ratios) < self._size:
+                ratios.append(ratio)
+            else:
+                ratios[writes % self._size] = ratio
+            self._writes[key] = writes + 1
+            self._save()
+
+        self._logger.debug(f"Recorded print duration ratio {ratio:.3f} for {key}")
+        return True
+
+    def correction(self, slicer: str, source: str):
+        """
+        Returns a dict with the factor to apply to an estimated duration of the given slicer and source,
+        its confidence (0-1) and the number of prints it is based on, or None if there are none
+        """
+        with self._lock:
+            ratios = self._ratios.get(self._key(slicer, source))
+            logs = [log(r) for r in ratios] if ratios else []
+
+        if not logs:
+            return None
+        n = len(logs)
+        mean = sum(logs) / n
+        spread = sqrt(sum((l - mean) ** 2 for l in logs) / (n - 1)) if n > 1 else MAX_SPREAD
+        weight = n / (n + PRIOR_SAMPLES)
+
+        return {
+            "factor": round(exp(weight * mean), 3),
+            "confidence": round(weight * max(0, 1 - spread / MAX_SPREAD), 2),
+            "samples": n
+        }
+
+    def _key(self, slicer: str, source: str) -> str:
+        printer = self._printer() if (None != self._printer) else None
+        return f"{printer or 'default'}/{slicer or 'unknown'}/{source}"
+
+    def _apply(self, history: dict) -> None:
+        for key, entry in history.items():
+            self._ratios[key] = array("d", entry["ratios"][-self._size:])
+            self._writes[key] = int(entry["writes"])
+
+    def _save(self) -> None:
+        self._file.save({key: {"ratios": ratios.tolist(), "writes": self._writes[key]}
+                         for key, ratios in self._ratios.items()})
@@ -0,0 +1,135 @@
+import json
+import os
+from collections import deque
+from logging import Logger, getLogger
+from threading import Lock
+
+from .clock import SystemClock
+
+# events kept in memory for the queries of recent events
+RING_SIZE = 512
+# size in bytes after which the event file is rotated, and the number of rotated files kept
+FILE_SIZE = 256 * 1024
+FILES = 4
+# maximum number of events returned by a query
+QUERY_LIMIT = 1000
+FILE_NAME = "events.jsonl"
+
+
+class EventLog:
+    """
+    Structured history of what the plugin did: schedules, timers firing, relay switches, connects, print
+    ends and cooldowns. The latest events are kept in a fixed-size ring buffer in memory and every
+    event is appended as one compact JSON line to a file in the given folder, which is rotated when it
+    grows beyond the file size. Queries of recent events are answered from memory, older ones by
+    streaming the files line by line, so the full history is never loaded.
+
+    An event is a dict with the time "t" in milliseconds since the epoch, the type "e" and the data of
+    the event.
+    """
+
+    def __init__(self, logger: Logger = None, folder: str = None, clock = None, capacity: int = RING_SIZE,
+                 fileSize: int = FILE_SIZE, files: int = FILES) -> None:
+        self._logger = logger or getLogger(__name__)
+        self._folder = folder
+        self._clock = clock or SystemClock()
+        self._fileSize = fileSize
+        self._files = files
+        self._lock = Lock()
+        self._ring = deque(maxlen=capacity)
+
+    def record(self, type: str, **data) -> dict:
+        """Adds an event of the given type with the data as keyword arguments and returns it"""
+        event = {"t": int(self._clock.now().timestamp() * 1000), "e": type}
+        event.update(data)
+        line = json.dumps(event, separators=(",", ":"), default=str) + "\n"
+
+        with self._lock:
+            self._ring.append(event)
+            if None != self._folder:
+                try:
+                    self._append(line)
+                except OSError as e:
+                    self._logger.warn(f"Could not write event to {self._path(0)}: {e}")
+        return event
+
+    def query(self, since: int = None, until: int = None, types: list = None, limit: int = QUERY_LIMIT) -> list:
+        """
+        Returns the latest events (up to the limit) in the time range in milliseconds, both ends
+        included, of the given types, oldest first
+        """
+        types = set(types) if types else None
+        matches = deque(maxlen=max(0, limit))
+
+        def collect(events):
+            for event in events:
+                if (None != since) and (event["t"] < since):
+                    continue
+                if (None != until) and (event["t"] > until):
+                    continue
+                if (None != types) and (event["e"] not in types):
+                    continue
+                matches.append(event)
+
+        with self._lock:
+            # the ring holds all events since its oldest one
+            if (None == self._folder) or (self._ring and (None != since) and (self._ring[0]["t"] < since)):
+                collect(list(self._ring))
+                return list(matches)
+            files = self._open(since)
+
+        # files are opened under the lock, so a rotation meanwhile does not let events be read twice
+        for file in files:
+            with file:
+                collect(self._read(file))
+        return list(matches)
+
+    def _append(self, line: str) -> None:
+        path = self._path(0)
+        with open(path, "a", encoding="utf-8") as events:
+            events.write(line)
+            size = events.tell()
+        if size >= self._fileSize:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        """Renames events.jsonl to events.1.jsonl and so on, dropping the oldest file"""
+        for index in range(self._files - 1, 0, -1):
+            source = self._path(index - 1)
+            if os.path.exists(source):
+                os.replace(source, self._path(index))
+        if 1 == self._files:
+            os.remove(self._path(0))
+
+    def _open(self, since: int) -> list:
+        """Opens the event files not older than the given time, oldest first"""
+        files = []
+        for index in range(self._files - 1, -1, -1):
+            path = self._path(index)
+            try:
+                # the modification time is the time of the last event in the file
+                if (None != since) and (os.path.getmtime(path) * 1000 < since):
+                    continue
+                files.append(open(path, "r", encoding="utf-8"))
+            except OSError:
+                continue
+        return files
+
+    def _read(self, file):
+        for number, line in enumerate(file, 1):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                self._logger.warn(f"Skipping unreadable event in line {number} of {file.name}")
+
+    def _path(self, index: int) -> str:
+        if 0 == index:
+            return os.path.join(self._folder, FILE_NAME)
+        name, extension = os.path.splitext(FILE_NAME)
+        return os.path.join(self._folder, f"{name}.{index}{extension}")
+
+    def _getEvents(self):
+        with self._lock:
+            return list(self._ring)
+
+    events = property(_getEvents, None, None, "Events kept in memory, oldest first")
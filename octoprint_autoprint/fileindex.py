@@ -0,0 +1,214 @@
+from bisect import bisect_left
+from logging import Logger
+from threading import RLock
+
+from octoprint.filemanager import FileManager, valid_file_type
+from .gcodeinfo import GcodeScanner
+
+STORAGE = "local"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class FileIndex:
+    """
+    In-memory index of the folders and machinecode files of the local storage. The index is built
+    once on first use and afterwards kept up to date from the file and folder events, so queries
+    never have to walk the storage.
+    """
+
+    def __init__(self, logger: Logger, fileManager: FileManager, scanner: GcodeScanner = None) -> None:
+        self._logger = logger
+        self._fileManager = fileManager
+        self._scanner = scanner
+        self._lock = RLock()
+        self._built = False
+        self._folders = []
+        self._files = {}
+        self._printTimes = {}
+
+    def queryFolders(self, prefix: str = "", offset: int = 0, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+        """Returns a page of the folder paths starting with the given prefix ("" is the root folder)"""
+        with self._lock:
+            self._ensureBuilt()
+            return _page(self._folders, prefix, offset, limit)
+
+    def queryFiles(self, folder: str = "", prefix: str = "", offset: int = 0, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+        """Returns a page of the machinecode files in the given folder whose name starts with the prefix"""
+        folder = _normalize(folder)
+        with self._lock:
+            self._ensureBuilt()
+            result = _page(self._files.get(folder, []), prefix, offset, limit)
+            paths = [_join(folder, name) for name in result["items"]]
+            printTimes = [self._printTimes.get(path) for path in paths]
+
+        result["items"] = [{
+            "name": name,
+            "path": path,
+            "estimatedPrintTime": printTime if printTime is not None else self._headerPrintTime(path)
+        } for name, path, printTime in zip(result["items"], paths, printTimes)]
+        return result
+
+    def processEvent(self, event: str, payload: dict) -> bool:
+        """Updates the index from a file or folder event and returns True if the index changed"""
+        if payload is None:
+            return False
+        if event in ("FileMoved", "FolderMoved"):
+            # moves name the storage of both ends, a move between storages adds or removes only
+            fromIndex = STORAGE == payload.get("source_storage")
+            toIndex = STORAGE == payload.get("destination_storage")
+            if not (fromIndex or toIndex):
+                return False
+        elif payload.get("storage", payload.get("origin")) != STORAGE:
+            return False
+
+        with self._lock:
+            if not self._built:
+                return False
+
+            if "FileAdded" == event:
+                if "machinecode" not in payload.get("type", []):
+                    return False
+                self._addFile(payload["path"])
+            elif "FileRemoved" == event:
+                if not self._removeFile(payload["path"]):
+                    return False
+            elif "FileMoved" == event:
+                indexed = self._removeFile(payload["source_path"]) if fromIndex \
+                    else valid_file_type(payload["destination_path"], type="machinecode")
+                if not indexed:
+                    return False
+                if toIndex:
+                    self._addFile(payload["destination_path"])
+            elif "FolderAdded" == event:
+                self._addFolder(payload["path"])
+            elif "FolderRemoved" == event:
+                self._removeFolder(payload["path"])
+            elif "FolderMoved" == event:
+                if fromIndex:
+                    self._removeFolder(payload["source_path"])
+                if toIndex:
+                    self._addTree(payload["destination_path"])
+            elif "MetadataAnalysisFinished" == event:
+                path = _normalize(payload["path"])
+                if path not in self._printTimes:
+                    return False
+                self._printTimes[path] = (payload.get("result") or {}).get("estimatedPrintTime")
+            else:
+                return False
+
+        return True
+
+# ~~ Index maintenance
+
+    def _ensureBuilt(self):
+        if self._built:
+            return
+
+        self._folders = [""]
+        self._files = {"": []}
+        self._printTimes = {}
+        self._readEntries("", self._fileManager.list_files(destinations=STORAGE, recursive=True).get(STORAGE, {}))
+        self._sort()
+        self._built = True
+        self._logger.debug(f"Indexed {len(self._folders)} folders and {len(self._printTimes)} files")
+
+    def _readEntries(self, folder: str, entries: dict):
+        for name, entry in entries.items():
+            path = _join(folder, name)
+            if "folder" == entry.get("type"):
+                self._folders.append(path)
+                self._files.setdefault(path, [])
+                self._readEntries(path, entry.get("children", {}))
+            elif "machinecode" == entry.get("type"):
+                self._files.setdefault(folder, []).append(name)
+                self._printTimes[path] = (entry.get("analysis") or {}).get("estimatedPrintTime")
+
+    def _sort(self):
+        self._folders.sort()
+        for files in self._files.values():
+            files.sort()
+
+    def _addTree(self, folder: str):
+        folder = _normalize(folder)
+        entries = self._fileManager.list_files(path=folder, destinations=STORAGE, recursive=True).get(STORAGE, {})
+        self._addFolder(folder)
+        self._readEntries(folder, entries)
+        self._sort()
+
+    def _addFolder(self, path: str):
+        path = _normalize(path)
+        index = bisect_left(self._folders, path)
+        if (index == len(self._folders)) or (self._folders[index] != path):
+            self._folders.insert(index, path)
+        self._files.setdefault(path, [])
+
+    def _removeFolder(self, path: str):
+        path = _normalize(path)
+        subfolders = path + "/"
+        start = bisect_left(self._folders, subfolders)
+        end = bisect_left(self._folders, subfolders + "\uffff", lo=start)
+        removed = self._folders[start:end]
+        del self._folders[start:end]
+
+        index = bisect_left(self._folders, path)
+        if (index < len(self._folders)) and (self._folders[index] == path):
+            del self._folders[index]
+            removed.append(path)
+
+        for folder in removed:
+            for name in self._files.pop(folder, []):
+                self._printTimes.pop(_join(folder, name), None)
+
+    def _addFile(self, path: str):
+        path = _normalize(path)
+        folder, _, name = path.rpartition("/")
+        self._addFolder(folder)
+        files = self._files[folder]
+        index = bisect_left(files, name)
+        if (index == len(files)) or (files[index] != name):
+            files.insert(index, name)
+
+        metadata = self._fileManager.get_metadata(STORAGE, path) or {}
+        self._printTimes[path] = (metadata.get("analysis") or {}).get("estimatedPrintTime")
+
+    def _removeFile(self, path: str) -> bool:
+        path = _normalize(path)
+        folder, _, name = path.rpartition("/")
+        files = self._files.get(folder, [])
+        index = bisect_left(files, name)
+        if (index == len(files)) or (files[index] != name):
+            return False
+        del files[index]
+        self._printTimes.pop(path, None)
+        return True
+
+    def _headerPrintTime(self, path: str):
+        if None == self._scanner:
+            return None
+        try:
+            return self._scanner.scan(self._fileManager.path_on_disk(STORAGE, path))["estimatedPrintTime"]
+        except OSError:
+            return None
+
+
+def _normalize(path: str) -> str:
+    return (path or "").strip("/")
+
+
+def _join(folder: str, name: str) -> str:
+    return f"{folder}/{name}" if folder else name
+
+
+def _page(items: list, prefix: str, offset: int, limit: int) -> dict:
+    """Slices the range of the sorted list starting with the prefix"""
+    start = bisect_left(items, prefix)
+    end = bisect_left(items, prefix + "\uffff", lo=start) if prefix else len(items)
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    return {
+        "total": end - start,
+        "offset": offset,
+        "items": items[start + offset:min(end, start + offset + limit)]
+    }
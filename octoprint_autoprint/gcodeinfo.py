@@ -0,0 +1,152 @@
+import mmap
+import os
+import re
+from collections import OrderedDict
+from threading import Lock
+
+# number of bytes scanned at the beginning and at the end of a file
+HEAD_SIZE = 16 * 1024
+TAIL_SIZE = 16 * 1024
+CACHE_SIZE = 256
+
+SLICERS = (
+    ("cura", re.compile(rb"^;Generated with Cura", re.M)),
+    ("prusaslicer", re.compile(rb"^; generated by (?:PrusaSlicer|SuperSlicer|OrcaSlicer)", re.M)),
+    ("simplify3d", re.compile(rb"^; G-Code generated by Simplify3D", re.M)),
+)
+
+# Cura
+CURA_TIME = re.compile(rb"^;TIME:(\d+(?:\.\d+)?)", re.M)
+CURA_FILAMENT = re.compile(rb"^;Filament used:\s*([\d.,\sm]+)$", re.M)
+# PrusaSlicer and derivatives
+PRUSA_TIME = re.compile(rb"^; estimated printing time(?: \(normal mode\))?\s*=\s*(.+)$", re.M)
+PRUSA_FILAMENT = re.compile(rb"^; filament used \[mm\]\s*=\s*([\d.,\s]+)$", re.M)
+# Simplify3D
+S3D_TIME = re.compile(rb"^;\s*Build time:\s*(\d+) hours? (\d+) minutes?", re.M)
+S3D_FILAMENT = re.compile(rb"^;\s*Filament length:\s*([\d.]+) mm", re.M)
+
+# heater targets set in the preamble of the file, before the first move
+BED_TEMPERATURE = re.compile(rb"^M1(?:40|90)\b[^;\n]*?\bS(\d+(?:\.\d+)?)", re.M)
+TOOL_TEMPERATURE = re.compile(rb"^M1(?:04|09)\b[^;\n]*?\bS(\d+(?:\.\d+)?)", re.M)
+FIRST_MOVE = re.compile(rb"^G[01]\b", re.M)
+
+DURATION_PART = re.compile(r"(\d+)\s*([dhms])")
+DURATION_UNITS = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+
+
+class GcodeScanner:
+    """
+    Extracts slicer header information (estimated print time, filament usage, heater targets of the
+    preamble) from G-code files by reading only the first and last few KB of the file. Results are
+    cached by path, modification time and size, so repeated lookups of unchanged files do not touch
+    the file at all.
+    """
+
+    def __init__(self, cacheSize: int = CACHE_SIZE) -> None:
+        self._cacheSize = cacheSize
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def scan(self, path: str) -> dict:
+        """
+        Returns a dict with the slicer, estimatedPrintTime (seconds) and filamentUsed (mm) found in the
+        file header or trailer and the bedTemperature and toolTemperature (°C) the preamble heats to.
+        Values which could not be found are None
+        """
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            cached = self._cache.get(path)
+            if (cached is not None) and (cached[0] == key):
+                self._cache.move_to_end(path)
+                return cached[1]
+
+        info = self._parse(self._readHeadAndTail(path, stat.st_size))
+
+        with self._lock:
+            self._cache[path] = (key, info)
+            self._cache.move_to_end(path)
+            while len(self._cache) > self._cacheSize:
+                self._cache.popitem(last=False)
+
+        return info
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            self._cache.pop(path, None)
+
+    @staticmethod
+    def _readHeadAndTail(path: str, size: int) -> bytes:
+        if size == 0:
+            return b""
+
+        with open(path, "rb") as f:
+            if size <= HEAD_SIZE + TAIL_SIZE:
+                return f.read()
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[:HEAD_SIZE] + b"\n" + m[size - TAIL_SIZE:]
+
+    @staticmethod
+    def _parse(data: bytes) -> dict:
+        info = {
+            "slicer": None,
+            "estimatedPrintTime": None,
+            "filamentUsed": None,
+            "bedTemperature": None,
+            "toolTemperature": None
+        }
+
+        for name, pattern in SLICERS:
+            if pattern.search(data):
+                info["slicer"] = name
+                break
+
+        match = CURA_TIME.search(data)
+        if match:
+            info["estimatedPrintTime"] = float(match.group(1))
+        else:
+            match = PRUSA_TIME.search(data)
+            if match:
+                info["estimatedPrintTime"] = _parseDuration(match.group(1).decode("ascii", "replace"))
+            else:
+                match = S3D_TIME.search(data)
+                if match:
+                    info["estimatedPrintTime"] = float(int(match.group(1)) * 3600 + int(match.group(2)) * 60)
+
+        match = CURA_FILAMENT.search(data)
+        if match:
+            # Cura reports meters per extruder
+            info["filamentUsed"] = _sumValues(match.group(1).replace(b"m", b"")) * 1000
+        else:
+            match = PRUSA_FILAMENT.search(data) or S3D_FILAMENT.search(data)
+            if match:
+                info["filamentUsed"] = _sumValues(match.group(1))
+
+        move = FIRST_MOVE.search(data)
+        preamble = data[:move.start()] if move else data
+        info["bedTemperature"] = _firstTarget(BED_TEMPERATURE, preamble)
+        info["toolTemperature"] = _firstTarget(TOOL_TEMPERATURE, preamble)
+
+        return info
+
+
+def _parseDuration(text: str):
+    parts = DURATION_PART.findall(text)
+    if not parts:
+        return None
+    return float(sum(int(value) * DURATION_UNITS[unit] for value, unit in parts))
+
+
+def _firstTarget(pattern, data: bytes):
+    """First non-zero temperature set by the given commands"""
+    for match in pattern.finditer(data):
+        temperature = float(match.group(1))
+        if temperature > 0:
+            return temperature
+    return None
+
+
+def _sumValues(text: bytes) -> float:
+    return sum(float(v) for v in text.replace(b",", b" ").split() if v.replace(b".", b"", 1).isdigit())
@@ -0,0 +1,250 @@
+import os
+from threading import Lock
+from time import perf_counter
+
+BACKENDS = ("rpigpio", "gpiod", "sysfs", "daemon", "mock")
+DEFAULT_CHIP = "/dev/gpiochip0"
+SYSFS_ROOT = "/sys/class/gpio"
+CONSUMER = "octoprint-autoprint"
+
+
+class GpioUnavailable(Exception):
+
+    def __init__(self, backend, reason):
+        self.backend = backend
+        self.message = f"GPIO backend {backend} is not available: {reason}"
+        super().__init__(self.message)
+
+
+class GpioBackend:
+    """
+    Subset of the RPi.GPIO module interface PrinterControl switches its relays with. Pins are
+    numbered in the BCM scheme (the line offsets of the GPIO chip)
+    """
+
+    name = None
+    IN = 1
+    OUT = 0
+
+    def setup(self, pin: int, direction: int) -> None:
+        raise NotImplementedError()
+
+    def input(self, pin: int) -> int:
+        raise NotImplementedError()
+
+    def output(self, pin, state) -> None:
+        raise NotImplementedError()
+
+    def cleanup(self, pin: int = None) -> None:
+        raise NotImplementedError()
+
+
+class RPiGpioBackend(GpioBackend):
+    """RPi.GPIO, the classic library of the Raspberry Pi up to the Pi 4"""
+
+    name = "rpigpio"
+
+    def __init__(self) -> None:
+        try:
+            import RPi.GPIO as gpio
+            gpio.setmode(gpio.BCM)
+            # on a Pi 5 the import succeeds but accessing the pins fails, reading a pin function tells
+            # without reconfiguring any pin
+            gpio.gpio_function(0)
+        except (ImportError, RuntimeError) as e:
+            raise GpioUnavailable(self.name, e)
+        self._gpio = gpio
+        self.IN = gpio.IN
+        self.OUT = gpio.OUT
+
+    def setup(self, pin, direction):
+        self._gpio.setup(pin, direction)
+
+    def input(self, pin):
+        return self._gpio.input(pin)
+
+    def output(self, pin, state):
+        self._gpio.output(pin, state)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self._gpio.cleanup()
+        else:
+            self._gpio.cleanup(pin)
+
+
+class GpiodBackend(GpioBackend):
+    """
+    Character device of the GPIO chip through the libgpiod bindings (v1 and v2 API), which also
+    works on the Pi 5 and any other Linux board
+    """
+
+    name = "gpiod"
+
+    def __init__(self, chip: str = DEFAULT_CHIP) -> None:
+        try:
+            import gpiod
+        except ImportError as e:
+            raise GpioUnavailable(self.name, e)
+        if not os.path.exists(chip):
+            raise GpioUnavailable(self.name, f"{chip} does not exist")
+        self._gpiod = gpiod
+        self._chip = chip
+        self._v2 = hasattr(gpiod, "request_lines")
+        self._v1Chip = None if self._v2 else gpiod.Chip(chip)
+        self._lock = Lock()
+        self._requests = {}
+        self._values = {}
+
+    def setup(self, pin, direction):
+        with self._lock:
+            self._release(pin)
+            value = self._values.get(pin, 0)
+            if self._v2:
+                from gpiod.line import Direction, Value
+                settings = self._gpiod.LineSettings(
+                    direction=Direction.OUTPUT if self.OUT == direction else Direction.INPUT,
+                    output_value=Value.ACTIVE if value else Value.INACTIVE)
+                self._requests[pin] = self._gpiod.request_lines(
+                    self._chip, consumer=CONSUMER, config={pin: settings})
+            else:
+                line = self._v1Chip.get_line(pin)
+                if self.OUT == direction:
+                    line.request(consumer=CONSUMER, type=self._gpiod.LINE_REQ_DIR_OUT, default_vals=[value])
+                else:
+                    line.request(consumer=CONSUMER, type=self._gpiod.LINE_REQ_DIR_IN)
+                self._requests[pin] = line
+
+    def input(self, pin):
+        with self._lock:
+            request = self._requests[pin]
+            if self._v2:
+                from gpiod.line import Value
+                value = 1 if Value.ACTIVE == request.get_value(pin) else 0
+            else:
+                value = request.get_value()
+            self._values[pin] = value
+            return value
+
+    def output(self, pin, state):
+        pins = pin if isinstance(pin, (list, tuple)) else [pin]
+        states = state if isinstance(state, (list, tuple)) else [state] * len(pins)
+        with self._lock:
+            for p, s in zip(pins, states):
+                value = 1 if s else 0
+                if self._v2:
+                    from gpiod.line import Value
+                    self._requests[p].set_value(p, Value.ACTIVE if value else Value.INACTIVE)
+                else:
+                    self._requests[p].set_value(value)
+                self._values[p] = value
+
+    def cleanup(self, pin=None):
+        with self._lock:
+            for p in (list(self._requests) if pin is None else [pin]):
+                self._release(p)
+
+    def _release(self, pin):
+        request = self._requests.pop(pin, None)
+        if request is not None:
+            request.release()
+
+
+class SysfsBackend(GpioBackend):
+    """
+    Deprecated sysfs interface of the kernel, for systems without libgpiod. Pins are offsets of the
+    pinctrl GPIO chip, whose base number is added to get the sysfs GPIO number
+    """
+
+    name = "sysfs"
+
+    def __init__(self, root: str = SYSFS_ROOT) -> None:
+        if not os.path.isdir(root):
+            raise GpioUnavailable(self.name, f"{root} does not exist")
+        self._root = root
+        self._base = self._findBase()
+        self._lock = Lock()
+        self._exported = set()
+
+    def setup(self, pin, direction):
+        with self._lock:
+            path = self._export(pin)
+            if self.OUT == direction:
+                # "high" and "low" switch to output without a glitch of the current state
+                with open(os.path.join(path, "value")) as value:
+                    state = value.read().strip() == "1"
+                self._write(os.path.join(path, "direction"), "high" if state else "low")
+            else:
+                self._write(os.path.join(path, "direction"), "in")
+
+    def input(self, pin):
+        with open(os.path.join(self._pinPath(pin), "value")) as value:
+            return 1 if value.read().strip() == "1" else 0
+
+    def output(self, pin, state):
+        pins = pin if isinstance(pin, (list, tuple)) else [pin]
+        states = state if isinstance(state, (list, tuple)) else [state] * len(pins)
+        for p, s in zip(pins, states):
+            self._write(os.path.join(self._pinPath(p), "value"), "1" if s else "0")
+
+    def cleanup(self, pin=None):
+        with self._lock:
+            for p in (list(self._exported) if pin is None else [pin]):
+                if p in self._exported:
+                    self._write(os.path.join(self._root, "unexport"), str(self._base + p))
+                    self._exported.discard(p)
+
+    def _findBase(self) -> int:
+        for chip in sorted(os.listdir(self._root)):
+            if not chip.startswith("gpiochip"):
+                continue
+            try:
+                with open(os.path.join(self._root, chip, "label")) as label:
+                    if label.read().startswith("pinctrl"):
+                        with open(os.path.join(self._root, chip, "base")) as base:
+                            return int(base.read())
+            except (OSError, ValueError):
+                continue
+        return 0
+
+    def _pinPath(self, pin) -> str:
+        return os.path.join(self._root, f"gpio{self._base + pin}")
+
+    def _export(self, pin) -> str:
+        path = self._pinPath(pin)
+        if not os.path.exists(path):
+            self._write(os.path.join(self._root, "export"), str(self._base + pin))
+        self._exported.add(pin)
+        return path
+
+    @staticmethod
+    def _write(path, value) -> None:
+        with open(path, "w") as f:
+            f.write(value)
+
+
+def createGpio(backend: str, chip: str = DEFAULT_CHIP, metrics = None, socket: str = None) -> GpioBackend:
+    """
+    Creates the GPIO backend of the given name, importing its library only now. Raises GpioUnavailable
+    if the backend cannot be used on this host. The time taken is recorded in the given metrics
+    """
+    started = perf_counter()
+    if "rpigpio" == backend:
+        gpio = RPiGpioBackend()
+    elif "gpiod" == backend:
+        gpio = GpiodBackend(chip)
+    elif "sysfs" == backend:
+        gpio = SysfsBackend()
+    elif "daemon" == backend:
+        from .gpiodaemon import DaemonBackend, DEFAULT_SOCKET
+        gpio = DaemonBackend(socket or DEFAULT_SOCKET)
+    elif "mock" == backend:
+        from .simulation import FakeGPIO
+        gpio = FakeGPIO()
+    else:
+        raise GpioUnavailable(backend, f"unknown backend, use one of {', '.join(BACKENDS)}")
+
+    if None != metrics:
+        metrics.histogram("autoprint_gpio_startup_seconds", "Time taken to load and initialize the GPIO backend",
+                          backend=backend).observe(perf_counter() - started)
+    return gpio
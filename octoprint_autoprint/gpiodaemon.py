@@ -0,0 +1,378 @@
+"""
+Relay arbitration daemon for several OctoPrint instances on one host sharing the GPIO lines of a relay
+HAT. The daemon owns the lines and the plugin instances switch them through it with the "daemon" GPIO
+backend, over a Unix socket:
+
+    python -m octoprint_autoprint.gpiodaemon --socket /run/autoprint/gpio.sock --backend gpiod
+
+Requests and replies are JSON objects, one per line. A request has an "id", the "op" (setup, input,
+output or cleanup) and its parameters, the reply the same "id" and either the "value" or an "error".
+Every change of an output is sent to all clients as {"state": {"<pin>": 0|1}}.
+"""
+import argparse
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+from threading import Condition, Lock, Thread
+
+from .gpiobackend import BACKENDS, DEFAULT_CHIP, GpioBackend, GpioUnavailable, createGpio
+
+DEFAULT_SOCKET = "/run/autoprint/gpio.sock"
+# seconds a client waits for the reply of the daemon
+REQUEST_TIMEOUT = 2
+READ_SIZE = 65536
+
+
+class GpioDaemon:
+    """
+    Serves the GPIO lines of one backend to the clients connected to its Unix socket. All requests are
+    handled on one thread in the order they arrive. The outputs of all requests read in one round are
+    merged into a single write of the backend.
+
+    Lines are shared: a line set up as output by one client is not set up again (which could glitch the
+    relay) when another client sets it up, and it is only released by the backend when the last client
+    using it cleans it up. Lines of a client which disconnects stay as they are.
+    """
+
+    def __init__(self, gpio: GpioBackend, path: str = DEFAULT_SOCKET, logger: logging.Logger = None,
+                 mode: int = 0o660) -> None:
+        self._gpio = gpio
+        self._path = path
+        self._logger = logger or logging.getLogger(__name__)
+        self._mode = mode
+        self._selector = selectors.DefaultSelector()
+        self._server = None
+        self._clients = {}
+        self._lines = {}
+        self._stopped = False
+
+    def serve(self) -> None:
+        """Listens on the socket and handles the clients until stop is called"""
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._path)
+        os.chmod(self._path, self._mode)
+        self._server.listen()
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._logger.info(f"Serving GPIO backend {self._gpio.name} on {self._path}")
+
+        try:
+            while not self._stopped:
+                requests = []
+                for key, _ in self._selector.select(timeout=1):
+                    if key.fileobj is self._server:
+                        self._accept()
+                    else:
+                        requests.extend(self._read(key.fileobj))
+                if requests:
+                    self._handle(requests)
+        finally:
+            for client in list(self._clients):
+                self._disconnect(client)
+            self._selector.close()
+            self._server.close()
+            os.unlink(self._path)
+
+    def stop(self) -> None:
+        self._stopped = True
+
+    def _accept(self) -> None:
+        client, _ = self._server.accept()
+        client.setblocking(False)
+        self._clients[client] = {"buffer": b"", "pins": set()}
+        self._selector.register(client, selectors.EVENT_READ)
+        self._logger.debug(f"Client {client.fileno()} connected")
+
+    def _read(self, client) -> list:
+        """Returns the complete requests received from the client as (client, request) pairs"""
+        try:
+            data = client.recv(READ_SIZE)
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(client)
+            return []
+
+        state = self._clients[client]
+        lines = (state["buffer"] + data).split(b"\n")
+        state["buffer"] = lines.pop()
+        requests = []
+        for line in lines:
+            try:
+                requests.append((client, json.loads(line)))
+            except ValueError:
+                self._send(client, {"id": None, "error": "Request is not valid JSON"})
+        return requests
+
+    def _disconnect(self, client) -> None:
+        state = self._clients.pop(client, None)
+        if None == state:
+            return
+        for pin in state["pins"]:
+            self._lines[pin]["clients"].discard(client)
+        self._selector.unregister(client)
+        client.close()
+        self._logger.debug(f"Client disconnected, its lines {sorted(state['pins'])} stay as they are")
+
+    def _handle(self, requests: list) -> None:
+        replies = []
+        outputs = {}
+        for client, request in requests:
+            if not isinstance(request, dict):
+                replies.append((client, None, {"id": None, "error": "Request is not a JSON object"}))
+                continue
+            op = request.get("op")
+            try:
+                if "output" == op:
+                    # collected and written together after all requests of this round
+                    pins, states = request["pins"], request["states"]
+                    for pin in pins:
+                        self._checkOutput(client, pin)
+                    outputs.update(zip(pins, [1 if s else 0 for s in states]))
+                    value = None
+                elif "setup" == op:
+                    value = self._setup(client, request["pin"], request["direction"])
+                elif "input" == op:
+                    value = self._input(request["pin"])
+                elif "cleanup" == op:
+                    value = self._cleanup(client, request.get("pin"))
+                else:
+                    raise ValueError(f"Unknown operation {op}")
+                replies.append((client, op, {"id": request.get("id"), "value": value}))
+            except Exception as e:
+                replies.append((client, op, {"id": request.get("id"), "error": str(e)}))
+
+        changed = {}
+        if outputs:
+            try:
+                self._gpio.output(list(outputs), list(outputs.values()))
+                for pin, value in outputs.items():
+                    if self._lines[pin]["value"] != value:
+                        changed[str(pin)] = value
+                    self._lines[pin]["value"] = value
+            except Exception as e:
+                self._logger.error(f"Writing {outputs} failed: {e}")
+                replies = [(client, op, dict(reply, error=str(e)) if "output" == op else reply)
+                           for client, op, reply in replies]
+
+        for client, _, reply in replies:
+            self._send(client, reply)
+        if changed:
+            for client in list(self._clients):
+                self._send(client, {"state": changed})
+
+    def _setup(self, client, pin: int, direction: str) -> int:
+        line = self._lines.get(pin)
+        if "out" == direction:
+            if (None == line) or ("out" != line["direction"]):
+                # switch to output keeping the state the line has
+                if None == line:
+                    self._gpio.setup(pin, self._gpio.IN)
+                value = self._gpio.input(pin)
+                self._gpio.setup(pin, self._gpio.OUT)
+                self._gpio.output(pin, value)
+                line = self._lines.setdefault(pin, {"clients": set()})
+                line.update(direction="out", value=value)
+        elif "in" == direction:
+            if None == line:
+                self._gpio.setup(pin, self._gpio.IN)
+                line = self._lines[pin] = {"direction": "in", "value": None, "clients": set()}
+            # an output of another client is not turned into an input
+        else:
+            raise ValueError(f"Unknown direction {direction}")
+
+        line["clients"].add(client)
+        self._clients[client]["pins"].add(pin)
+        return self._input(pin)
+
+    def _input(self, pin: int) -> int:
+        line = self._lines.get(pin)
+        if None == line:
+            raise ValueError(f"Pin {pin} is not set up")
+        if "out" == line["direction"]:
+            return line["value"]
+        return self._gpio.input(pin)
+
+    def _checkOutput(self, client, pin: int) -> None:
+        line = self._lines.get(pin)
+        if (None == line) or ("out" != line["direction"]) or (client not in line["clients"]):
+            raise ValueError(f"Pin {pin} is not set up as output by this client")
+
+    def _cleanup(self, client, pin: int = None) -> None:
+        pins = list(self._clients[client]["pins"]) if None == pin else [pin]
+        for p in pins:
+            self._clients[client]["pins"].discard(p)
+            line = self._lines.get(p)
+            if None == line:
+                continue
+            line["clients"].discard(client)
+            if not line["clients"]:
+                self._gpio.cleanup(p)
+                del self._lines[p]
+
+    def _send(self, client, message: dict) -> None:
+        try:
+            client.sendall(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+        except OSError:
+            self._disconnect(client)
+
+
+class DaemonBackend(GpioBackend):
+    """
+    GPIO backend switching the lines through the GPIO daemon of the host. The states broadcast by the
+    daemon are kept, so reading an output costs no round trip. If the daemon restarts, the connection
+    is re-established and the lines set up again with the next request
+    """
+
+    name = "daemon"
+    IN = 1
+    OUT = 0
+
+    def __init__(self, path: str = DEFAULT_SOCKET, timeout: float = REQUEST_TIMEOUT) -> None:
+        self._path = path
+        self._timeout = timeout
+        self._logger = logging.getLogger(__name__)
+        self._lock = Lock()
+        self._condition = Condition()
+        self._socket = None
+        self._sequence = 0
+        self._replies = {}
+        self._directions = {}
+        self._values = {}
+        try:
+            self._connect()
+        except OSError as e:
+            raise GpioUnavailable(self.name, f"cannot connect to {path}: {e}")
+
+    def setup(self, pin, direction):
+        direction = "out" if self.OUT == direction else "in"
+        value = self._call({"op": "setup", "pin": pin, "direction": direction})
+        self._directions[pin] = direction
+        self._values[pin] = value
+
+    def input(self, pin):
+        if ("out" == self._directions.get(pin)) and (None != self._values.get(pin)):
+            return self._values[pin]
+        return self._call({"op": "input", "pin": pin})
+
+    def output(self, pin, state):
+        pins = list(pin) if isinstance(pin, (list, tuple)) else [pin]
+        states = state if isinstance(state, (list, tuple)) else [state] * len(pins)
+        states = [1 if s else 0 for s in states]
+        self._call({"op": "output", "pins": pins, "states": states})
+        self._values.update(zip(pins, states))
+
+    def cleanup(self, pin=None):
+        self._call({"op": "cleanup", "pin": pin})
+        for p in (list(self._directions) if None == pin else [pin]):
+            self._directions.pop(p, None)
+            self._values.pop(p, None)
+
+    def close(self) -> None:
+        with self._lock:
+            if None != self._socket:
+                self._socket.close()
+                self._socket = None
+
+    def _connect(self) -> None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self._path)
+        self._socket = connection
+        Thread(target=self._receive, args=[connection], name="autoprint-gpio-client", daemon=True).start()
+
+    def _call(self, request: dict):
+        with self._lock:
+            try:
+                return self._request(request)
+            except ConnectionError:
+                # the daemon restarted, the lines it had are kept but have to be claimed again
+                self._connect()
+                for pin, direction in list(self._directions.items()):
+                    self._request({"op": "setup", "pin": pin, "direction": direction})
+                return self._request(request)
+
+    def _request(self, request: dict):
+        if None == self._socket:
+            raise ConnectionError("Not connected to the GPIO daemon")
+        self._sequence += 1
+        request = dict(request, id=self._sequence)
+        try:
+            self._socket.sendall(json.dumps(request, separators=(",", ":")).encode() + b"\n")
+        except OSError as e:
+            self._socket = None
+            raise ConnectionError(e)
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: request["id"] in self._replies or None == self._socket,
+                                            self._timeout):
+                raise TimeoutError(f"GPIO daemon did not answer {request['op']} within {self._timeout} sec.")
+            reply = self._replies.pop(request["id"], None)
+        if None == reply:
+            raise ConnectionError("Connection to the GPIO daemon lost")
+        if "error" in reply:
+            raise OSError(f"GPIO daemon: {reply['error']}")
+        return reply.get("value")
+
+    def _receive(self, connection) -> None:
+        buffer = b""
+        while True:
+            try:
+                data = connection.recv(READ_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            lines = (buffer + data).split(b"\n")
+            buffer = lines.pop()
+            with self._condition:
+                for line in lines:
+                    try:
+                        message = json.loads(line)
+                        if "state" in message:
+                            self._values.update({int(pin): value for pin, value in message["state"].items()})
+                        else:
+                            self._replies[message.get("id")] = message
+                    except (ValueError, TypeError, AttributeError) as e:
+                        # a torn or garbled line only fails the request waiting for it (by its timeout)
+                        self._logger.warn(f"Skipping unreadable message of the GPIO daemon {line[:80]!r}: {e}")
+                self._condition.notify_all()
+
+        with self._condition:
+            if self._socket is connection:
+                self._socket = None
+            self._condition.notify_all()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="path of the Unix socket")
+    parser.add_argument("--backend", choices=[b for b in BACKENDS if "daemon" != b], default="gpiod")
+    parser.add_argument("--chip", default=DEFAULT_CHIP)
+    parser.add_argument("--mode", type=lambda mode: int(mode, 8), default=0o660,
+                        help="permissions of the socket (octal), the OctoPrint users need read and write access")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        gpio = createGpio(args.backend, args.chip)
+    except GpioUnavailable as e:
+        raise SystemExit(e.message)
+
+    daemon = GpioDaemon(gpio, args.socket, mode=args.mode)
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+from logging import Logger
+from threading import Lock
+
+from .clock import SystemClock
+from .storage import JsonFile
+
+AMBIENT_TEMP = 25
+# heating rates in °C/s assumed until a heat-up of the printer has been observed
+DEFAULT_RATES = {"tool": 1.5, "bed": 0.4}
+# weight of a newly observed heat-up in the learned rate
+LEARN_WEIGHT = 0.3
+# heat-ups smaller than this are too short to tell the heating rate
+MIN_HEATUP = 20
+# a heater is considered at its target within this tolerance
+TARGET_TOLERANCE = 2
+# seconds allowed for connecting to the printer on top of its startup time
+CONNECT_ALLOWANCE = 5
+
+
+class HeatupPredictor:
+    """
+    Predicts how long before the first layer the printer has to be turned on: the startup time plus
+    the time to heat the bed and the tool to the targets of the file's preamble. Bed and tool are
+    pre-heated in parallel, so the slower of both counts. The heating rates of the printer are learned
+    from the temperatures it reports whenever a heater heats up from well below its target
+    """
+
+    def __init__(self, logger: Logger, path: str = None, startupTime = None, clock = None) -> None:
+        self._logger = logger
+        self._file = JsonFile(logger, path, "heating rates")
+        self._startupTime = startupTime
+        self._clock = clock or SystemClock()
+        self._lock = Lock()
+        self._rates = dict(DEFAULT_RATES)
+        self._learned = set()
+        self._heatups = {}
+        self._file.load(self._apply)
+
+    def heatTime(self, targets: dict) -> float:
+        """Seconds to heat the printer from ambient temperature to the given heater targets"""
+        times = [max(0, target - AMBIENT_TEMP) / self._rates[_kind(heater)]
+                 for heater, target in (targets or {}).items() if target]
+        return max(times, default=0)
+
+    def leadTime(self, targets: dict) -> float:
+        """Seconds between turning on the printer and the first layer of a file with the given heater targets"""
+        startup = self._startupTime() if (None != self._startupTime) else 0
+        return round((startup or 0) + CONNECT_ALLOWANCE + self.heatTime(targets))
+
+    def processTemperatures(self, temperatures: dict) -> None:
+        """Learns the heating rates from the temperatures reported by the printer"""
+        now = self._clock.monotonic()
+        learned = False
+
+        with self._lock:
+            for key, (actual, target) in temperatures.items():
+                if (actual is None) or not (key.startswith("T") or "B" == key):
+                    continue
+                kind = "bed" if "B" == key else "tool"
+                heatup = self._heatups.get(key)
+
+                if (not target) or ((None != heatup) and (heatup[2] != target)):
+                    self._heatups.pop(key, None)
+                    heatup = None
+
+                if (None == heatup):
+                    if target and (target - actual >= MIN_HEATUP):
+                        self._heatups[key] = (now, actual, target)
+                elif actual >= target - TARGET_TOLERANCE:
+                    started, startTemp, _ = self._heatups.pop(key)
+                    if now > started:
+                        self._learn(kind, (actual - startTemp) / (now - started))
+                        learned = True
+
+            if learned:
+                self._save()
+
+    def _learn(self, kind: str, rate: float) -> None:
+        if kind in self._learned:
+            rate = self._rates[kind] + LEARN_WEIGHT * (rate - self._rates[kind])
+        self._learned.add(kind)
+        self._rates[kind] = round(rate, 4)
+        self._logger.debug(f"Learned {kind} heating rate of {self._rates[kind]}°C/s")
+
+    def _apply(self, rates: dict) -> None:
+        for kind, rate in rates.items():
+            if (kind in self._rates) and (float(rate) > 0):
+                self._rates[kind] = float(rate)
+                self._learned.add(kind)
+
+    def _save(self) -> None:
+        self._file.save({kind: self._rates[kind] for kind in self._learned})
+
+    rates = property(lambda self: dict(self._rates), None, None, "Heating rates of bed and tool in °C/s")
+
+
+class HeatWait:
+    """
+    Measures how long a print waits for the heaters to reach the temperatures of its preamble. The
+    printing time OctoPrint reports includes that wait, while the estimates of the slicer and the
+    analysis do not and the lead time of a job already covers it
+    """
+
+    def __init__(self, clock = None) -> None:
+        self._clock = clock or SystemClock()
+        self._lock = Lock()
+        self._targets = {}
+        self._startedAt = None
+        self._heatedAt = None
+
+    def start(self, targets: dict) -> None:
+        """Starts measuring for a print heating up to the given temperatures by reported heater key (B, T0)"""
+        with self._lock:
+            self._targets = {key: target for key, target in targets.items() if target}
+            self._startedAt = self._clock.monotonic()
+            self._heatedAt = None if self._targets else self._startedAt
+
+    def processTemperatures(self, temperatures: dict) -> None:
+        with self._lock:
+            if (None == self._startedAt) or (None != self._heatedAt):
+                return
+            for key, target in self._targets.items():
+                actual, _ = temperatures.get(key, (None, None))
+                if (actual is None) or (actual < target - TARGET_TOLERANCE):
+                    return
+            self._heatedAt = self._clock.monotonic()
+
+    def stop(self) -> float:
+        """Ends the measurement and returns the seconds waited, 0 if the heaters did not reach the targets"""
+        with self._lock:
+            waited = 0 if (None == self._heatedAt) else self._heatedAt - self._startedAt
+            self._startedAt = None
+            self._heatedAt = None
+            return waited
+
+
+def _kind(heater: str) -> str:
+    return "bed" if "bed" == heater else "tool"
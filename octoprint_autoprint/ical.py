@@ -0,0 +1,57 @@
+from datetime import datetime, timezone
+
+PRODUCT_ID = "-//chof747//OctoPrint Autoprint//EN"
+# lines of the calendar are folded after this many octets
+LINE_LENGTH = 75
+
+
+def renderCalendar(events: list, name: str = "Printer") -> str:
+    """
+    Renders events (dicts with uid, start, end, summary and description) as iCalendar (RFC 5545). Times
+    are floating local times, as the jobs are scheduled in the local time of the printer
+    """
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODUCT_ID}",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{_escape(name)}"
+    ]
+    for event in events:
+        lines.extend([
+            "BEGIN:VEVENT",
+            f"UID:{event['uid']}",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART:{_time(event['start'])}",
+            f"DTEND:{_time(max(event['end'], event['start']))}",
+            f"SUMMARY:{_escape(event['summary'])}",
+            f"DESCRIPTION:{_escape(event.get('description', ''))}",
+            "TRANSP:OPAQUE",
+            "END:VEVENT"
+        ])
+    lines.append("END:VCALENDAR")
+    return "".join(_fold(line) + "\r\n" for line in lines)
+
+
+def _time(time: datetime) -> str:
+    return time.strftime("%Y%m%dT%H%M%S")
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def _fold(line: str) -> str:
+    encoded = line.encode("utf-8")
+    if len(encoded) <= LINE_LENGTH:
+        return line
+    parts = []
+    while encoded:
+        size = LINE_LENGTH if not parts else LINE_LENGTH - 1
+        # do not split multi byte characters
+        while (size < len(encoded)) and (0x80 == encoded[size] & 0xC0):
+            size -= 1
+        parts.append(encoded[:size].decode("utf-8"))
+        encoded = encoded[size:]
+    return "\r\n ".join(parts)
@@ -0,0 +1,126 @@
+import json
+import os
+from logging import Logger
+from threading import Lock
+
+from .storage import replaceFile
+
+# number of records appended since the last compaction which triggers a new compaction
+COMPACT_THRESHOLD = 256
+
+
+class JobJournal:
+    """
+    Append-only journal of the scheduled print jobs. Every schedule, cancel, start and end of a job is
+    appended as one JSON line and synced to disk before the call returns, so a restart of OctoPrint
+    or the Pi does not lose scheduled jobs. The journal keeps the pending jobs in memory and
+    periodically rewrites the file with only those, which bounds the time needed for a replay.
+    Recurring jobs are kept in the same way, with their latest state.
+    """
+
+    def __init__(self, logger: Logger, path: str, compactThreshold: int = COMPACT_THRESHOLD) -> None:
+        self._logger = logger
+        self._path = path
+        self._compactThreshold = compactThreshold
+        self._lock = Lock()
+        self._pending = {}
+        self._running = {}
+        self._recurring = {}
+        self._appended = 0
+
+    def replay(self):
+        """
+        Reads the journal and returns the pending jobs (scheduled but neither cancelled nor started) and
+        the jobs which have been started but never ended, both as lists of job dicts
+        """
+        with self._lock:
+            self._pending = {}
+            self._running = {}
+            self._recurring = {}
+
+            if os.path.exists(self._path):
+                with open(self._path, "r", encoding="utf-8") as journal:
+                    for number, line in enumerate(journal, 1):
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # a torn write of the last record before a crash
+                            self._logger.warn(f"Skipping unreadable record in line {number} of {self._path}")
+                            continue
+                        self._apply(record)
+
+            self._compact()
+            return list(self._pending.values()), list(self._running.values())
+
+    def scheduled(self, job: dict) -> None:
+        self._record({"op": "schedule", "job": job})
+
+    def scheduledAll(self, jobs: list) -> None:
+        """Records several scheduled jobs with one write and sync"""
+        self._record(*[{"op": "schedule", "job": job} for job in jobs])
+
+    def cancelled(self, jobId: str) -> None:
+        self._record({"op": "cancel", "id": jobId})
+
+    def started(self, jobId: str) -> None:
+        self._record({"op": "start", "id": jobId})
+
+    def ended(self, jobId: str) -> None:
+        self._record({"op": "end", "id": jobId})
+
+    def recurring(self, series: dict) -> None:
+        self._record({"op": "recur", "series": series})
+
+    def unrecurring(self, seriesId: str) -> None:
+        self._record({"op": "unrecur", "id": seriesId})
+
+    def _getRecurring(self):
+        with self._lock:
+            return list(self._recurring.values())
+
+    recurringJobs = property(_getRecurring, None, None, "Latest state of the recurring jobs read by replay")
+
+    def _record(self, *records: dict) -> None:
+        with self._lock:
+            for record in records:
+                self._apply(record)
+            with open(self._path, "a", encoding="utf-8") as journal:
+                journal.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+                journal.flush()
+                os.fsync(journal.fileno())
+
+            self._appended += len(records)
+            if self._appended >= self._compactThreshold:
+                self._compact()
+
+    def _apply(self, record: dict) -> None:
+        op = record.get("op")
+        if "schedule" == op:
+            job = record["job"]
+            self._pending[job["id"]] = job
+        elif "cancel" == op:
+            self._pending.pop(record["id"], None)
+        elif "start" == op:
+            job = self._pending.pop(record["id"], None)
+            if job is not None:
+                self._running[record["id"]] = job
+        elif "end" == op:
+            self._pending.pop(record["id"], None)
+            self._running.pop(record["id"], None)
+        elif "recur" == op:
+            series = record["series"]
+            self._recurring[series["id"]] = series
+        elif "unrecur" == op:
+            self._recurring.pop(record["id"], None)
+
+    def _compact(self) -> None:
+        """Rewrites the journal with the records of the pending and running jobs only"""
+        records = [{"op": "schedule", "job": job} for job in self._pending.values()]
+        for jobId, job in self._running.items():
+            records.append({"op": "schedule", "job": job})
+            records.append({"op": "start", "id": jobId})
+        records.extend({"op": "recur", "series": series} for series in self._recurring.values())
+
+        replaceFile(self._path, [json.dumps(record, separators=(",", ":")) + "\n" for record in records])
+        self._appended = 0
+        self._logger.debug(f"Compacted job journal to {len(records)} records")
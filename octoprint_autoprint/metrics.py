@@ -0,0 +1,113 @@
+from bisect import bisect_left
+from threading import Lock
+
+# default histogram buckets in seconds, from sub-millisecond GPIO writes up to long cooldowns
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class Counter:
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: str):
+        yield f"{name}{labels} {_format(self.value)}"
+
+
+class Gauge:
+    """Gauge whose value is read from a callback when the metrics are rendered"""
+
+    def __init__(self, read) -> None:
+        self._read = read
+
+    def samples(self, name: str, labels: str):
+        yield f"{name}{labels} {_format(self._read())}"
+
+
+class Histogram:
+    """Histogram with fixed buckets; observing a value is a bisect and three additions"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self._lock = Lock()
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def samples(self, name: str, labels: str):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+
+        cumulative = 0
+        for bound, bucketCount in zip(self._buckets + (float("inf"),), counts):
+            cumulative += bucketCount
+            le = "+Inf" if bound == float("inf") else _format(bound)
+            yield f"{name}_bucket{_withLabel(labels, 'le', le)} {cumulative}"
+        yield f"{name}_sum{labels} {_format(total)}"
+        yield f"{name}_count{labels} {count}"
+
+
+class Metrics:
+    """Registry of the plugin's metrics which renders them in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._families = {}
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._get(name, help, "counter", labels, Counter)
+
+    def gauge(self, name: str, help: str, read, **labels) -> Gauge:
+        return self._get(name, help, "gauge", labels, lambda: Gauge(read))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get(name, help, "histogram", labels, lambda: Histogram(buckets))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            families = [(name, help, kind, dict(metrics)) for name, (help, kind, metrics) in self._families.items()]
+
+        for name, help, kind, metrics in sorted(families):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(metrics.items()):
+                lines.extend(metric.samples(name, _labels(labels)))
+
+        return "\n".join(lines) + "\n"
+
+    def _get(self, name, help, kind, labels, create):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            _, _, metrics = self._families.setdefault(name, (help, kind, {}))
+            if key not in metrics:
+                metrics[key] = create()
+            return metrics[key]
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _withLabel(labels: str, key: str, value: str) -> str:
+    label = f'{key}="{value}"'
+    return "{" + label + "}" if not labels else labels[:-1] + "," + label + "}"
+
+
+def _format(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
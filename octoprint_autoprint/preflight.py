@@ -0,0 +1,305 @@
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from threading import Lock
+
+from octoprint.filemanager import FileManager
+
+STORAGE = "local"
+WORKERS = 2
+CACHE_SIZE = 128
+# extents of the moves may exceed the print volume by this many mm (e.g. rounding of the slicer)
+BOUNDS_TOLERANCE = 1.0
+# lines searched for the bounding box headers of the slicer
+HEADER_LINES = 100
+
+# bounding box written by Cura into the header, e.g. ";MINX:10.5"
+BOUNDS_HEADER = re.compile(rb"^;(MIN|MAX)([XYZ]):\s*(-?\d+(?:\.\d+)?)")
+
+
+class Preflight:
+    """
+    Checks G-code files of scheduled jobs in a pool of worker threads before they are printed:
+    the extents of the print against the volume of the printer profile, the heater targets against
+    the configured maxima and the filament needed against the filament left on the spool. The file
+    is streamed once, the results of that pass are cached by path, modification time and size, and
+    the verdict is delivered to the given callback when it is ready
+    """
+
+    def __init__(self, logger: Logger, fileManager: FileManager, profile = None, onResult = None,
+                 workers: int = WORKERS, cacheSize: int = CACHE_SIZE) -> None:
+        self._logger = logger
+        self._fileManager = fileManager
+        self._profile = profile
+        self._onResult = onResult
+        self._cacheSize = cacheSize
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="autoprint-preflight")
+        self._lock = Lock()
+        self._cache = OrderedDict()
+        self._running = {}
+        self._futures = set()
+        self._maxToolTemp = 260
+        self._maxBedTemp = 110
+        self._spoolLength = 0
+
+    def submit(self, path: str, jobId: str = None) -> None:
+        """Queues the check of a file and returns at once, the result is passed to the callback"""
+        try:
+            key = self._key(path)
+        except OSError as e:
+            self._deliver(jobId, path, self._verdict(path, None, f"File cannot be read: {e}"))
+            return
+
+        with self._lock:
+            cached = self._cache.get(path)
+            if (None != cached) and (cached[0] == key):
+                self._cache.move_to_end(path)
+                analysis = cached[1]
+            else:
+                analysis = None
+                waiting = self._running.get((path, key))
+                if None != waiting:
+                    # the file is being checked already, deliver its result for this job as well
+                    waiting.append(jobId)
+                    return
+                self._running[(path, key)] = [jobId]
+
+        if None != analysis:
+            self._deliver(jobId, path, self._verdict(path, analysis))
+        else:
+            self._submit(self._check, path, key)
+
+    def execute(self, callback, *args) -> None:
+        """Runs other file work of the plugin (e.g. reading uploaded files) on the pool of workers"""
+        self._submit(self._run, callback, args)
+
+    def _run(self, callback, args) -> None:
+        try:
+            callback(*args)
+        except Exception:
+            self._logger.exception(f"Background work {getattr(callback, '__name__', callback)} failed")
+
+    def _submit(self, callback, *args) -> None:
+        future = self._executor.submit(callback, *args)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+
+    def _discard(self, future) -> None:
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self) -> None:
+        """Cancels the queued work and returns without waiting for the running one"""
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _check(self, path, key) -> None:
+        error = None
+        analysis = None
+        try:
+            analysis = analyse(self._fileManager.path_on_disk(STORAGE, path))
+        except OSError as e:
+            error = f"File cannot be read: {e}"
+        except Exception as e:
+            self._logger.exception(f"Pre-flight check of {path} failed")
+            error = f"File could not be checked: {e}"
+
+        with self._lock:
+            jobIds = self._running.pop((path, key), [])
+            if None != analysis:
+                self._cache[path] = (key, analysis)
+                self._cache.move_to_end(path)
+                while len(self._cache) > self._cacheSize:
+                    self._cache.popitem(last=False)
+
+        result = self._verdict(path, analysis, error)
+        for jobId in jobIds:
+            self._deliver(jobId, path, result)
+
+    def _key(self, path):
+        stat = os.stat(self._fileManager.path_on_disk(STORAGE, path))
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _deliver(self, jobId, path, result) -> None:
+        if result["errors"] or result["warnings"]:
+            self._logger.warn(f"Pre-flight check of {path}: {'; '.join(result['errors'] + result['warnings'])}")
+        if None != self._onResult:
+            self._onResult(jobId, path, result)
+
+    def _verdict(self, path: str, analysis: dict, error: str = None) -> dict:
+        """Checks the analysis of a file against the current printer profile and settings"""
+        result = {"path": path, "ok": False, "errors": [], "warnings": [], "analysis": analysis}
+        if None != error:
+            result["errors"].append(error)
+            return result
+
+        profile = self._profile() if (None != self._profile) else None
+        if None != profile:
+            result["errors"].extend(_checkBounds(analysis["bounds"], _printVolume(profile)))
+        else:
+            result["warnings"].append("No printer profile to check the extents of the print against")
+
+        tool, bed = analysis["temperatures"]["tool"], analysis["temperatures"]["bed"]
+        if (None != tool) and (tool > self._maxToolTemp):
+            result["errors"].append(
+                f"Nozzle is heated to {tool:g}°C, more than the maximum of {self._maxToolTemp}°C")
+        if (None != bed) and (bed > self._maxBedTemp):
+            result["errors"].append(
+                f"Bed is heated to {bed:g}°C, more than the maximum of {self._maxBedTemp}°C")
+        if (None == tool) and (None == bed):
+            result["warnings"].append("File does not set any heater temperature")
+
+        used = analysis["filamentUsed"]
+        if (self._spoolLength > 0) and (used > self._spoolLength * 1000):
+            result["errors"].append(
+                f"Print needs {used / 1000:.1f} m of filament, only {self._spoolLength} m are left on the spool")
+
+        result["ok"] = not result["errors"]
+        return result
+
+    # ~~ Properties
+
+    def _setLimit(self, name, value, minimum):
+        if ((type(value) == int) or (type(value) == str and value.isnumeric())) and (int(value) >= minimum):
+            setattr(self, name, int(value))
+        else:
+            self._logger.warn(
+                f"Could not assign '{value}' as pre-flight {name[1:]}: Not a valid number >= {minimum}")
+
+    maxToolTemp = property(lambda self: self._maxToolTemp,
+                           lambda self, temp: self._setLimit("_maxToolTemp", temp, 1), None,
+                           "Highest nozzle temperature a file may set in °C")
+
+    maxBedTemp = property(lambda self: self._maxBedTemp,
+                          lambda self, temp: self._setLimit("_maxBedTemp", temp, 1), None,
+                          "Highest bed temperature a file may set in °C")
+
+    spoolLength = property(lambda self: self._spoolLength,
+                           lambda self, length: self._setLimit("_spoolLength", length, 0), None,
+                           "Meters of filament left on the spool, 0 if it is not checked")
+
+
+def analyse(path: str) -> dict:
+    """
+    Streams through a G-code file once and returns the extents of the extruding moves (or the
+    bounding box of the slicer header), the highest heater targets and the filament used in mm
+    """
+    header = {}
+    low = [None, None, None]
+    high = [None, None, None]
+    position = [0.0, 0.0, 0.0]
+    absolute = True
+    absoluteE = True
+    e = 0.0
+    eMax = 0.0
+    used = 0.0
+    tool = None
+    bed = None
+
+    with open(path, "rb") as gcode:
+        for number, line in enumerate(gcode):
+            if line.startswith(b";"):
+                if number < HEADER_LINES:
+                    match = BOUNDS_HEADER.match(line)
+                    if match:
+                        header[match.group(1) + match.group(2)] = float(match.group(3))
+                continue
+
+            words = line.split(b";", 1)[0].split()
+            if not words:
+                continue
+            command = words[0].upper()
+
+            if (b"G1" == command) or (b"G0" == command):
+                values = _values(words)
+                for axis, letter in enumerate((b"X", b"Y", b"Z")):
+                    if letter in values:
+                        position[axis] = values[letter] if absolute else position[axis] + values[letter]
+                if b"E" in values:
+                    e = values[b"E"] if absoluteE else e + values[b"E"]
+                    if e > eMax:
+                        used += e - eMax
+                        eMax = e
+                        for axis in range(3):
+                            if (None == low[axis]) or (position[axis] < low[axis]):
+                                low[axis] = position[axis]
+                            if (None == high[axis]) or (position[axis] > high[axis]):
+                                high[axis] = position[axis]
+            elif b"G90" == command:
+                absolute = absoluteE = True
+            elif b"G91" == command:
+                absolute = absoluteE = False
+            elif b"M82" == command:
+                absoluteE = True
+            elif b"M83" == command:
+                absoluteE = False
+            elif b"G92" == command:
+                values = _values(words)
+                if b"E" in values:
+                    e = eMax = values[b"E"]
+                for axis, letter in enumerate((b"X", b"Y", b"Z")):
+                    if letter in values:
+                        position[axis] = values[letter]
+            elif command in (b"M104", b"M109"):
+                target = _values(words).get(b"S")
+                if (None != target) and ((None == tool) or (target > tool)):
+                    tool = target
+            elif command in (b"M140", b"M190"):
+                target = _values(words).get(b"S")
+                if (None != target) and ((None == bed) or (target > bed)):
+                    bed = target
+
+    bounds = {}
+    for axis, name in enumerate("XYZ"):
+        bounds["min" + name] = header.get(b"MIN" + name.encode(), low[axis])
+        bounds["max" + name] = header.get(b"MAX" + name.encode(), high[axis])
+
+    return {
+        "bounds": bounds,
+        "temperatures": {"tool": tool or None, "bed": bed or None},
+        "filamentUsed": round(used, 1)
+    }
+
+
+def _values(words: list) -> dict:
+    values = {}
+    for word in words[1:]:
+        try:
+            values[word[:1].upper()] = float(word[1:])
+        except ValueError:
+            continue
+    return values
+
+
+def _printVolume(profile: dict) -> dict:
+    """Bounds of the print volume of an OctoPrint printer profile"""
+    volume = profile.get("volume", {})
+    box = volume.get("custom_box")
+    if box:
+        return {"minX": box["x_min"], "maxX": box["x_max"], "minY": box["y_min"], "maxY": box["y_max"],
+                "minZ": box["z_min"], "maxZ": box["z_max"]}
+
+    width, depth, height = volume.get("width", 0), volume.get("depth", 0), volume.get("height", 0)
+    if "center" == volume.get("origin"):
+        return {"minX": -width / 2, "maxX": width / 2, "minY": -depth / 2, "maxY": depth / 2,
+                "minZ": 0, "maxZ": height}
+    return {"minX": 0, "maxX": width, "minY": 0, "maxY": depth, "minZ": 0, "maxZ": height}
+
+
+def _checkBounds(bounds: dict, volume: dict) -> list:
+    errors = []
+    for axis in "XYZ":
+        low, high = bounds["min" + axis], bounds["max" + axis]
+        if (None != low) and (low < volume["min" + axis] - BOUNDS_TOLERANCE):
+            errors.append(f"Print reaches {axis} {low:g} mm, below the print volume starting at "
+                          f"{volume['min' + axis]:g} mm")
+        if (None != high) and (high > volume["max" + axis] + BOUNDS_TOLERANCE):
+            errors.append(f"Print reaches {axis} {high:g} mm, beyond the print volume ending at "
+                          f"{volume['max' + axis]:g} mm")
+    return errors
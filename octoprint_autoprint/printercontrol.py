@@ -1,60 +1,208 @@
 from logging import Logger
-import RPi.GPIO as GPIO
-from time import sleep
+from threading import RLock
 from octoprint.printer import PrinterInterface
-from octoprint.util import ResettableTimer
-
+from .cooldown import CoolingCurve
+from .clock import SystemClock
+from .events import EventLog
+from .metrics import Metrics
+from .warmup import WarmupHistory
+from .gpiobackend import GpioBackend, createGpio
+from .relays import RelayBank
+
+# delay before re-checking a connection attempt, doubled after every failed attempt
 CONNECTION_WAIT = 1
+MAX_CONNECTION_WAIT = 30
+# number of connection attempts after the first one before giving up
 CONNECTION_TIMEOUT_REPEAT = 5
-TEMP_WAIT_CYCLE = 5
+DISCONNECT_TIMEOUT = 10
+# least seconds between two state updates for the temperatures reported during a cooldown
+COOLDOWN_PUBLISH_INTERVAL = 5
+# names of the relays powering the printer and the light
+PRINTER = "printer"
+LIGHT = "light"
+DEFAULT_POWER_ON = [{"on": [PRINTER, LIGHT], "delay": 0}]
+DEFAULT_POWER_OFF = [{"off": [PRINTER, LIGHT], "delay": 0}]
 
 class PrinterControl:
 
-    def __init__(self, logger: Logger, printer: PrinterInterface) -> None:
-        self._statePrinter = False
-        self._stateLight = False
-        self._gpioPrinter = None
-        self._gpioLight = None
+    def __init__(self, logger: Logger, printer: PrinterInterface, onStateChange = None, gpio: GpioBackend = None,
+                 clock = None, metrics: Metrics = None, warmup: WarmupHistory = None,
+                 events: EventLog = None) -> None:
         self._startupTime = None
         self._cooldownTemp = None
         self._turnOffAfterPrint = False
-        GPIO.setmode(GPIO.BCM)
+        self._disconnectTimeout = DISCONNECT_TIMEOUT
+        self._learnStartupTime = True
+        self._powerOnSequence = DEFAULT_POWER_ON
+        self._powerOffSequence = DEFAULT_POWER_OFF
+        if (None == gpio):
+            gpio = createGpio("rpigpio", metrics=metrics)
 
         self._logger = logger
         self._printer = printer
-        self._cooldownTimer = None
-
-    def startUpPrinter(self, callback = None, lightsOn=True) -> bool:
-        """Command that starts up the printer and turns on the light"""
-
-        self._switchPrinter(True)
-        if (lightsOn):
-            self._switchLight(True)
-
-        connectTimer = ResettableTimer(self._startupTime, self._connectPrinter, [callback])        
-        connectTimer.start();   
-
+        self._clock = clock or SystemClock()
+        self._onStateChange = onStateChange
+        self._coolingDown = False
+        self._coolingCurve = None
+        self._lock = RLock()
+        self._disconnectTimer = None
+        self._disconnectStarted = None
+        self._lastShutdown = None
+        self._poweredOnAt = None
+        self._connectedAt = None
+        self._connectAttempt = 0
+        self._connectTimer = None
+        self._onStartupAborted = None
+        self._warmup = warmup or WarmupHistory(logger)
+        self._cooldownStarted = None
+        self._cooldownPublished = None
+        self._events = events or EventLog(logger)
+
+        metrics = metrics or Metrics()
+        self._relays = RelayBank(logger, gpio, self._clock, metrics, self._notifyStateChange, self._events)
+        self._connectLatency = metrics.histogram(
+            "autoprint_startup_connect_seconds", "Time from printer relay on to connecting the printer")
+        self._operationalLatency = metrics.histogram(
+            "autoprint_startup_operational_seconds", "Time from connecting the printer until it is operational")
+        self._startupLatency = metrics.histogram(
+            "autoprint_startup_seconds", "Time from printer relay on until the printer is operational")
+        self._connectRetries = metrics.counter(
+            "autoprint_connect_retries_total", "Connection attempts repeated because the printer was not ready")
+        metrics.gauge("autoprint_connect_wait_seconds", "Wait between printer relay on and the first connection attempt",
+                      lambda: self.connectWait or 0)
+        self._cooldownDuration = metrics.histogram(
+            "autoprint_cooldown_seconds", "Time waited for the tool to cool down before shutting down")
+        self._shutdowns = {
+            escalated: metrics.counter("autoprint_shutdowns_total", "Printer power offs after a disconnect",
+                                       escalated=str(escalated).lower())
+            for escalated in (False, True)
+        }
+
+    def startUpPrinter(self, callback = None, lightsOn=True, onAbort = None) -> bool:
+        """
+        Command that starts up the printer and turns on the light. The callback is called after the first
+        connection attempt, onAbort with the reason if the printer is powered off or does not become
+        operational before
+        """
+
+        with self._lock:
+            self._cancelConnectTimer()
+            self._connectedAt = None
+            self._connectAttempt = 0
+            self._onStartupAborted = onAbort
+        self._relays.runSequence(self._powerOnSequence, lambda: self._armConnect(callback),
+                                 () if lightsOn else (LIGHT,))
+
+    def _armConnect(self, callback):
+        """Waits for the printer to start up after the power on sequence before connecting"""
+        if (not self.isPrinterOn):
+            self._logger.warn("The power on sequence does not switch on the printer relay - switching it on")
+            self._relays.switch({PRINTER: True})
+
+        wait = self.connectWait
+        with self._lock:
+            self._poweredOnAt = self._relays.switchedAt(PRINTER)
+            delay = max(0, wait - (self._clock.monotonic() - self._poweredOnAt))
+            self._connectTimer = self._clock.timer(delay, self._connectPrinter, [callback])
+            self._connectTimer.start()
+
+        self._logger.debug(f"Connecting to the printer in {delay} sec.")
 
     def shutDownPrinter(self):
         """Command that shutdowns the printer and turns off the light"""
 
         if (self._checkTemperatures()):
-            self._cooldownTimer = None
+            with self._lock:
+                self._coolingDown = False
             self._shutDown()
         else:
-            self._logger.debug("Wait a few seconds for tool to cooldown")
-            self._cooldownTimer = ResettableTimer(TEMP_WAIT_CYCLE, self.shutDownPrinter)
-            self._cooldownTimer.start()
+            self._logger.debug("Wait for tool to cooldown")
+            with self._lock:
+                self._coolingDown = True
+                self._coolingCurve = CoolingCurve()
+                self._cooldownStarted = self._clock.monotonic()
+                self._cooldownPublished = None
+            self._events.record("cooldown", target=self._cooldownTemp)
+        self._notifyStateChange()
 
     def cancelShutDown(self):
         """Cancel a given shutdown command"""
-        if (None != self._cooldownTimer):
-            self._cooldownTimer.cancel();
-            self._cooldownTimer = None;
+        with self._lock:
+            if (not self._coolingDown):
+                return
+            self._coolingDown = False
+        self._events.record("cooldownCancelled")
+        self._notifyStateChange()
+
+    def processTemperatures(self, temperatures: dict):
+        """
+        Processes temperatures reported by the printer while waiting for the tool to cool down. The
+        printer is turned off as soon as all tools are below the cooldown temperature
+        """
+        if (not self._coolingDown):
+            return
+
+        toolTemps = [actual for key, (actual, _) in temperatures.items()
+                     if key.startswith("T") and actual is not None]
+        if not toolTemps:
+            return
+
+        temp = max(toolTemps)
+        with self._lock:
+            if (not self._coolingDown):
+                return
+            now = self._clock.monotonic()
+            self._coolingCurve.addSample(now, temp)
+            cooledDown = temp <= self._cooldownTemp
+            if cooledDown:
+                self._coolingDown = False
+                duration = now - self._cooldownStarted
+                self._cooldownDuration.observe(duration)
+            elif (None != self._cooldownPublished) and (now - self._cooldownPublished < COOLDOWN_PUBLISH_INTERVAL):
+                # the samples arrive on the communication thread, the ETA is published in intervals only
+                return
+            self._cooldownPublished = now
+
+        if cooledDown:
+            self._logger.debug(f"Tool cooled down to {temp}°C")
+            self._events.record("cooledDown", temperature=temp, duration=round(duration, 1))
+            # do not disconnect from within the communication thread reporting the temperatures
+            self._clock.timer(0, self._shutDown).start()
+        self._notifyStateChange()
 
     def toggleLight(self):
         """Command to toggle the state of the light"""
-        self._switchLight(not self._stateLight)
+        self._relays.switch({LIGHT: not self.isLightOn})
+
+    def switchRelay(self, name: str, state: bool) -> bool:
+        """Command to switch the relay of the given name, returns False if there is none"""
+        if name not in self._relays.names:
+            return False
+        self._relays.switch({name: state})
+        return True
+
+    def onPrinterStateChanged(self):
+        """
+        Powers off the printer once a pending disconnect has completed, or if the printer disconnected or
+        failed while waiting for the tool to cool down, as no temperatures are reported anymore then
+        """
+        self._observeStartup()
+        with self._lock:
+            if self._coolingDown and self._printer.is_closed_or_error():
+                self._coolingDown = False
+                lost = True
+            else:
+                lost = False
+                if (None == self._disconnectStarted) or (not self._printer.is_closed_or_error()):
+                    return
+                started = self._claimDisconnect()
+
+        if lost:
+            self._logger.warn("Printer disconnected while cooling down - shutting down without waiting")
+            self._events.record("cooldownAborted")
+            self._shutDown()
+            return
+        self._powerOff(started, False)
 
 # ~~ Private helper Methods
 
@@ -69,81 +217,234 @@ class PrinterControl:
         return tempOK
 
     def _shutDown(self):
+        with self._lock:
+            if (None != self._disconnectStarted):
+                return
+            self._disconnectStarted = self._clock.monotonic()
             self._printer.disconnect();
+            self._disconnectTimer = self._clock.timer(self._disconnectTimeout, self._disconnectTimedOut)
+            self._disconnectTimer.start()
+
+        # the printer might have been disconnected already
+        self.onPrinterStateChanged()
+
+    def _claimDisconnect(self):
+        """Ends waiting for the disconnect and returns when it has been started"""
+        if (None != self._disconnectTimer):
+            self._disconnectTimer.cancel()
+            self._disconnectTimer = None
+        started = self._disconnectStarted
+        self._disconnectStarted = None
+        return started
+
+    def _disconnectTimedOut(self):
+        with self._lock:
+            if (None == self._disconnectStarted):
+                return
+            started = self._claimDisconnect()
+
+        self._logger.warn(
+            f"Printer did not disconnect within {self._disconnectTimeout} sec. - cutting the power anyway")
+        self._powerOff(started, True)
+
+    def _powerOff(self, started, escalated):
+        with self._lock:
+            self._cancelConnectTimer()
+            self._poweredOnAt = None
+            self._connectedAt = None
+        self._abortStartup("Printer was powered off while starting up")
+        self._relays.runSequence(self._powerOffSequence, self._ensurePoweredOff)
+
+        latency = self._clock.monotonic() - started
+        self._shutdowns[escalated].inc()
+        self._lastShutdown = {
+            "latency": round(latency, 3),
+            "escalated": escalated
+        }
 
-            while (not self._printer.is_closed_or_error()): 
-                pass
-            
-            self._switchPrinter(False)
-            self._switchLight(False)
-
-    def _prepGPIOPin(self, pin) -> bool:
-        GPIO.setup(pin, GPIO.IN)
-        state = 1 == GPIO.input(pin)
-
-        GPIO.setup(pin, GPIO.OUT)
-        GPIO.output(pin, state)
-
-        return state
-
-    def _connectPrinter(self, callback):
-        self._printer.connect()
-        callback()
-
-    def _switchLight(self, state):
-        GPIO.output(self._gpioLight, state)
-        self._logger.debug("Light turned %s" %
-                           ("on" if state else "off"))
-        self._stateLight = state
-
-    def _switchPrinter(self, state):
-        GPIO.output(self._gpioPrinter, state)
-        self._logger.debug("Printer turned %s" %
-                           ("on" if state else "off"))
-        self._statePrinter = state
+        self._logger.info(
+            f"Printer powered off {latency:.3f} sec. after disconnect{' (escalated)' if escalated else ''}")
+        self._events.record("powerOff", latency=round(latency, 3), escalated=escalated)
+        self._notifyStateChange()
+
+    def _notifyStateChange(self):
+        if (None != self._onStateChange):
+            self._onStateChange()
+
+    def _ensurePoweredOff(self):
+        if self.isPrinterOn:
+            self._logger.warn("The power off sequence does not switch off the printer relay - switching it off")
+            self._relays.switch({PRINTER: False})
+
+    def _connectPrinter(self, callback = None):
+        with self._lock:
+            self._connectTimer = None
+            poweredOff = (None == self._poweredOnAt)
+            if not poweredOff:
+                first = (0 == self._connectAttempt)
+                self._connectAttempt += 1
+                self._connectedAt = self._clock.monotonic()
+                if first:
+                    self._connectLatency.observe(self._connectedAt - self._poweredOnAt)
+                connected = self._printer.is_operational()
+                if connected:
+                    self._poweredOnAt = None
+                    self._connectedAt = None
+                    self._onStartupAborted = None
+
+        if poweredOff:
+            self._abortStartup("Printer was powered off before connecting to it")
+            return
+        if not connected:
+            self._events.record("connect", attempt=self._connectAttempt)
+            self._printer.connect()
+            self._awaitConnection()
+        if first and (None != callback):
+            callback()
+
+    def _abortStartup(self, reason: str):
+        """Tells the one starting up the printer that the startup has been given up"""
+        with self._lock:
+            onAbort = self._onStartupAborted
+            self._onStartupAborted = None
+        if None != onAbort:
+            onAbort(reason)
+
+    def _awaitConnection(self):
+        """Arms the check of the current connection attempt, waiting twice as long after every attempt"""
+        with self._lock:
+            if (None == self._connectedAt) or (None != self._connectTimer):
+                return
+            delay = min(MAX_CONNECTION_WAIT, CONNECTION_WAIT * 2 ** (self._connectAttempt - 1))
+            self._connectTimer = self._clock.timer(delay, self._checkConnection)
+            self._connectTimer.start()
+
+    def _checkConnection(self):
+        with self._lock:
+            self._connectTimer = None
+            if (None == self._connectedAt) or self._printer.is_operational():
+                return
+            if not self._printer.is_closed_or_error():
+                # OctoPrint is still trying to connect, it fails on its own if the printer does not answer
+                retry = None
+            elif self._connectAttempt <= CONNECTION_TIMEOUT_REPEAT:
+                retry = True
+            else:
+                retry = False
+                self._connectedAt = None
+
+        if retry is None:
+            self._awaitConnection()
+        elif retry:
+            self._logger.info(f"Printer not ready yet, connection attempt {self._connectAttempt + 1}")
+            self._connectRetries.inc()
+            self._connectPrinter()
+        else:
+            self._logger.warn(f"Printer did not become operational after {self._connectAttempt} connection attempts")
+            self._events.record("connectFailed", attempts=self._connectAttempt)
+            self._abortStartup(f"Printer did not become operational after {self._connectAttempt} connection attempts")
+
+    def _cancelConnectTimer(self):
+        if (None != self._connectTimer):
+            self._connectTimer.cancel()
+            self._connectTimer = None
+
+    def _observeStartup(self):
+        """Records the startup latencies and warm-up time once a printer started up is operational"""
+        with self._lock:
+            if (None == self._connectedAt) or (not self._printer.is_operational()):
+                return
+            now = self._clock.monotonic()
+            self._onStartupAborted = None
+            self._operationalLatency.observe(now - self._connectedAt)
+            self._startupLatency.observe(now - self._poweredOnAt)
+            self._events.record("operational", startup=round(now - self._poweredOnAt, 3),
+                                attempts=self._connectAttempt)
+
+            if self._learnStartupTime:
+                self._warmup.record(self._connectedAt - self._poweredOnAt, self._connectAttempt > 1)
+
+            self._cancelConnectTimer()
+            self._connectedAt = None
+            self._poweredOnAt = None
 
 # ~~ Properties
 
     def _getPrinterState(self):
-        return self._statePrinter
+        return self._relays.isOn(PRINTER)
 
     isPrinterOn = property(_getPrinterState, None, None,
                            "Represents the state of the printer relais")
 
     def _getLightState(self):
-        return self._stateLight
+        return self._relays.isOn(LIGHT)
 
     isLightOn = property(_getLightState, None, None,
                          "Represents the state of the light relais")
 
     def _getPrinterGPIO(self):
-        return self._gpioPrinter
+        return self._relays.pin(PRINTER)
 
     def _setPrinterGPIO(self, pin):
-        if (None != self._gpioPrinter):
-            GPIO.cleanup(self._gpioPrinter)
-        self._gpioPrinter = int(pin)
-        self._statePrinter = self._prepGPIOPin(self._gpioPrinter)
-        self._logger.info(
-            f"New printer GPIO port is gpio{self._gpioPrinter} and it is {self._statePrinter}")
+        self._relays.configure(PRINTER, pin, "printer")
 
     printerGpio = property(_getPrinterGPIO, _setPrinterGPIO,
                            None, "The GPIO pin triggering the printer relais")
 
     def _getLightGPIO(self):
-        return self._gpioLight
+        return self._relays.pin(LIGHT)
 
     def _setLightGPIO(self, pin):
-        if (None != self._gpioLight):
-            GPIO.cleanup(self._gpioLight)
-        self._gpioLight = int(pin)
-        self._stateLight = self._prepGPIOPin(self._gpioLight)
-        self._logger.info(
-            f"New light GPIO port is gpio{self._gpioLight} and it is {self._stateLight}")
+        self._relays.configure(LIGHT, pin, "light")
 
     lightGpio = property(_getLightGPIO, _setLightGPIO, None,
                          "The GPIO pin triggering the light relais")
 
+    def _getRelays(self):
+        return self._relays.states
+
+    def _setRelays(self, relays):
+        """Configures the additional relays from a list of dicts with name, pin and role"""
+        configured = {PRINTER, LIGHT}
+        for relay in (relays or []):
+            name = relay.get("name") if isinstance(relay, dict) else None
+            pin = relay.get("pin") if isinstance(relay, dict) else None
+            if (not name) or (name in configured) or \
+                    not ((type(pin) == int) or (type(pin) == str and pin.isnumeric())):
+                self._logger.warn(f"Could not assign '{relay}' as relay: Needs a unique name and a valid pin")
+                continue
+            self._relays.configure(name, pin, relay.get("role") or "other")
+            configured.add(name)
+
+        for name in self._relays.names:
+            if name not in configured:
+                self._relays.remove(name)
+
+    relays = property(_getRelays, _setRelays, None,
+                      "Pin, role and state of all relays, assigned as list of the additional relays")
+
+    def _setPowerOnSequence(self, sequence):
+        if isinstance(sequence, list) and all(isinstance(step, dict) for step in sequence):
+            self._powerOnSequence = sequence
+        else:
+            self._logger.warn(f"Could not assign '{sequence}' as power on sequence: Not a list of steps")
+
+    powerOnSequence = property(lambda self: self._powerOnSequence, _setPowerOnSequence, None,
+                               "Steps switching the relays when the printer is started up")
+
+    def _setPowerOffSequence(self, sequence):
+        if isinstance(sequence, list) and all(isinstance(step, dict) for step in sequence):
+            self._powerOffSequence = sequence
+        else:
+            self._logger.warn(f"Could not assign '{sequence}' as power off sequence: Not a list of steps")
+
+    powerOffSequence = property(lambda self: self._powerOffSequence, _setPowerOffSequence, None,
+                                "Steps switching the relays when the printer is shut down")
+
+    def readRelays(self) -> dict:
+        """Reads the state of all relays back from their GPIO pins"""
+        return self._relays.readBack()
+
     def _getStartupTime(self):
         return self._startupTime
 
@@ -182,6 +483,57 @@ class PrinterControl:
     turnOffAfterPrint = property(_getTurnOffAfterPrint, _setTurnOffAfterPrint, None,
                                  "Default value if to turn off printer after print")
 
+    def _getDisconnectTimeout(self):
+        return self._disconnectTimeout
+
+    def _setDisconnectTimeout(self, time):
+        if ((type(time) == int) or (type(time) == str and time.isnumeric())) and (int(time) > 0):
+            self._disconnectTimeout = int(time)
+            self._logger.debug(f"Set printer disconnect timeout to {time} sec.")
+        else:
+            self._logger.warn(
+                f"Could not assign '{time}' as printer disconnect timeout: Not a valid number > 0")
+
+    disconnectTimeout = property(_getDisconnectTimeout, _setDisconnectTimeout, None,
+                                 "Time to wait for the printer to disconnect before the power is cut anyway")
+
+    def _getLearnStartupTime(self):
+        return self._learnStartupTime
+
+    def _setLearnStartupTime(self, learn):
+        self._learnStartupTime = True if (learn) else False
+
+    learnStartupTime = property(_getLearnStartupTime, _setLearnStartupTime, None,
+                                "If the wait before connecting is learned from the recorded warm-up times")
+
+    def _getConnectWait(self):
+        learned = self._warmup.wait if self._learnStartupTime else None
+        if (None == learned):
+            return self._startupTime
+        return round(max(CONNECTION_WAIT, learned), 1)
+
+    connectWait = property(_getConnectWait, None, None,
+                           "Seconds waited after turning on the printer before the first connection attempt")
+
+    @property
+    def lastShutdown(self):
+        """Latency between disconnect and power off of the last shutdown and if it had to be escalated"""
+        return self._lastShutdown
+
     @property
     def isCoolingDown(self):
-        return (None != self._cooldownTimer)
\ No newline at end of file
+        return self._coolingDown
+
+    @property
+    def isShuttingDown(self):
+        """If the printer is being disconnected to be powered off"""
+        return None != self._disconnectStarted
+
+    @property
+    def cooldownEta(self):
+        """Estimated seconds until the tool has cooled down, based on the temperatures seen so far"""
+        with self._lock:
+            if (not self._coolingDown) or (None == self._coolingCurve):
+                return None
+            eta = self._coolingCurve.eta(self._cooldownTemp)
+        return None if eta is None else round(eta)
\ No newline at end of file
@@ -1,9 +1,22 @@
+import os
 from logging import Logger
 from datetime import datetime, timedelta
 from math import ceil
 from datetime import datetime
+from uuid import uuid4
 
 from octoprint.filemanager import FileManager
+from .gcodeinfo import GcodeScanner
+from .heating import HeatupPredictor
+from .durations import DurationHistory
+from .clock import SystemClock
+
+# bed clear condition of batches: wait for the given seconds, an acknowledgement or the bed to cool down
+BED_CLEAR_MODES = ("timer", "ack", "temperature")
+DEFAULT_BED_CLEAR = {"mode": "timer", "delay": 300, "temperature": 30}
+# rough G-code bytes per second of printing, only used for a file without any estimate until OctoPrint
+# has analysed it
+PROVISIONAL_BYTES_PER_SECOND = 350
 
 
 class PrintJob:
@@ -12,28 +25,93 @@ class PrintJob:
     """
 
     def __init__(self, file: str, time: datetime, turnoffAfter: bool, startFinish: str, startWithLights: bool,
-                 logger: Logger, fileManager: FileManager):
+                 logger: Logger, fileManager: FileManager, scanner: GcodeScanner = None, clock = None,
+                 heatup: HeatupPredictor = None, durations: DurationHistory = None, batch: list = None,
+                 bedClear: dict = None):
         self._logger = logger
         self._fileManager = fileManager
+        self._scanner = scanner
+        self._clock = clock or SystemClock()
+        self._heatup = heatup
+        self._durations = durations
 
+        self._id = uuid4().hex[:12]
         self._jobFile = file
+        self._files = [file] + list(batch or [])
+        self._fileIndex = 0
+        self._bedClear = dict(bedClear or DEFAULT_BED_CLEAR)
         self._time = time
         self._startTime = None
         self._turnOffAfter = turnoffAfter
         self._startFinish = startFinish
         self._startWithLights = startWithLights
-        
+        self._state = "scheduled"
+        self._error = None
+        self._estimatedPrintTime = None
+        self._estimateSource = None
+        self._slicer = None
+        self._correction = None
+        self._heatTargets = {}
+        self._leadTime = 0
+        self._heatedAt = None
+        self._firedAt = None
+        self._pendingAnalysis = []
+
+        self._readHeatTargets(file)
+        self._estimateDuration()
         if ("asap" != self._startFinish):
             self._calcStartTime()
         else:
-            self._startTime = datetime.now()
+            self._startTime = self._clock.now()
+
+    @classmethod
+    def fromDict(cls, data: dict, logger: Logger, fileManager: FileManager, scanner: GcodeScanner = None,
+                 clock = None):
+        """Restores a job from its dict representation without recalculating its start time"""
+        job = cls.__new__(cls)
+        job._logger = logger
+        job._fileManager = fileManager
+        job._scanner = scanner
+        job._clock = clock or SystemClock()
+
+        job._id = data["id"]
+        job._jobFile = data["file"]
+        job._files = [data["file"]] + list(data.get("batch") or [])
+        job._fileIndex = 0
+        job._bedClear = data.get("bedClear") or dict(DEFAULT_BED_CLEAR)
+        job._time = datetime.fromtimestamp(data["time"] / 1000)
+        job._startTime = datetime.fromtimestamp(data["startTime"] / 1000)
+        job._turnOffAfter = data["turnOffAfter"]
+        job._startFinish = data["startFinish"]
+        job._startWithLights = data["startWithLights"]
+        job._state = "scheduled"
+        job._error = None
+        job._estimatedPrintTime = data.get("estimatedPrintTime")
+        job._estimateSource = data.get("estimateSource")
+        job._slicer = data.get("slicer")
+        job._correction = data.get("durationCorrection")
+        job._heatup = None
+        job._durations = None
+        job._heatTargets = data.get("heatTargets") or {}
+        job._leadTime = data.get("leadTime") or 0
+        job._heatedAt = None
+        job._firedAt = None
+        job._pendingAnalysis = list(data.get("pendingAnalysis") or [])
+        return job
+
+    def shiftToFuture(self) -> None:
+        """Moves a job whose start time has passed by whole days so it starts at the same time of day"""
+        days = timedelta(days=(self._clock.now() - self._startTime).days + 1)
+        self._time += days
+        self._startTime += days
 
     def _calcStartTime(self):
         duration = 0
         if ("finish" == self._startFinish):
-            metadata = self._fileManager.get_metadata("local", self._jobFile)
-            if ('analysis' in metadata) and ('estimatedPrintTime' in metadata['analysis']):
-                duration =metadata['analysis']['estimatedPrintTime']
+            if (None != self._estimatedPrintTime):
+                if (None != self._durations):
+                    self._correction = self._durations.correction(self._slicer, self._estimateSource)
+                duration = self.correctedPrintTime + self.bedClearTime
                 duration += 60 - (duration % 60)
             else:
                 self._logger.warn(f"No estimated print time available use time as start time!")
@@ -41,28 +119,125 @@ class PrintJob:
 
             self._logger.info(f"Adjusting time by {duration} seconds to finish at {self._time.isoformat()}")
 
-        self._startTime = self._time - timedelta(seconds=duration)
-        if (self._startTime < datetime.now()):
-            wrongtime = self._startTime
+        if (None != self._heatup):
+            self._leadTime = self._heatup.leadTime(self._heatTargets)
+            self._logger.info(f"Turning on the printer {self._leadTime} seconds early to start up and heat up")
+
+        self._startTime = self._time - timedelta(seconds=duration + self._leadTime)
+        now = self._clock.now()
+        if (self._startTime < now) and ("start" == self._startFinish) and (self._time >= now):
+            # too late to heat up in time, a start job is still started right away instead of being refused
+            self._logger.info(f"Turning on the printer right away, {(now - self._startTime).total_seconds():.0f} "
+                              f"seconds later than needed to heat up in time")
+            self._startTime = now
+        elif (self._startTime < now):
+            wrongtime = self._time if ("start" == self._startFinish) else self._startTime
             self._startTime = None
-            raise PrintJobTooEarly((datetime.now() - wrongtime).total_seconds() / 60);
+            raise PrintJobTooEarly((now - wrongtime).total_seconds() / 60);
+
+    def _estimateDuration(self):
+        """Estimates the duration of all files of the job, the source and slicer are the ones of the first file"""
+        estimates = [readEstimate(file, self._fileManager, self._scanner, self._logger, True) for file in self._files]
+        times = [estimate["estimatedPrintTime"] for estimate in estimates]
+        self._estimatedPrintTime = None if (None in times) else sum(times)
+        self._estimateSource = estimates[0]["estimateSource"]
+        self._slicer = estimates[0]["slicer"]
+        # only the start time of a finish job depends on the estimate, and only one from the file size is
+        # replaced once OctoPrint analysed the file
+        self._pendingAnalysis = [file for file, estimate in zip(self._files, estimates)
+                                 if estimate["estimateSource"] in (None, "size")] \
+            if ("finish" == self._startFinish) else []
+
+    def analysisFinished(self, file: str) -> bool:
+        """
+        Recalculates the start time once OctoPrint has analysed a file of the job which was scheduled
+        with a provisional estimate, returns False if the job did not wait for that file
+        """
+        if file not in self._pendingAnalysis:
+            return False
+        self._estimateDuration()
+        try:
+            self._calcStartTime()
+        except PrintJobTooEarly as e:
+            self._logger.warn(f"Printjob {self._id} cannot finish in time anymore: {e.message} It starts right away")
+            self._startTime = self._clock.now()
+        return True
+
+    def _readHeatTargets(self, file):
+        """Takes the bed and tool temperatures the printer is pre-heated to from the file's preamble"""
+        if (None == self._scanner):
+            return
+        try:
+            info = self._scanner.scan(self._fileManager.path_on_disk("local", file))
+        except OSError as e:
+            self._logger.warn(f"Could not scan {file} for heater targets: {e}")
+            return
+        targets = {"bed": info["bedTemperature"], "tool0": info["toolTemperature"]}
+        self._heatTargets = {heater: target for heater, target in targets.items() if None != target}
+
+    def markHeated(self) -> None:
+        """Records that the printer reached the heater targets of the job and the first layer starts"""
+        if (None == self._heatedAt):
+            self._heatedAt = self._clock.now()
+
+    def markFired(self) -> None:
+        """Records that the wake-up timer fired for the job"""
+        if (None == self._firedAt):
+            self._firedAt = self._clock.now()
+
+    def nextFile(self) -> str:
+        """Moves on to the next file of a batch and returns it"""
+        self._fileIndex += 1
+        self._readHeatTargets(self.fileToPrint)
+        return self.fileToPrint
 
     def __dict__(self):
         return {
+            "id": self._id,
             "file": self._jobFile,
+            "batch": self._files[1:],
+            "batchIndex": self._fileIndex,
+            "bedClear": self._bedClear,
             "time": self._time.timestamp()*1000,
             "startTime": self._startTime.timestamp()*1000,
             "turnOffAfter" : self._turnOffAfter,
-            "startWithLights" : self._startWithLights
+            "startWithLights" : self._startWithLights,
+            "startFinish": self._startFinish,
+            "estimatedPrintTime": self._estimatedPrintTime,
+            "estimateSource": self._estimateSource,
+            "slicer": self._slicer,
+            "durationCorrection": self._correction,
+            "correctedPrintTime": self.correctedPrintTime,
+            "heatTargets": self._heatTargets,
+            "leadTime": self._leadTime,
+            "actualLeadTime": self.actualLeadTime,
+            "leadDeviation": None if (None == self.actualLeadTime) else round(self.actualLeadTime - self._leadTime),
+            "fireError": self.fireError,
+            "estimateAccuracy": self.estimateAccuracy,
+            "pendingAnalysis": self._pendingAnalysis,
+            "state": self._state,
+            "error": self._error
         }
 
     # ~Properties
 
+    def _getId(self):
+        return self._id
+
+    id = property(_getId, None, None,
+                  "Unique identifier of the print job")
+
+    def _getStartTime(self):
+        return self._startTime
+
+    startTime = property(_getStartTime, None, None,
+                         "The time at which the printjob should start")
+
     def _getSecondsToStart(self):
         if ("asap" == self._startFinish):
             return 0;
         else:
-            return (self._startTime - datetime.now()).total_seconds()
+            return (self._startTime - self._clock.now()).total_seconds()
 
     secondsToStart = property(_getSecondsToStart, None, None,
                             "The time in second until the printjob should start")
@@ -73,17 +248,142 @@ class PrintJob:
     startWithLights = property(_isStartingWithLights, None, None,
                             "Determining if the printer should start with the lights on")
 
+    def _getEstimatedPrintTime(self):
+        return self._estimatedPrintTime
+
+    estimatedPrintTime = property(_getEstimatedPrintTime, None, None,
+                                  "Estimated duration of the print in seconds (None if unknown)")
+
+    def _getCorrectedPrintTime(self):
+        estimate = self.estimatedPrintTime
+        if (None == estimate) or (None == self._correction):
+            return estimate
+        return round(estimate * self._correction["factor"])
+
+    correctedPrintTime = property(_getCorrectedPrintTime, None, None,
+                                  "Estimated duration corrected by the durations of earlier prints")
+
+    heatTargets = property(lambda self: dict(self._heatTargets), None, None,
+                           "Temperatures of the heaters (bed, tool0) the printer is pre-heated to")
+
+    leadTime = property(lambda self: self._leadTime, None, None,
+                        "Predicted seconds between turning on the printer and the first layer")
+
+    def _getActualLeadTime(self):
+        if (None == self._heatedAt) or (None == self._startTime):
+            return None
+        return round((self._heatedAt - self._startTime).total_seconds())
+
+    actualLeadTime = property(_getActualLeadTime, None, None,
+                              "Seconds between the start time and the printer reaching the heater targets")
+
+    def _getFireError(self):
+        if (None == self._firedAt) or (None == self._startTime):
+            return None
+        return round((self._firedAt - self._startTime).total_seconds(), 3)
+
+    def _getEstimateAccuracy(self):
+        if ("finish" != self._startFinish):
+            return None
+        return "provisional" if self._pendingAnalysis else "final"
+
+    estimateAccuracy = property(_getEstimateAccuracy, None, None,
+                                "provisional while a file of a finish job waits for OctoPrint's analysis, else final")
+
+    pendingAnalysis = property(lambda self: list(self._pendingAnalysis), None, None,
+                               "Files whose analysis the start time of a finish job still waits for")
+
+    fireError = property(_getFireError, None, None,
+                         "Seconds the wake-up timer fired after the start time of the job (negative if early)")
+
+    def _getEndTime(self):
+        if ("finish" == self._startFinish):
+            return self._time
+        duration = self._leadTime + (self.correctedPrintTime or 0) + self.bedClearTime
+        return self._startTime + timedelta(seconds=duration)
+
+    endTime = property(_getEndTime, None, None, "Time at which the printjob is expected to be finished")
+
     def _getJobFile(self):
-        return self._jobFile
+        return self._files[self._fileIndex]
 
     fileToPrint = property(_getJobFile, None, None,
                             "Filename of the file to print")
 
+    files = property(lambda self: list(self._files), None, None,
+                     "Files printed one after the other by the job")
+
+    hasNextFile = property(lambda self: self._fileIndex + 1 < len(self._files), None, None,
+                           "If the job has further files to print after the current one")
+
+    bedClear = property(lambda self: dict(self._bedClear), None, None,
+                        "Condition (mode, delay, temperature) for the bed to be cleared between the files")
+
+    def _getBedClearTime(self):
+        if ("timer" != self._bedClear.get("mode")):
+            return 0
+        return (len(self._files) - 1) * int(self._bedClear.get("delay") or 0)
+
+    bedClearTime = property(_getBedClearTime, None, None,
+                            "Seconds spent waiting for the bed to be cleared between the files, if known")
+
     def _setTurnOffAfter(self, turnOff) -> None:
         self._turnOffAfter = True if turnOff else False
 
     turnOffAfter = property(lambda self: self._turnOffAfter, _setTurnOffAfter)
 
+    def _getState(self):
+        return self._state
+
+    def _setState(self, state):
+        self._state = state
+
+    state = property(_getState, _setState, None,
+                     "Lifecycle state of the job (scheduled, starting, printing, clearingBed, failed)")
+
+    def fail(self, error: str) -> None:
+        """Marks the job as failed with the given reason"""
+        self._state = "failed"
+        self._error = error
+
+    error = property(lambda self: self._error, None, None,
+                     "Reason why the job failed")
+
+
+def readEstimate(file: str, fileManager: FileManager, scanner: GcodeScanner = None, logger: Logger = None,
+                 provisional: bool = False) -> dict:
+    """
+    Returns the estimated print time of a file from OctoPrint's analysis or else from its slicer header,
+    as dict with the estimatedPrintTime, the estimateSource (analysis, header, size) and the slicer. With
+    provisional set a file without either is estimated from its size
+    """
+    estimate = {"estimatedPrintTime": None, "estimateSource": None, "slicer": None}
+    info = {}
+    if (None != scanner):
+        try:
+            info = scanner.scan(fileManager.path_on_disk("local", file))
+        except OSError as e:
+            if (None != logger):
+                logger.warn(f"Could not scan {file} for a slicer header: {e}")
+    estimate["slicer"] = info.get("slicer")
+
+    metadata = fileManager.get_metadata("local", file) or {}
+    if ('analysis' in metadata) and ('estimatedPrintTime' in metadata['analysis']):
+        estimate["estimatedPrintTime"] = metadata['analysis']['estimatedPrintTime']
+        estimate["estimateSource"] = "analysis"
+    elif (None != info.get("estimatedPrintTime")):
+        estimate["estimatedPrintTime"] = info["estimatedPrintTime"]
+        estimate["estimateSource"] = "header"
+    elif provisional:
+        try:
+            size = os.path.getsize(fileManager.path_on_disk("local", file))
+            estimate["estimatedPrintTime"] = round(size / PROVISIONAL_BYTES_PER_SECOND)
+            estimate["estimateSource"] = "size"
+        except OSError as e:
+            if (None != logger):
+                logger.warn(f"Could not read the size of {file}: {e}")
+    return estimate
+
 
 class PrintJobTooEarly(Exception):
 
@@ -0,0 +1,459 @@
+from bisect import bisect_right
+from calendar import monthrange
+from datetime import datetime, timedelta
+from itertools import product
+from logging import Logger
+from threading import RLock
+from uuid import uuid4
+
+from .clock import SystemClock
+from .journal import JobJournal
+from .printjob import PrintJobTooEarly
+
+# upper bound of the periods (days, weeks, months) searched without an occurrence, e.g. for the 31st
+# of every second month
+MAX_EMPTY_PERIODS = 400
+# occurrences which are too close to schedule are skipped, at most this many in a row
+MAX_SKIPPED = 100
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+CRON_MONTHS = ("JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC")
+CRON_DAYS = ("SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT")
+
+
+class InvalidRecurrence(Exception):
+
+    def __init__(self, rule, reason):
+        self.message = f"Invalid recurrence '{rule}': {reason}"
+        super().__init__(self.message)
+
+
+class CronRule:
+    """
+    Cron expression with the five fields minute, hour, day of month, month and day of week, each a
+    list of values, ranges and steps (e.g. "0 6 * * 1-5"), occurring from the given start time on. The
+    next occurrence is found field by field, jumping over whole months, days and hours which do not match
+    """
+
+    def __init__(self, text: str, start: datetime = None) -> None:
+        self.text = text
+        self._start = None if (None == start) else start.replace(second=0, microsecond=0)
+        fields = text.split()
+        if 5 != len(fields):
+            raise InvalidRecurrence(text, "a cron expression needs 5 fields")
+        self._minutes = _cronField(text, fields[0], 0, 59)
+        self._hours = _cronField(text, fields[1], 0, 23)
+        self._days = _cronField(text, fields[2], 1, 31)
+        self._months = _cronField(text, fields[3], 1, 12, CRON_MONTHS, 1)
+        # cron counts the days of the week from sunday (0 or 7)
+        self._weekdays = sorted({(day + 6) % 7 for day in _cronField(text, fields[4], 0, 7, CRON_DAYS)})
+        self._anyDay = "*" == fields[2]
+        self._anyWeekday = "*" == fields[4]
+
+    def next(self, after: datetime):
+        """First occurrence after the given time, None if there is none within the next years"""
+        if None != self._start:
+            after = max(after, self._start - timedelta(minutes=1))
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        last = after.year + 8
+
+        while time.year <= last:
+            if time.month not in self._months:
+                index = bisect_right(self._months, time.month)
+                year = time.year if index < len(self._months) else time.year + 1
+                time = datetime(year, self._months[index % len(self._months)], 1)
+                continue
+            if not self._dayMatches(time):
+                time = datetime(time.year, time.month, time.day) + timedelta(days=1)
+                continue
+            if time.hour not in self._hours:
+                index = bisect_right(self._hours, time.hour)
+                if index == len(self._hours):
+                    time = datetime(time.year, time.month, time.day) + timedelta(days=1)
+                else:
+                    time = time.replace(hour=self._hours[index], minute=0)
+                continue
+            if time.minute not in self._minutes:
+                index = bisect_right(self._minutes, time.minute)
+                if index == len(self._minutes):
+                    time = time.replace(minute=0) + timedelta(hours=1)
+                else:
+                    time = time.replace(minute=self._minutes[index])
+                continue
+            return time
+
+        return None
+
+    def _dayMatches(self, time: datetime) -> bool:
+        day = time.day in self._days
+        weekday = time.weekday() in self._weekdays
+        if self._anyDay or self._anyWeekday:
+            return day and weekday
+        # cron matches either of both if both are restricted
+        return day or weekday
+
+
+class RRule:
+    """
+    Subset of the RFC 5545 recurrence rule: FREQ (DAILY, WEEKLY, MONTHLY), INTERVAL, BYDAY (without
+    ordinals), BYMONTHDAY, BYHOUR, BYMINUTE, COUNT and UNTIL, starting at the given time. The next
+    occurrence is calculated from the period the given time falls in, without going through the
+    earlier occurrences
+    """
+
+    def __init__(self, text: str, start: datetime) -> None:
+        self.text = text
+        self._start = start.replace(second=0, microsecond=0)
+        parts = {}
+        for part in text.upper().replace("RRULE:", "").strip().split(";"):
+            if not part:
+                continue
+            key, _, value = part.partition("=")
+            parts[key.strip()] = value.strip()
+
+        self._frequency = parts.get("FREQ")
+        if self._frequency not in FREQUENCIES:
+            raise InvalidRecurrence(text, f"FREQ must be one of {', '.join(FREQUENCIES)}")
+        unsupported = set(parts) - {"FREQ", "INTERVAL", "BYDAY", "BYMONTHDAY", "BYHOUR", "BYMINUTE", "COUNT",
+                                    "UNTIL", "WKST"}
+        if unsupported:
+            raise InvalidRecurrence(text, f"{', '.join(sorted(unsupported))} is not supported")
+
+        try:
+            self._interval = int(parts.get("INTERVAL", 1))
+            self.count = int(parts["COUNT"]) if "COUNT" in parts else None
+            self._until = _parseUntil(parts["UNTIL"]) if "UNTIL" in parts else None
+            self._hours = _numbers(parts, "BYHOUR", [self._start.hour], 0, 23)
+            self._minutes = _numbers(parts, "BYMINUTE", [self._start.minute], 0, 59)
+            self._monthDays = _numbers(parts, "BYMONTHDAY", None, -31, 31)
+        except ValueError as e:
+            raise InvalidRecurrence(text, e)
+        if self._interval < 1:
+            raise InvalidRecurrence(text, "INTERVAL must be at least 1")
+
+        self._weekdays = None
+        if "BYDAY" in parts:
+            days = parts["BYDAY"].split(",")
+            if any(day not in WEEKDAYS for day in days):
+                raise InvalidRecurrence(text, "BYDAY must list the days MO to SU without ordinals")
+            self._weekdays = sorted(WEEKDAYS.index(day) for day in days)
+        elif ("WEEKLY" == self._frequency):
+            self._weekdays = [self._start.weekday()]
+        if ("MONTHLY" == self._frequency) and (None == self._weekdays) and (None == self._monthDays):
+            self._monthDays = [self._start.day]
+
+        self._times = sorted(product(self._hours, self._minutes))
+
+    def next(self, after: datetime):
+        """First occurrence after the given time, None if the rule ended before"""
+        after = max(after, self._start - timedelta(minutes=1))
+        period = self._period(after)
+        period -= period % self._interval
+
+        for _ in range(MAX_EMPTY_PERIODS):
+            for day in self._days(period):
+                for hour, minute in self._times:
+                    time = datetime(day.year, day.month, day.day, hour, minute)
+                    if (time <= after) or (time < self._start):
+                        continue
+                    return time if (None == self._until) or (time <= self._until) else None
+            period += self._interval
+        return None
+
+    def _period(self, time: datetime) -> int:
+        """Number of the day, week or month of the time, counted from the one of the start"""
+        if "DAILY" == self._frequency:
+            return (time.date() - self._start.date()).days
+        if "WEEKLY" == self._frequency:
+            return (_monday(time) - _monday(self._start)).days // 7
+        return (time.year - self._start.year) * 12 + time.month - self._start.month
+
+    def _days(self, period: int) -> list:
+        """Days of the given period the rule occurs on, in order"""
+        if "DAILY" == self._frequency:
+            day = self._start.date() + timedelta(days=period)
+            days = [day]
+        elif "WEEKLY" == self._frequency:
+            monday = _monday(self._start) + timedelta(weeks=period)
+            days = [monday + timedelta(days=weekday) for weekday in self._weekdays]
+        else:
+            month = self._start.month - 1 + period
+            year, month = self._start.year + month // 12, month % 12 + 1
+            length = monthrange(year, month)[1]
+            first = datetime(year, month, 1).date()
+            days = [first + timedelta(days=day) for day in range(length)]
+
+        if None != self._weekdays:
+            days = [day for day in days if day.weekday() in self._weekdays]
+        if None != self._monthDays:
+            days = [day for day in days if (day.day in self._monthDays)
+                    or (day.day - monthrange(day.year, day.month)[1] - 1 in self._monthDays)]
+        return days
+
+
+def _monday(time: datetime):
+    return time.date() - timedelta(days=time.weekday())
+
+
+def _parseUntil(value: str) -> datetime:
+    """UNTIL as date or local date and time (a UTC time is taken as local time as well)"""
+    value = value.rstrip("Z")
+    if "T" in value:
+        return datetime.strptime(value, "%Y%m%dT%H%M%S")
+    return datetime.strptime(value, "%Y%m%d") + timedelta(days=1, microseconds=-1)
+
+
+def _numbers(parts: dict, key: str, default, low: int, high: int):
+    if key not in parts:
+        return default
+    numbers = sorted({int(value) for value in parts[key].split(",")})
+    if any((number < low) or (number > high) or (0 == number and low < 0) for number in numbers):
+        raise ValueError(f"{key} must be between {low} and {high}")
+    return numbers
+
+
+def _cronField(text: str, field: str, low: int, high: int, names: tuple = (), offset: int = 0) -> list:
+    """Sorted values of a cron field of comma separated values, ranges and steps"""
+    def value(token):
+        if token.upper() in names:
+            return names.index(token.upper()) + offset
+        if not token.isdigit():
+            raise InvalidRecurrence(text, f"'{token}' is not a valid value")
+        return int(token)
+
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        if "*" == part:
+            first, last = low, high
+        elif "-" in part:
+            first, _, last = part.partition("-")
+            first, last = value(first), value(last)
+        else:
+            first = last = value(part)
+            if step:
+                last = high
+        if step and not step.isdigit():
+            raise InvalidRecurrence(text, f"'{step}' is not a valid step")
+        if (first < low) or (last > high) or (first > last):
+            raise InvalidRecurrence(text, f"'{field}' is out of the range {low}-{high}")
+        values.update(range(first, last + 1, int(step) if step else 1))
+    return sorted(values)
+
+
+def parseRule(text: str, start: datetime):
+    """Returns the rule of a cron expression or an RRULE (starting at the given time)"""
+    if not text or not text.strip():
+        raise InvalidRecurrence(text, "the rule is empty")
+    if "FREQ=" in text.upper():
+        return RRule(text, start)
+    return CronRule(text, start)
+
+
+class RecurringJob:
+    """
+    Series of print jobs created from a template (the parameters of scheduleJob) at the occurrences of
+    a recurrence rule. Only the next occurrence is scheduled as print job at a time
+    """
+
+    def __init__(self, rule: str, start: datetime, template: dict, id: str = None, count: int = 0,
+                 lastOccurrence: datetime = None) -> None:
+        self._id = id or uuid4().hex[:12]
+        self._start = start
+        self._rule = parseRule(rule, start)
+        self._template = template
+        self._count = count
+        self._lastOccurrence = lastOccurrence
+        self.jobId = None
+
+    @classmethod
+    def fromDict(cls, data: dict):
+        """
+        Restores a series from the journal. The job of its scheduled occurrence is not kept in the
+        journal, so the series is rewound to before that occurrence to schedule it again
+        """
+        last = data.get("lastOccurrence")
+        last = datetime.fromtimestamp(last / 1000) if last else None
+        count = data.get("count", 0)
+        if (None != last) and (None != data.get("jobId")):
+            last -= timedelta(minutes=1)
+            count = max(0, count - 1)
+        return cls(data["rule"], datetime.fromtimestamp(data["start"] / 1000), data["template"], data["id"],
+                   count, last)
+
+    def nextOccurrence(self, after: datetime):
+        """Next occurrence after the given time and the last scheduled one, None if the series ended"""
+        limit = getattr(self._rule, "count", None)
+        if (None != limit) and (self._count >= limit):
+            return None
+        if (None != self._lastOccurrence) and (self._lastOccurrence > after):
+            after = self._lastOccurrence
+        return self._rule.next(after)
+
+    def following(self, until: datetime):
+        """Occurrences after the last scheduled one up to the given time"""
+        limit = getattr(self._rule, "count", None)
+        count = self._count
+        time = self._lastOccurrence
+        while (None != time) and ((None == limit) or (count < limit)):
+            time = self._rule.next(time)
+            if (None == time) or (time > until):
+                return
+            count += 1
+            yield time
+
+    def occurred(self, time: datetime, jobId: str) -> None:
+        """Records that the occurrence at the given time has been scheduled as the job with the given id"""
+        self._count += 1
+        self._lastOccurrence = time
+        self.jobId = jobId
+
+    def __dict__(self):
+        return {
+            "id": self._id,
+            "rule": self._rule.text,
+            "start": self._start.timestamp() * 1000,
+            "template": self._template,
+            "count": self._count,
+            "lastOccurrence": None if (None == self._lastOccurrence) else self._lastOccurrence.timestamp() * 1000,
+            "jobId": self.jobId
+        }
+
+    id = property(lambda self: self._id, None, None, "Unique identifier of the series")
+
+    template = property(lambda self: dict(self._template), None, None,
+                        "Parameters of the print jobs as for scheduleJob")
+
+    lastOccurrence = property(lambda self: self._lastOccurrence, None, None,
+                              "Time of the occurrence scheduled last")
+
+
+class RecurringSchedule:
+    """
+    Keeps the recurring jobs and schedules the next occurrence of a series on the timer whenever the
+    previous one has been started or skipped. Occurrences too close to be scheduled are skipped.
+    The series are kept in the job journal, their occurrences are re-created after a restart
+    """
+
+    def __init__(self, logger: Logger, timer, createJob, journal: JobJournal = None, clock = None) -> None:
+        self._logger = logger
+        self._timer = timer
+        self._createJob = createJob
+        self._journal = journal
+        self._clock = clock or SystemClock()
+        self._lock = RLock()
+        self._series = {}
+
+    def add(self, series: RecurringJob) -> bool:
+        """Adds a series and schedules its first occurrence, returns False if it has none"""
+        with self._lock:
+            self._series[series.id] = series
+            if not self._scheduleNext(series):
+                return False
+        self._logger.info(f"Added recurring printjob {series.id} for {series.template['path']}")
+        return True
+
+    def restore(self, series: list) -> None:
+        for data in series:
+            try:
+                self.add(RecurringJob.fromDict(data))
+            except (InvalidRecurrence, KeyError, TypeError) as e:
+                self._logger.warn(f"Dropping unreadable recurring printjob {data.get('id')}: {e}")
+                self._journalEntry("unrecurring", data.get("id"))
+
+    def remove(self, seriesId: str) -> bool:
+        """Removes a series and cancels its scheduled occurrence"""
+        with self._lock:
+            series = self._series.pop(seriesId, None)
+            if None == series:
+                return False
+            self._journalEntry("unrecurring", seriesId)
+        if None != series.jobId:
+            self._timer.cancelJob(series.jobId)
+        self._logger.info(f"Removed recurring printjob {seriesId}")
+        return True
+
+    def removeAll(self) -> None:
+        """Removes all series and cancels their scheduled occurrences"""
+        for series in self.series:
+            self.remove(series.id)
+
+    def onJobStarted(self, job) -> None:
+        """Schedules the next occurrence of the series the started job belongs to"""
+        self._scheduleAfter(job.id)
+
+    def skip(self, jobId: str) -> bool:
+        """
+        Schedules the next occurrence of the series whose occurrence with the given job id has been
+        cancelled, returns False if the job is no occurrence of a series
+        """
+        if not self._scheduleAfter(jobId):
+            return False
+        self._logger.info(f"Skipped occurrence {jobId} of a recurring printjob")
+        return True
+
+    def _scheduleAfter(self, jobId: str) -> bool:
+        with self._lock:
+            series = next((s for s in self._series.values() if s.jobId == jobId), None)
+            if None == series:
+                return False
+            series.jobId = None
+            self._scheduleNext(series)
+            return True
+
+    def _scheduleNext(self, series: RecurringJob) -> bool:
+        after = self._clock.now()
+        for _ in range(MAX_SKIPPED):
+            time = series.nextOccurrence(after)
+            if None == time:
+                self._logger.info(f"Recurring printjob {series.id} has no further occurrences")
+                self._series.pop(series.id, None)
+                self._journalEntry("unrecurring", series.id)
+                return False
+            try:
+                job = self._createJob(series.template, time)
+            except PrintJobTooEarly as e:
+                self._logger.warn(f"Skipping occurrence {time.isoformat()} of recurring printjob {series.id}: "
+                                  f"{e.message}")
+                series.occurred(time, None)
+                after = time
+                continue
+
+            series.occurred(time, job.id)
+            self._journalEntry("recurring", series.__dict__())
+            self._timer.scheduleJob(job, False)
+            return True
+
+        self._logger.warn(f"Removing recurring printjob {series.id}: {MAX_SKIPPED} occurrences in a row "
+                          f"could not be scheduled")
+        self._series.pop(series.id, None)
+        self._journalEntry("unrecurring", series.id)
+        return False
+
+    def upcoming(self, until: datetime) -> list:
+        """
+        Start and end times of the occurrences of all series after their scheduled job up to the given
+        time, taking the lead and duration of the scheduled job for them
+        """
+        events = []
+        with self._lock:
+            for series in list(self._series.values()):
+                job = self._timer.getJob(series.jobId) if (None != series.jobId) else None
+                if (None == job) or (None == series.lastOccurrence):
+                    continue
+                startOffset = job.startTime - series.lastOccurrence
+                endOffset = job.endTime - series.lastOccurrence
+                for time in series.following(until - startOffset):
+                    events.append({"series": series, "start": time + startOffset, "end": time + endOffset})
+        return events
+
+    def _journalEntry(self, event: str, data) -> None:
+        if (None != self._journal):
+            getattr(self._journal, event)(data)
+
+    def _getSeries(self):
+        with self._lock:
+            return list(self._series.values())
+
+    series = property(_getSeries, None, None, "All recurring jobs")
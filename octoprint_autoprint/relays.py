@@ -0,0 +1,163 @@
+from logging import Logger
+from threading import RLock
+from time import perf_counter
+
+from .clock import SystemClock
+from .events import EventLog
+from .gpiobackend import GpioBackend
+from .metrics import Metrics
+
+ROLES = ("printer", "light", "fan", "heater", "camera", "other")
+
+
+class RelayBank:
+    """
+    Bank of named relays on GPIO pins, each with a role. Relays switched together are written with
+    a single call of the GPIO backend. Sequences switch groups of relays one after the other with
+    a delay after each group, e.g. to keep the inrush currents of the power supplies apart.
+
+    A sequence is a list of steps, each a dict with the relays to switch "on" and "off" and the
+    "delay" in seconds before the next step. Relays are given by their name or their role.
+    """
+
+    def __init__(self, logger: Logger, gpio: GpioBackend, clock = None, metrics: Metrics = None,
+                 onChange = None, events: EventLog = None) -> None:
+        self._logger = logger
+        self._events = events or EventLog(logger)
+        self._gpio = gpio
+        self._clock = clock or SystemClock()
+        self._metrics = metrics or Metrics()
+        self._onChange = onChange
+        self._lock = RLock()
+        self._relays = {}
+        self._latency = {}
+
+    def configure(self, name: str, pin: int, role: str) -> bool:
+        """Adds a relay or moves it to another pin and returns its current state"""
+        pin = int(pin)
+        if role not in ROLES:
+            self._logger.warn(f"Unknown role '{role}' of relay {name}, using 'other'")
+            role = "other"
+
+        with self._lock:
+            relay = self._relays.get(name)
+            if (None != relay) and (relay["pin"] == pin):
+                relay["role"] = role
+                return relay["on"]
+            if (None != relay):
+                self._gpio.cleanup(relay["pin"])
+
+            self._gpio.setup(pin, self._gpio.IN)
+            state = 1 == self._gpio.input(pin)
+            self._gpio.setup(pin, self._gpio.OUT)
+            self._gpio.output(pin, state)
+            self._relays[name] = {"pin": pin, "role": role, "on": state, "switchedAt": None}
+
+        self._logger.info(f"Relay {name} ({role}) is on gpio{pin} and it is {state}")
+        return state
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            relay = self._relays.pop(name, None)
+            if (None != relay):
+                self._gpio.cleanup(relay["pin"])
+
+    def switch(self, states: dict) -> None:
+        """Switches the given relays (name to state) with one write"""
+        with self._lock:
+            names = [name for name in states if name in self._relays]
+            if not names:
+                return
+            pins = [self._relays[name]["pin"] for name in names]
+            values = [True if states[name] else False for name in names]
+
+            started = perf_counter()
+            if 1 == len(pins):
+                self._gpio.output(pins[0], values[0])
+            else:
+                self._gpio.output(pins, values)
+            latency = perf_counter() - started
+
+            now = self._clock.monotonic()
+            for name, value in zip(names, values):
+                relay = self._relays[name]
+                relay["on"] = value
+                relay["switchedAt"] = now
+                self._latencyOf(name).observe(latency)
+
+        self._logger.debug("Switched " + ", ".join(f"{n} {'on' if v else 'off'}"
+                                                   for n, v in zip(names, values)))
+        self._events.record("relay", states=dict(zip(names, values)), latency=round(latency, 6))
+        if (None != self._onChange):
+            self._onChange()
+
+    def runSequence(self, steps: list, done = None, exclude: tuple = ()) -> None:
+        """
+        Runs the steps of a sequence, leaving out the relays of the excluded names or roles, and calls
+        done after the last one
+        """
+        self._runStep(list(steps or []), 0, done, exclude)
+
+    def _runStep(self, steps, index, done, exclude):
+        while index < len(steps):
+            step = steps[index]
+            states = {name: True for name in self.resolve(step.get("on", []), exclude)}
+            states.update({name: False for name in self.resolve(step.get("off", []), exclude)})
+            self.switch(states)
+
+            index += 1
+            delay = float(step.get("delay", 0) or 0)
+            if (delay > 0) and (index < len(steps)):
+                self._clock.timer(delay, self._runStep, [steps, index, done, exclude]).start()
+                return
+
+        if (None != done):
+            done()
+
+    def resolve(self, names: list, exclude: tuple = ()) -> list:
+        """Names of the relays with the given names or roles"""
+        with self._lock:
+            resolved = []
+            for name in names:
+                matches = [name] if name in self._relays else \
+                    [n for n, r in self._relays.items() if r["role"] == name]
+                if not matches:
+                    self._logger.warn(f"No relay with the name or role '{name}'")
+                for n in matches:
+                    if (n not in resolved) and (n not in exclude) and (self._relays[n]["role"] not in exclude):
+                        resolved.append(n)
+            return resolved
+
+    def isOn(self, name: str) -> bool:
+        relay = self._relays.get(name)
+        return (None != relay) and relay["on"]
+
+    def pin(self, name: str):
+        relay = self._relays.get(name)
+        return None if (None == relay) else relay["pin"]
+
+    def switchedAt(self, name: str):
+        """Monotonic time the relay was switched last, None if it has not been switched"""
+        relay = self._relays.get(name)
+        return None if (None == relay) else relay["switchedAt"]
+
+    def readBack(self) -> dict:
+        """Reads the state of all relays from their pins"""
+        with self._lock:
+            return {name: {"pin": r["pin"], "role": r["role"], "on": 1 == self._gpio.input(r["pin"])}
+                    for name, r in self._relays.items()}
+
+    def _latencyOf(self, name):
+        if name not in self._latency:
+            self._latency[name] = self._metrics.histogram(
+                "autoprint_gpio_switch_seconds", "Time taken to switch a relay",
+                relay=name, backend=getattr(self._gpio, "name", None) or "custom")
+        return self._latency[name]
+
+    names = property(lambda self: list(self._relays), None, None, "Names of the relays")
+
+    def _getStates(self):
+        with self._lock:
+            return {name: {"pin": r["pin"], "role": r["role"], "on": r["on"]} for name, r in self._relays.items()}
+
+    states = property(_getStates, None, None, "Pin, role and state of every relay")
@@ -0,0 +1,158 @@
+from heapq import heappush, heappop, heapify
+from itertools import count
+from logging import Logger, getLogger
+from threading import Condition, Lock, Thread, current_thread
+from time import monotonic
+
+from .metrics import Metrics
+
+# number of cancelled entries tolerated in the queue before it is rebuilt
+STALE_ENTRY_SLACK = 16
+# seconds to wait for a running callback on shutdown
+SHUTDOWN_TIMEOUT = 5
+
+
+class ScheduledTimer:
+    """
+    Timer of the Scheduler with the interface of OctoPrint's ResettableTimer used by the plugin. It
+    fires at most once: a cancel before the callback has been taken off the queue always prevents it
+    """
+
+    def __init__(self, scheduler, delay: float, callback, args: list = None) -> None:
+        self._scheduler = scheduler
+        self._delay = delay
+        self._callback = callback
+        self._args = args or []
+        self.due = None
+        self.cancelled = False
+        self.fired = False
+
+    def start(self) -> None:
+        self._scheduler._add(self)
+
+    def cancel(self) -> bool:
+        """Cancels the timer and returns True if this prevented the callback"""
+        return self._scheduler._cancel(self)
+
+    def _fire(self) -> None:
+        self._callback(*self._args)
+
+
+class Scheduler:
+    """
+    Runs the timed work of the plugin (connect delays, cooldown and disconnect checks, job wake-ups,
+    relay sequences) on one dedicated thread in the order of the due times, instead of a thread per
+    timer. The thread is started with the first timer and runs until shutdown, so the number of
+    threads stays constant. Callbacks should not block, as they delay all timers due after them
+    """
+
+    def __init__(self, logger: Logger = None, metrics: Metrics = None, name: str = "autoprint-scheduler") -> None:
+        self._logger = logger or getLogger(__name__)
+        self._name = name
+        self._condition = Condition()
+        self._queue = []
+        self._live = 0
+        self._sequence = count()
+        self._thread = None
+        self._stopped = False
+
+        metrics = metrics or Metrics()
+        self._lag = metrics.histogram(
+            "autoprint_scheduler_lag_seconds", "Delay between the due time of a timer and its callback",
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+        metrics.gauge("autoprint_scheduler_pending", "Timers waiting on the scheduler thread", lambda: self._live)
+
+    def timer(self, delay: float, callback, args: list = None) -> ScheduledTimer:
+        """Returns a not yet started timer calling the callback on the scheduler thread after the delay"""
+        return ScheduledTimer(self, delay, callback, args)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Drops all pending timers and stops the thread once a running callback has returned"""
+        with self._condition:
+            self._stopped = True
+            for _, _, timer in self._queue:
+                timer.cancelled = True
+            self._queue = []
+            self._live = 0
+            self._condition.notify()
+            thread = self._thread
+
+        if wait and (None != thread) and (thread is not current_thread()):
+            thread.join(SHUTDOWN_TIMEOUT)
+
+    def _add(self, timer: ScheduledTimer) -> None:
+        with self._condition:
+            if self._stopped:
+                self._logger.debug(f"Scheduler is shut down, dropping timer for {timer._callback}")
+                return
+            if timer.cancelled or (None != timer.due):
+                return
+            timer.due = monotonic() + max(0, timer._delay)
+            heappush(self._queue, (timer.due, next(self._sequence), timer))
+            self._live += 1
+            if None == self._thread:
+                self._thread = Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            # wake up the thread only if the new timer is due before the one it waits for
+            if self._queue[0][2] is timer:
+                self._condition.notify()
+
+    def _cancel(self, timer: ScheduledTimer) -> bool:
+        with self._condition:
+            if timer.cancelled or timer.fired or (None == timer.due):
+                timer.cancelled = True
+                return False
+            timer.cancelled = True
+            self._live -= 1
+            if len(self._queue) > 2 * self._live + STALE_ENTRY_SLACK:
+                self._queue = [entry for entry in self._queue if not entry[2].cancelled]
+                heapify(self._queue)
+            return True
+
+    def _next(self):
+        """Waits for the next due timer and takes it off the queue, returns None on shutdown"""
+        with self._condition:
+            while not self._stopped:
+                while self._queue and self._queue[0][2].cancelled:
+                    heappop(self._queue)
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                wait = self._queue[0][0] - monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                _, _, timer = heappop(self._queue)
+                timer.fired = True
+                self._live -= 1
+                return timer
+            return None
+
+    def _run(self) -> None:
+        while True:
+            timer = self._next()
+            if None == timer:
+                return
+            self._lag.observe(monotonic() - timer.due)
+            try:
+                timer._fire()
+            except Exception:
+                self._logger.exception(f"Error in scheduled callback {timer._callback}")
+
+    pending = property(lambda self: self._live, None, None, "Number of timers which have not fired yet")
+
+    running = property(lambda self: (None != self._thread) and self._thread.is_alive(), None, None,
+                       "If the scheduler thread is running")
+
+
+_shared = None
+_sharedLock = Lock()
+
+
+def sharedScheduler() -> Scheduler:
+    """Scheduler used by clocks which have not been given one"""
+    global _shared
+    with _sharedLock:
+        if None == _shared:
+            _shared = Scheduler()
+        return _shared
@@ -0,0 +1,267 @@
+from math import exp
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import sleep
+
+from .clock import SystemClock
+from .gpiobackend import GpioBackend
+
+AMBIENT_TEMP = 25
+
+
+class FakeGPIO(GpioBackend):
+    """In-memory GPIO backend, a replacement for the RPi.GPIO module which records every output write"""
+
+    name = "mock"
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+
+    def __init__(self, latency: float = 0, clock = None) -> None:
+        self._latency = latency
+        self._clock = clock or SystemClock()
+        self._lock = Lock()
+        self.mode = None
+        self.pins = {}
+        self.writes = []
+
+    def setmode(self, mode) -> None:
+        self.mode = mode
+
+    def setup(self, pin, direction) -> None:
+        with self._lock:
+            self.pins.setdefault(pin, 0)
+
+    def input(self, pin) -> int:
+        with self._lock:
+            return self.pins.get(pin, 0)
+
+    def output(self, pin, state) -> None:
+        if self._latency:
+            sleep(self._latency)
+
+        pins = pin if isinstance(pin, (list, tuple)) else [pin]
+        states = state if isinstance(state, (list, tuple)) else [state] * len(pins)
+        with self._lock:
+            for p, s in zip(pins, states):
+                self.pins[p] = 1 if s else 0
+                self.writes.append((self._clock.monotonic(), p, bool(s)))
+
+    def cleanup(self, pin=None) -> None:
+        with self._lock:
+            if pin is None:
+                self.pins.clear()
+            else:
+                self.pins.pop(pin, None)
+
+    def isHigh(self, pin) -> bool:
+        return 1 == self.input(pin)
+
+
+class VirtualPrinter:
+    """
+    Scriptable printer with configurable connect delay, heating and cooling behaviour. The printer
+    only connects while its power pin on the given GPIO is high and has been for the boot delay.
+    Events are delivered asynchronously on a dispatcher thread, as OctoPrint's event manager does.
+    With a simulated clock events and temperature reports are delivered through its timers instead,
+    so everything runs on the thread driving the clock. Temperatures are only reported while the
+    optional reportWhile callable returns True, and again once a file or temperature is set
+    """
+
+    def __init__(self, gpio: FakeGPIO, powerPin: int,
+                 connectDelay: float = 0.5, disconnectDelay: float = 0.05, bootDelay: float = 0,
+                 toolHeatRate: float = 2.0, bedHeatRate: float = 0.5, coolingRate: float = 0.01,
+                 printDuration: float = 1.0, reportInterval: float = 0.1, printTemperature: float = None,
+                 onEvent=None, onTemperatures=None, clock=None, reportWhile=None) -> None:
+        self._gpio = gpio
+        self._clock = clock or SystemClock()
+        self._powerPin = powerPin
+        self.connectDelay = connectDelay
+        self.bootDelay = bootDelay
+        self.disconnectDelay = disconnectDelay
+        self.coolingRate = coolingRate
+        self.printDuration = printDuration
+        self.printDurations = {}
+        self.printTemperature = printTemperature
+        self.reportInterval = reportInterval
+        self.onEvent = onEvent
+        self.onTemperatures = onTemperatures
+        self.reportWhile = reportWhile
+
+        self._lock = Lock()
+        self._state = "Offline"
+        self._printing = None
+        self._heaters = {
+            "tool0": {"actual": AMBIENT_TEMP, "target": 0, "rate": toolHeatRate},
+            "bed": {"actual": AMBIENT_TEMP, "target": 0, "rate": bedHeatRate}
+        }
+        self._lastUpdate = self._clock.monotonic()
+        self._reporting = False
+        self.selectedFiles = []
+
+        self._closed = Event()
+        self._events = Queue()
+        if not self._clock.simulated:
+            Thread(target=self._dispatchEvents, daemon=True).start()
+            Thread(target=self._reportTemperatures, daemon=True).start()
+
+    # ~~ PrinterInterface subset
+
+    def connect(self, *args, **kwargs) -> None:
+        with self._lock:
+            self._setState("Connecting")
+        self._clock.timer(self.connectDelay, self._connected).start()
+
+    def disconnect(self, *args, **kwargs) -> None:
+        self._clock.timer(self.disconnectDelay, self._disconnected).start()
+
+    def is_operational(self) -> bool:
+        return self._state in ("Operational", "Printing")
+
+    def is_closed_or_error(self) -> bool:
+        return self._state in ("Offline", "Error")
+
+    def is_printing(self) -> bool:
+        return "Printing" == self._state
+
+    def is_pausing(self) -> bool:
+        return False
+
+    def is_paused(self) -> bool:
+        return False
+
+    def select_file(self, path, sd, printAfterSelect=False, *args, **kwargs) -> None:
+        self.selectedFiles.append((self._clock.monotonic(), path))
+        self._startReports()
+        if printAfterSelect:
+            with self._lock:
+                self._printing = path
+                self._setState("Printing")
+                if None != self.printTemperature:
+                    self._updateTemperatures()
+                    self._heaters["tool0"]["actual"] = self.printTemperature
+                    self._heaters["tool0"]["target"] = self.printTemperature
+            self._fire("PrintStarted", {"path": path, "origin": "local"})
+            duration = self.printDurations.get(path, self.printDuration)
+            self._clock.timer(duration, self._printDone, [path, duration]).start()
+
+    def set_temperature(self, heater, value, *args, **kwargs) -> None:
+        with self._lock:
+            self._updateTemperatures()
+            self._heaters[heater]["target"] = value
+        self._startReports()
+
+    def get_current_temperatures(self, *args, **kwargs) -> dict:
+        with self._lock:
+            self._updateTemperatures()
+            return {k: {"actual": h["actual"], "target": h["target"], "offset": 0}
+                    for k, h in self._heaters.items()}
+
+    # ~~ Simulation
+
+    def setTemperature(self, heater, actual) -> None:
+        """Forces the current temperature of a heater, e.g. a hot nozzle at the end of a print"""
+        with self._lock:
+            self._updateTemperatures()
+            self._heaters[heater]["actual"] = actual
+
+    def _connected(self) -> None:
+        with self._lock:
+            if "Connecting" != self._state:
+                return
+            self._setState("Operational" if self._isBooted() else "Error")
+        self._fire("Connected" if self.is_operational() else "Error", {})
+        self._startReports()
+
+    def _isBooted(self) -> bool:
+        """If the printer is powered for at least the boot delay"""
+        if not self._gpio.isHigh(self._powerPin):
+            return False
+        poweredOn = next((time for time, pin, state in reversed(self._gpio.writes)
+                          if (pin == self._powerPin) and state), None)
+        return (None == poweredOn) or (self._clock.monotonic() - poweredOn >= self.bootDelay)
+
+    def _disconnected(self) -> None:
+        with self._lock:
+            self._printing = None
+            self._setState("Offline")
+        self._fire("Disconnected", {})
+
+    def _printDone(self, path, duration) -> None:
+        with self._lock:
+            if self._printing != path:
+                return
+            self._printing = None
+            self._setState("Operational")
+            if None != self.printTemperature:
+                # the end code of the file turns off the heaters
+                self._updateTemperatures()
+                self._heaters["tool0"]["target"] = 0
+                self._heaters["bed"]["target"] = 0
+        self._fire("PrintDone", {"path": path, "origin": "local", "time": duration})
+
+    def _setState(self, state) -> None:
+        if state != self._state:
+            self._state = state
+            self._fire("PrinterStateChanged", {"state_id": state.upper()})
+
+    def _updateTemperatures(self) -> None:
+        now = self._clock.monotonic()
+        elapsed = now - self._lastUpdate
+        self._lastUpdate = now
+        powered = self._gpio.isHigh(self._powerPin)
+
+        for heater in self._heaters.values():
+            target = heater["target"] if powered else 0
+            if target > heater["actual"]:
+                heater["actual"] = min(target, heater["actual"] + heater["rate"] * elapsed)
+            elif target < heater["actual"]:
+                floor = max(target, AMBIENT_TEMP)
+                heater["actual"] = floor + (heater["actual"] - floor) * exp(-self.coolingRate * elapsed)
+
+    def close(self) -> None:
+        """Stops the dispatcher and temperature reporting threads"""
+        self._closed.set()
+        self._events.put(None)
+
+    def _reportTemperatures(self) -> None:
+        while not self._closed.wait(self.reportInterval):
+            self._reportTemperature()
+
+    def _startReports(self) -> None:
+        """Starts the chain of temperature reports on the simulated clock unless it is running"""
+        if (not self._clock.simulated) or self._reporting or (not self.is_operational()):
+            return
+        self._reporting = True
+        self._clock.timer(self.reportInterval, self._reportTemperature).start()
+
+    def _reportTemperature(self) -> None:
+        if (not self.is_operational()) or self._closed.is_set() \
+                or ((None != self.reportWhile) and (not self.reportWhile())):
+            self._reporting = False
+            return
+        if None != self.onTemperatures:
+            temps = self.get_current_temperatures()
+            self.onTemperatures({
+                "T0" if "tool0" == k else "B": (t["actual"], t["target"]) for k, t in temps.items()
+            })
+        if self._clock.simulated:
+            self._clock.timer(self.reportInterval, self._reportTemperature).start()
+
+    def _fire(self, event, payload) -> None:
+        if self._clock.simulated:
+            self._clock.timer(0, self._deliver, [event, payload]).start()
+        else:
+            self._events.put((event, payload))
+
+    def _deliver(self, event, payload) -> None:
+        if None != self.onEvent:
+            self.onEvent(event, payload)
+
+    def _dispatchEvents(self) -> None:
+        while True:
+            item = self._events.get()
+            if None == item:
+                return
+            self._deliver(*item)
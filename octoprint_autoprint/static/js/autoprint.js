@@ -7,6 +7,9 @@
 
 $(function () {
 
+    // entries of the folder and file index read per request
+    var INDEX_PAGE_SIZE = 100;
+
     function AutoprintViewModel(parameters) {
 
         /* 
@@ -16,18 +19,24 @@ $(function () {
         var self = this;
         self.settings = parameters[0];
         self.filesViewModel = parameters[1];
-        self.interval = undefined;
+        self.stateVersion = undefined;
         self.state = {
             printer: ko.observable(false),
             light: ko.observable(false),
             cooldown: ko.observable(false),
+            cooldownEta: ko.observable(undefined),
             connected: ko.observable(false),
             printInProgress: ko.observable(false)
         };
 
         self.list = {
             folder: ko.observableArray(),
-            file: ko.observableArray()
+            file: ko.observableArray(),
+            // entries of the index loaded so far and available in total
+            folderLoaded: ko.observable(0),
+            folderTotal: ko.observable(0),
+            fileLoaded: ko.observable(0),
+            fileTotal: ko.observable(0)
         };
         self.autoprint = {
             turnOffAfterPrint: ko.observable(false),
@@ -35,7 +44,10 @@ $(function () {
             startWithLights: ko.observable(false),
             time: ko.observable((new Date()).getTime()),
             file: ko.observable(),
-            folder: ko.observable('')
+            folder: ko.observable(''),
+            batch: ko.observableArray([]),
+            bedClear: ko.observable('timer'),
+            recurrence: ko.observable('')
         };
 
         self.setFolder = ko.computed({
@@ -57,16 +69,23 @@ $(function () {
 
         self.errormsgs = {
             time: ko.observable(undefined),
-            file: ko.observable(undefined)
-        }
-
-        self.scheduledJob = {
             file: ko.observable(undefined),
-            startTime: ko.observable(undefined),
-            turnOffAfterPrint: ko.observable(undefined),
-            startWithLights: ko.observable(undefined)
+            bedClear: ko.observable(undefined),
+            recurrence: ko.observable(undefined)
         }
 
+        self.relays = ko.observableArray([]);
+        // set if the GPIO backend is not available and the relays are not switched
+        self.gpioError = ko.observable(undefined);
+        self.relayRoles = ["printer", "light", "fan", "heater", "camera", "other"];
+
+        self.scheduledJobs = ko.observableArray([]);
+        self.activeJob = ko.observable(undefined);
+        self.failedJobs = ko.observableArray([]);
+        self.recurringJobs = ko.observableArray([]);
+        // results of the pre-flight checks by file path
+        self.preflightResults = ko.observable({});
+
         self.timeDisplay = ko.computed({
             read: function () {
                 var time = this.autoprint.time();
@@ -95,34 +114,66 @@ $(function () {
         };
 
         self.onTabChange = function (next, current) {
-            console.log(next, current);
             if ("#tab_plugin_autoprint" == next) {
-                self.interval = window.setInterval(self.updateState, 500);
-            } else if (undefined !== self.interval) {
-                window.clearInterval(self.interval);
-                self.interval = undefined;
+                self.updateState();
             }
         };
 
+        self.onDataUpdaterReconnect = function () {
+            self.updateState();
+        };
+
+        self.onDataUpdaterPluginMessage = function (plugin, message) {
+            if ("autoprint" != plugin) {
+                return;
+            }
+
+            if ("index" == message.type) {
+                self.updateFolderList();
+                self.updateFiles();
+                return;
+            }
+
+            if ("estimate" == message.type) {
+                new PNotify({
+                    title: gettext("Print job re-estimated"),
+                    text: _.sprintf(gettext("OctoPrint analysed %(file)s, the print job now starts at %(start)s"), {
+                        file: message.job.file,
+                        start: (new Date(message.job.startTime)).toLocaleString()
+                    }),
+                    type: "info"
+                });
+                return;
+            }
+
+            if ("state" != message.type) {
+                return;
+            }
+
+            if (undefined === self.stateVersion || message.version <= self.stateVersion) {
+                return;
+            }
+
+            if (message.version != self.stateVersion + 1) {
+                // missed a delta - resync the full state
+                self.updateState();
+                return;
+            }
+
+            self.applyState(message.delta);
+            self.stateVersion = message.version;
+        };
+
         self.onBeforeBinding = function () {
             ko.computed(self.updateFiles);
+            self.powerOnSequenceText = self.sequenceText(self.settings.settings.plugins.autoprint.relays.powerOnSequence);
+            self.powerOffSequenceText = self.sequenceText(self.settings.settings.plugins.autoprint.relays.powerOffSequence);
             self.autoprint.turnOffAfterPrint(self.settings.settings.plugins.autoprint.defaults.turnOffAfterPrint());
+            self.autoprint.bedClear(self.settings.settings.plugins.autoprint.batch.bedClear());
             console.log(self.settings.settings.plugins.autoprint.defaults.turnOffAfterPrint());
             self.updateState();
         };
 
-        self.onEventFolderAdded = function () {
-            self.updateFolderList();
-        }
-
-        self.onEventFolderRemoved = function () {
-            self.updateFolderList();
-        }
-
-        self.onEventFolderMoved = function () {
-            self.updateFolderList();
-        }
-
         self.filesViewModel.selectFileFromBrowser = function(/* String */ path)
         {
             var tokens = path.split("/");
@@ -133,6 +184,10 @@ $(function () {
             if( def = self.updateFiles())
             {
                 def.done(function() {
+                    // the file might not be on the first page of the folder
+                    if (!_.contains(self.list.file(), filename)) {
+                        self.list.file.push(filename);
+                    }
                     self.autoprint.file(filename);
                 });
             }
@@ -145,29 +200,37 @@ $(function () {
         */
 
         self.startUpPrinter = function () {
-            OctoPrint.simpleApiCommand("autoprint", "startUpPrinter", {}).then(function () {
-                self.updateState();
-            });
+            OctoPrint.simpleApiCommand("autoprint", "startUpPrinter", {});
         };
 
         self.shutDownPrinter = function () {
-            OctoPrint.simpleApiCommand("autoprint", "shutDownPrinter", {}).then(function () {
-                self.updateState();
-            });
+            OctoPrint.simpleApiCommand("autoprint", "shutDownPrinter", {});
         };
 
         self.cancelShutDown = function () {
-            OctoPrint.simpleApiCommand("autoprint", "cancelShutDown", {}).then(function () {
-                self.updateState();
-            });
+            OctoPrint.simpleApiCommand("autoprint", "cancelShutDown", {});
         }
 
         self.toggleLight = function () {
-            OctoPrint.simpleApiCommand("autoprint", "toggleLight", {}).then(function () {
-                self.updateState();
+            OctoPrint.simpleApiCommand("autoprint", "toggleLight", {});
+        }
+
+        self.switchRelay = function (relay) {
+            OctoPrint.simpleApiCommand("autoprint", "switchRelay", { name: relay.name, state: !relay.on });
+        }
+
+        self.addRelay = function () {
+            self.settings.settings.plugins.autoprint.relays.additional.push({
+                name: ko.observable(""),
+                pin: ko.observable(),
+                role: ko.observable("other")
             });
         }
 
+        self.removeRelay = function (relay) {
+            self.settings.settings.plugins.autoprint.relays.additional.remove(relay);
+        }
+
         self.scheduleJob = function () {
             job = {
                 file: self.autoprint.file() || "",
@@ -175,7 +238,12 @@ $(function () {
                 time: self.autoprint.time(),
                 turnOffAfterPrint: self.autoprint.turnOffAfterPrint(),
                 startFinish: self.autoprint.startFinish(),
-                startWithLights: self.autoprint.startWithLights()
+                startWithLights: self.autoprint.startWithLights(),
+                batch: self.autoprint.batch(),
+                bedClear: { mode: self.autoprint.bedClear() }
+            }
+            if (('asap' != job.startFinish) && self.autoprint.recurrence()) {
+                job.recurrence = self.autoprint.recurrence();
             }
 
             OctoPrint.simpleApiCommand("autoprint", "scheduleJob", job).then(
@@ -183,9 +251,33 @@ $(function () {
                 self.handlePrintJobError);
         }
 
-        self.cancelJob = function () {
-            OctoPrint.simpleApiCommand("autoprint", "cancelJob").then(
-                self.handlePrintJobSuccess
+        self.cancelRecurrence = function (series) {
+            OctoPrint.simpleApiCommand("autoprint", "cancelRecurrence", { id: series.id });
+        }
+
+        self.bedCleared = function () {
+            OctoPrint.simpleApiCommand("autoprint", "bedCleared", {});
+        }
+
+        self.preflightStatus = function (job) {
+            var results = self.preflightResults();
+            var checked = [job.file].concat(job.batch).map(function (path) { return results[path]; });
+            if (checked.some(function (result) { return undefined === result; })) {
+                return { css: "muted", text: "checking" };
+            }
+            var problems = [];
+            checked.forEach(function (result) {
+                problems = problems.concat(result.errors);
+            });
+            if (problems.length > 0) {
+                return { css: "text-error", text: problems.join("; ") };
+            }
+            return { css: "text-success", text: "ok" };
+        }
+
+        self.cancelJob = function (job) {
+            OctoPrint.simpleApiCommand("autoprint", "cancelJob", { id: job.id }).then(
+                self.handleJobListUpdate
             );
         }
 
@@ -196,85 +288,140 @@ $(function () {
 
         self.updateState = function () {
             OctoPrint.simpleApiGet("autoprint").then(function (printer_state) {
-                self.state.printer(printer_state.state.printer);
-                self.state.light(printer_state.state.light);
-                self.state.cooldown(printer_state.state.cooldown);
-                self.state.connected(printer_state.state.connected);
-                self.state.printInProgress(printer_state.state.printInProgress);
-
-                if (undefined !== printer_state.scheduledJob) {
-                    self.updateScheduledJob(printer_state.scheduledJob);
+                if (undefined !== self.stateVersion && printer_state.version < self.stateVersion) {
+                    return;
                 }
+                self.applyState(printer_state);
+                self.stateVersion = printer_state.version;
             });
         }
 
-        self.updateScheduledJob = function (jobdata) {
-            if (undefined !== jobdata) {
-                self.scheduledJob.file(jobdata.file);
-                self.scheduledJob.startTime(jobdata.startTime);
-                self.scheduledJob.turnOffAfterPrint(jobdata.turnOffAfter);   
-                self.scheduledJob.startWithLights(jobdata.startWithLights);   
-            } else {
-                self.scheduledJob.file(undefined)
+        self.applyState = function (printer_state) {
+            if (undefined !== printer_state.state) {
+                _.each(printer_state.state, function (value, key) {
+                    if (undefined !== self.state[key]) {
+                        self.state[key](value);
+                    }
+                });
+            }
+
+            if (undefined !== printer_state.relays) {
+                self.relays(printer_state.relays || []);
+            }
+            if (undefined !== printer_state.gpioError) {
+                if (printer_state.gpioError && (printer_state.gpioError !== self.gpioError())) {
+                    new PNotify({
+                        title: gettext("Relays are not switched"),
+                        text: printer_state.gpioError,
+                        type: "error",
+                        hide: false
+                    });
+                }
+                self.gpioError(printer_state.gpioError || undefined);
+            }
+            if (undefined !== printer_state.scheduledJobs) {
+                self.updateScheduledJobs(printer_state.scheduledJobs);
+            }
+            if (undefined !== printer_state.activeJob) {
+                self.activeJob(printer_state.activeJob || undefined);
+            }
+            if (undefined !== printer_state.failedJobs) {
+                self.failedJobs(printer_state.failedJobs || []);
+            }
+            if (undefined !== printer_state.recurringJobs) {
+                self.recurringJobs(printer_state.recurringJobs || []);
+            }
+            if (undefined !== printer_state.preflightResults) {
+                self.preflightResults(printer_state.preflightResults || {});
             }
         }
 
-        self.updateFolderList = function () {
-            var result = [];
-
-            var readFolder = function (folder) {
-                _.each(_.filter(folder, function (entry) {
-                    return entry.type == "folder";
-                }), function (folder) {
-                    result.push("/" + folder.path);
-                    if (folder.children.length > 0) {
-                        readFolder(folder.children.sort(sortFileList));
+        self.updateScheduledJobs = function (jobs) {
+            self.scheduledJobs(jobs || []);
+        }
+
+        self.sequenceText = function (sequence) {
+            // edits a relay sequence setting as JSON, keeping the last valid one on errors
+            var error = ko.observable(undefined);
+            var text = ko.computed({
+                read: function () {
+                    return JSON.stringify(ko.mapping.toJS(sequence), null, 1);
+                },
+                write: function (value) {
+                    try {
+                        var steps = JSON.parse(value);
+                        if (!_.isArray(steps)) {
+                            throw new Error("a sequence must be a list of steps");
+                        }
+                        sequence(steps);
+                        error(undefined);
+                    } catch (e) {
+                        error(e.message);
                     }
+                }
+            });
+            text.error = error;
+            return text;
+        }
+
+        self.queryIndex = function (params, offset) {
+            // reads one page of the plugin's folder/file index, further pages are loaded on demand
+            var query = $.param(_.extend({ offset: offset || 0, limit: INDEX_PAGE_SIZE }, params));
+            return OctoPrint.get(OctoPrint.getSimpleApiUrl("autoprint") + "?" + query);
+        }
+
+        self.loadFolders = function (offset) {
+            return self.queryIndex({ index: "folders" }, offset).done(function (response) {
+                var folders = _.map(response.items, function (folder) {
+                    return "/" + folder;
                 });
-            };
+                if (offset) {
+                    self.list.folder.push.apply(self.list.folder, folders);
+                } else {
+                    self.list.folder(folders);
+                }
+                self.list.folderLoaded((offset || 0) + response.items.length);
+                self.list.folderTotal(response.total);
+            });
+        }
 
-            var sortFileList = function (a, b) {
-                return (a.name > b.name) ? 1 : ((a.name < b.name) ? -1 : 0);
-            }
+        self.updateFolderList = function () {
+            return self.loadFolders(0);
+        }
 
-            OctoPrint.files.list(true).done(function (response) {
-                readFolder(response.files.sort(sortFileList));
-                result.unshift("/");
-                self.list.folder(result);
-            })
+        self.moreFolders = function () {
+            self.loadFolders(self.list.folderLoaded());
         }
 
-        self.updateFiles = function () {
+        self.loadFiles = function (offset) {
             var folder = self.autoprint.folder();
-            var result = [];
 
             if (undefined !== folder) {
-                var path = [ 'local' ];
-                if (folder) {
-                    path.push(folder)
-                }
-
-                return OctoPrint.files.listForLocation(path.join('/'), false).done(function (response) {
-                    _.each(response.children, function (file) {
-                        if (file.type == "machinecode") {
-                            result.push(file.name);
-                        }
-                    })
-                    _.each(response.files, function(file) {
-                        if (file.type == "machinecode") {
-                            result.push(file.name);
-                        }
-                    })
-
-                    self.list.file(result);
+                return self.queryIndex({ index: "files", folder: folder || "" }, offset).done(function (response) {
+                    var files = _.pluck(response.items, "name");
+                    if (offset) {
+                        self.list.file.push.apply(self.list.file, _.difference(files, self.list.file()));
+                    } else {
+                        self.list.file(files);
+                    }
+                    self.list.fileLoaded((offset || 0) + response.items.length);
+                    self.list.fileTotal(response.total);
                 });
             }
             else
             {
                 return null;
             }
+        }
+
+        self.updateFiles = function () {
+            return self.loadFiles(0);
         };
 
+        self.moreFiles = function () {
+            self.loadFiles(self.list.fileLoaded());
+        }
+
         /*
         * Response Hanlders ************************************************************* 
         */
@@ -282,6 +429,8 @@ $(function () {
         self.clearErrorMessages = function () {
             self.errormsgs.time(undefined);
             self.errormsgs.file(undefined);
+            self.errormsgs.bedClear(undefined);
+            self.errormsgs.recurrence(undefined);
 
         }
 
@@ -294,7 +443,10 @@ $(function () {
 
         self.handlePrintJobSuccess = function (data) {
             self.clearErrorMessages();
-            self.updateScheduledJob(data);
+        }
+
+        self.handleJobListUpdate = function (data) {
+            self.updateScheduledJobs(data.jobs);
         }
 
 
@@ -0,0 +1,50 @@
+import json
+import os
+from logging import Logger
+
+
+def replaceFile(path: str, lines: list) -> None:
+    """
+    Replaces the file with the given lines. They are written to a temporary file first, which is synced
+    to disk and renamed over the file, so a crash leaves either the old or the new content
+    """
+    temp = path + ".tmp"
+    with open(temp, "w", encoding="utf-8") as file:
+        for line in lines:
+            file.write(line)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+    directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class JsonFile:
+    """
+    JSON file the learned state of a history is kept in across restarts. Without a path nothing is
+    loaded or saved
+    """
+
+    def __init__(self, logger: Logger, path: str, description: str) -> None:
+        self._logger = logger
+        self._path = path
+        self._description = description
+
+    def load(self, apply) -> None:
+        """Passes the content of the file to apply, an unreadable file is ignored with a warning"""
+        if (None == self._path) or (not os.path.exists(self._path)):
+            return
+        try:
+            with open(self._path, "r", encoding="utf-8") as file:
+                apply(json.load(file))
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            self._logger.warn(f"Ignoring unreadable {self._description} {self._path}: {e}")
+
+    def save(self, data) -> None:
+        if (None == self._path):
+            return
+        replaceFile(self._path, [json.dumps(data)])
@@ -0,0 +1,58 @@
+from collections import deque
+from logging import Logger
+from math import ceil
+from threading import Lock
+
+from .storage import JsonFile
+
+# number of recent warm-up times the learned wait is based on
+WARMUP_SAMPLES = 20
+# percentile of the recorded warm-up times the learned wait is not lowered below
+WARMUP_PERCENTILE = 95
+# factor applied to the wait after a startup whose first connection attempt succeeded
+PROBE_FACTOR = 0.8
+
+
+class WarmupHistory:
+    """
+    Learns how long to wait after turning on the printer before connecting to it. A startup which
+    needed repeated connection attempts tells the actual warm-up time of the printer and raises the
+    wait to the 95th percentile of those times. A startup whose first attempt succeeded only tells
+    that the printer was ready earlier, so the wait is lowered a bit to probe for a shorter one,
+    but not below that percentile
+    """
+
+    def __init__(self, logger: Logger, path: str = None, size: int = WARMUP_SAMPLES) -> None:
+        self._logger = logger
+        self._file = JsonFile(logger, path, "warm-up history")
+        self._lock = Lock()
+        self._samples = deque(maxlen=size)
+        self._wait = None
+        self._file.load(self._apply)
+
+    def record(self, warmup: float, retried: bool) -> None:
+        """Records the seconds from power on to the successful connection attempt of a startup"""
+        with self._lock:
+            if retried:
+                self._samples.append(round(warmup, 3))
+                self._wait = self._percentile(WARMUP_PERCENTILE)
+            else:
+                self._wait = max(self._percentile(WARMUP_PERCENTILE) or 0, round(warmup * PROBE_FACTOR, 3))
+            self._save()
+
+    def _percentile(self, p: float):
+        """p-th percentile (nearest rank) of the recorded warm-up times, None if there are none"""
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[max(0, ceil(p / 100 * len(samples)) - 1)]
+
+    def _apply(self, history: dict) -> None:
+        self._samples.extend(float(s) for s in history.get("samples", []))
+        self._wait = None if history.get("wait") is None else float(history["wait"])
+
+    def _save(self) -> None:
+        self._file.save({"wait": self._wait, "samples": list(self._samples)})
+
+    wait = property(lambda self: self._wait, None, None,
+                    "Learned seconds to wait before connecting, None if no startup has been recorded yet")
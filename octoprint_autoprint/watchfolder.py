@@ -0,0 +1,219 @@
+import re
+from datetime import datetime, timedelta
+from logging import Logger
+from threading import Lock
+
+from octoprint.filemanager import FileManager
+from .clock import SystemClock
+from .events import EventLog
+
+STORAGE = "local"
+# seconds without a further upload before the collected files are ingested, and the longest wait
+# for a burst of uploads to end
+DEBOUNCE = 3
+MAX_WAIT = 30
+# lines of a file searched for the directive comment
+HEADER_LINES = 50
+
+# ";autoprint: finish=07:30 off=yes" in the header, "part[finish=0730,off].gcode" in the file name
+HEADER_DIRECTIVES = re.compile(rb"^;\s*autoprint:\s*(.*)$", re.IGNORECASE)
+NAME_DIRECTIVES = re.compile(r"\[([^\]]*)\][^/\[]*$")
+TIME_OF_DAY = re.compile(r"^(\d{1,2})[:.\-h]?(\d{2})$")
+SWITCHES = {"yes": True, "on": True, "true": True, "1": True, "no": False, "off": False, "false": False, "0": False}
+
+
+class InvalidDirective(Exception):
+
+    def __init__(self, path, reason):
+        self.path = path
+        self.message = f"Invalid autoprint directive of {path}: {reason}"
+        super().__init__(self.message)
+
+
+class WatchFolder:
+    """
+    Schedules G-code files uploaded into a watch folder by the directives in their header or name. The
+    FileAdded events of a burst of uploads are collected until no further file arrived for the debounce
+    time (or at most MAX_WAIT seconds) and then handed to the ingest callback in one pass, as a list of
+    (path, directives) pairs, so the jobs of all files can be scheduled together. Reading the files and
+    the ingest run through the given execute callable (e.g. on a pool of workers), as the debounce
+    timer fires on the thread shared by all timers of the plugin.
+
+    Directives are "key=value" words separated by spaces or commas, in a ";autoprint:" comment within the
+    first lines of the file or in square brackets in its name:
+
+    - start=<time> or finish=<time>, or asap: when to print, the time as HH:MM (the next time of that
+      time of day) or as date and time YYYY-MM-DDTHH:MM
+    - off=yes|no: turn the printer off after the print
+    - lights=yes|no: turn the light on with the printer
+    - batch=<name>: files of the same batch uploaded together are printed back to back
+    - bedclear=timer|ack|temperature: the bed clear condition of the batch
+
+    Files without a start, finish or asap directive are not scheduled.
+    """
+
+    def __init__(self, logger: Logger, fileManager: FileManager, ingest, clock = None,
+                 events: EventLog = None, execute = None) -> None:
+        self._logger = logger
+        self._fileManager = fileManager
+        self._ingest = ingest
+        self._execute = execute or (lambda callback, *args: callback(*args))
+        self._clock = clock or SystemClock()
+        self._events = events or EventLog(logger)
+        self._lock = Lock()
+        self._folder = None
+        self._debounce = DEBOUNCE
+        self._pending = {}
+        self._timer = None
+        self._firstAt = None
+
+    def processEvent(self, event: str, payload: dict) -> bool:
+        """Collects a file uploaded into the watch folder, returns True if it will be ingested"""
+        if ("FileAdded" != event) or (None == self._folder) or (STORAGE != payload.get("storage")):
+            return False
+        path = payload.get("path", "")
+        if ("gcode" not in (payload.get("type") or [])) or not self._isWatched(path):
+            return False
+
+        with self._lock:
+            self._pending[path] = True
+            now = self._clock.monotonic()
+            if None == self._firstAt:
+                self._firstAt = now
+            # wait for the burst to end, but not longer than MAX_WAIT after its first file
+            delay = min(self._debounce, max(0, self._firstAt + MAX_WAIT - now))
+            if None != self._timer:
+                self._timer.cancel()
+            self._timer = self._clock.timer(delay, self._flush)
+            self._timer.start()
+        return True
+
+    def _isWatched(self, path: str) -> bool:
+        return ("" == self._folder) or path.startswith(self._folder + "/")
+
+    def _flush(self) -> None:
+        with self._lock:
+            paths = list(self._pending)
+            self._pending = {}
+            self._timer = None
+            self._firstAt = None
+
+        if paths:
+            self._execute(self._ingestFiles, paths)
+
+    def _ingestFiles(self, paths: list) -> None:
+        entries = []
+        for path in paths:
+            try:
+                directives = self.directivesOf(path)
+            except InvalidDirective as e:
+                self._logger.warn(e.message)
+                self._events.record("ingestError", file=path, error=e.message)
+                continue
+            if None == directives:
+                self._logger.debug(f"{path} has no autoprint directives, it is not scheduled")
+                continue
+            entries.append((path, directives))
+
+        self._logger.info(f"Ingesting {len(entries)} of {len(paths)} files uploaded into the watch folder")
+        self._events.record("ingest", files=len(paths), scheduled=len(entries))
+        if entries:
+            self._ingest(entries)
+
+    def directivesOf(self, path: str):
+        """
+        Returns the directives of a file as dict with startFinish, time, and optionally
+        turnOffAfterPrint, startWithLights, batch and bedClear, or None if it has none. Directives in the
+        header take precedence over the ones in the name
+        """
+        words = []
+        match = NAME_DIRECTIVES.search(path)
+        if match:
+            words.extend(_words(match.group(1)))
+        words.extend(_words(self._headerDirectives(path)))
+        if not words:
+            return None
+        return parseDirectives(path, words, self._clock.now())
+
+    def _headerDirectives(self, path: str) -> str:
+        try:
+            with open(self._fileManager.path_on_disk(STORAGE, path), "rb") as gcode:
+                for number, line in enumerate(gcode):
+                    if number >= HEADER_LINES:
+                        break
+                    match = HEADER_DIRECTIVES.match(line.strip())
+                    if match:
+                        return match.group(1).decode("utf-8", "replace")
+        except OSError as e:
+            self._logger.warn(f"Could not read the header of {path}: {e}")
+        return ""
+
+    # ~~ Properties
+
+    def _setFolder(self, folder):
+        """Sets the watched folder, None turns watching off and "" watches all files"""
+        self._folder = None if (None == folder) else folder.strip("/")
+
+    folder = property(lambda self: self._folder, _setFolder, None,
+                      "Folder whose uploads are scheduled, None if no folder is watched")
+
+    def _setDebounce(self, debounce):
+        if ((type(debounce) == int) or (type(debounce) == str and debounce.isnumeric())) and (int(debounce) >= 0):
+            self._debounce = int(debounce)
+        else:
+            self._logger.warn(f"Could not assign '{debounce}' as debounce time: Not a valid number >= 0")
+
+    debounce = property(lambda self: self._debounce, _setDebounce, None,
+                        "Seconds without a further upload before the uploaded files are scheduled")
+
+    pending = property(lambda self: len(self._pending), None, None, "Number of files waiting to be ingested")
+
+
+def parseDirectives(path: str, words: list, now: datetime) -> dict:
+    """Parses directive words, later ones overriding earlier ones"""
+    directives = {}
+    for word in words:
+        key, _, value = word.partition("=")
+        key = key.lower()
+        if key in ("start", "finish"):
+            directives["startFinish"] = key
+            directives["time"] = _parseTime(path, value, now)
+        elif "asap" == key:
+            directives["startFinish"] = "asap"
+            directives["time"] = now
+        elif key in ("off", "lights"):
+            switch = SWITCHES.get(value.lower() if value else "yes")
+            if None == switch:
+                raise InvalidDirective(path, f"{key} must be yes or no")
+            directives["turnOffAfterPrint" if "off" == key else "startWithLights"] = switch
+        elif "batch" == key:
+            directives["batch"] = value
+        elif "bedclear" == key:
+            directives["bedClear"] = value
+        else:
+            raise InvalidDirective(path, f"unknown directive {key}")
+
+    if "startFinish" not in directives:
+        return None
+    return directives
+
+
+def _words(text: str) -> list:
+    return [word for word in re.split(r"[\s,]+", text.strip()) if word]
+
+
+def _parseTime(path: str, value: str, now: datetime) -> datetime:
+    match = TIME_OF_DAY.match(value)
+    if match:
+        hour, minute = int(match.group(1)), int(match.group(2))
+        if (hour > 23) or (minute > 59):
+            raise InvalidDirective(path, f"{value} is not a valid time of day")
+        time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return time if time > now else time + timedelta(days=1)
+
+    for pattern in ("%Y-%m-%dT%H:%M", "%Y%m%dT%H%M", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(value, pattern)
+        except ValueError:
+            continue
+    raise InvalidDirective(path, f"{value} is neither a time of day (HH:MM) nor a date and time (YYYY-MM-DDTHH:MM)")
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Benchmarks the timing critical paths of the plugin against a fake GPIO and a virtual printer.
+Run from the plugin directory inside the OctoPrint development environment:
+
+    python tests/benchmark.py --runs 5 --output bench.jsonl
+
+Each run prints one JSON document (and appends it to --output) tagged with the current commit, so
+numbers of different commits can be compared.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+from statistics import median
+from time import monotonic, perf_counter, process_time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from octoprint_autoprint.autoprinter import AutoPrinterTimer
+from octoprint_autoprint.gpiobackend import BACKENDS, createGpio
+from octoprint_autoprint.printercontrol import PrinterControl
+from octoprint_autoprint.printjob import PrintJob
+from octoprint_autoprint.simulation import FakeGPIO, VirtualPrinter
+
+PRINTER_PIN = 17
+LIGHT_PIN = 18
+COOLDOWN_TEMP = 60
+TIMEOUT = 30
+
+
+class Harness:
+    """Wires PrinterControl and AutoPrinterTimer to the simulation like the plugin does"""
+
+    def __init__(self, args) -> None:
+        self.logger = logging.getLogger("benchmark")
+        self.gpio = FakeGPIO(latency=args.gpio_latency)
+        self.printer = VirtualPrinter(self.gpio, PRINTER_PIN,
+                                      connectDelay=args.connect_delay,
+                                      disconnectDelay=args.disconnect_delay,
+                                      coolingRate=args.cooling_rate,
+                                      printDuration=args.print_duration,
+                                      onEvent=self.onEvent,
+                                      onTemperatures=self.onTemperatures)
+        self.control = PrinterControl(self.logger, self.printer, gpio=self.gpio)
+        self.control.printerGpio = PRINTER_PIN
+        self.control.lightGpio = LIGHT_PIN
+        self.control.startupTime = args.startup_time
+        self.control.cooldownTemp = COOLDOWN_TEMP
+        self.timer = AutoPrinterTimer(self.logger, self.printer, self.control)
+
+    def onEvent(self, event, payload):
+        if event in ("Connected", "PrinterStateChanged"):
+            self.timer.onPrinterStateChanged()
+        if event in ("Disconnected", "PrinterStateChanged", "Error"):
+            self.control.onPrinterStateChanged()
+        if event in ("PrintDone", "PrintFailed") and (None != self.timer.activeJob):
+            self.timer.processPrintJobEnd(payload)
+
+    def onTemperatures(self, temperatures):
+        self.control.processTemperatures(temperatures)
+
+
+class ThreadSampler(threading.Thread):
+
+    def __init__(self) -> None:
+        super().__init__(daemon=True)
+        self.peak = threading.active_count()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(0.005):
+            self.peak = max(self.peak, threading.active_count())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.peak
+
+
+def waitFor(condition):
+    started = monotonic()
+    while not condition():
+        if monotonic() - started > TIMEOUT:
+            raise TimeoutError("Simulation did not reach the expected state")
+        sleep(0.001)
+    return monotonic()
+
+
+def measure(scenario):
+    """Runs a scenario and returns its latency, CPU time and thread counts"""
+    threadsBefore = threading.active_count()
+    sampler = ThreadSampler()
+    sampler.start()
+    cpu = process_time()
+
+    latency = scenario()
+
+    cpu = process_time() - cpu
+    return {
+        "latency": latency,
+        "cpu": cpu,
+        "threadsBefore": threadsBefore,
+        "threadsPeak": sampler.stop(),
+        "threadsAfter": threading.active_count()
+    }
+
+
+def benchStartUpPrinter(args):
+    h = Harness(args)
+
+    def scenario():
+        started = monotonic()
+        h.control.startUpPrinter(lambda: None)
+        return waitFor(h.printer.is_operational) - started
+
+    try:
+        return measure(scenario)
+    finally:
+        h.printer.close()
+
+
+def benchStartPrintJob(args):
+    h = Harness(args)
+
+    def scenario():
+        job = PrintJob("benchmark.gcode", None, False, "asap", False, h.logger, None)
+        started = monotonic()
+        h.timer.scheduleJob(job)
+        waitFor(lambda: len(h.printer.selectedFiles) > 0)
+        return h.printer.selectedFiles[0][0] - started
+
+    try:
+        return measure(scenario)
+    finally:
+        h.printer.close()
+
+
+def benchShutDownPrinter(args):
+    h = Harness(args)
+    h.control.startUpPrinter(lambda: None)
+    waitFor(h.printer.is_operational)
+    h.printer.setTemperature("tool0", COOLDOWN_TEMP + args.overheat)
+
+    def scenario():
+        started = monotonic()
+        h.control.shutDownPrinter()
+        return waitFor(lambda: not h.gpio.isHigh(PRINTER_PIN)) - started
+
+    try:
+        result = measure(scenario)
+    finally:
+        h.printer.close()
+    result["disconnectToPowerOff"] = h.control.lastShutdown["latency"]
+    return result
+
+
+def benchGpio(args):
+    """Measures loading the GPIO backend and switching a pin with it"""
+    if ("mock" != args.gpio_backend) and (None == args.gpio_pin):
+        raise SystemExit("--gpio-pin is required for a real GPIO backend, it is switched on and off")
+
+    started = perf_counter()
+    gpio = createGpio(args.gpio_backend, args.gpio_chip, socket=args.gpio_socket)
+    startup = perf_counter() - started
+    pin = LIGHT_PIN if (None == args.gpio_pin) else args.gpio_pin
+
+    gpio.setup(pin, gpio.IN)
+    state = 1 == gpio.input(pin)
+    gpio.setup(pin, gpio.OUT)
+    gpio.output(pin, state)
+
+    latencies = []
+    try:
+        for _ in range(args.switches):
+            state = not state
+            started = perf_counter()
+            gpio.output(pin, state)
+            latencies.append(perf_counter() - started)
+    finally:
+        gpio.cleanup(pin)
+
+    return {
+        "startup": startup,
+        "switchMedian": median(latencies),
+        "switchMax": max(latencies)
+    }
+
+
+BENCHMARKS = {
+    "startUpPrinter": benchStartUpPrinter,
+    "startPrintJob": benchStartPrintJob,
+    "shutDownPrinter": benchShutDownPrinter,
+    "gpio": benchGpio
+}
+
+
+def summarize(runs):
+    return {key: median(run[key] for run in runs) for key in runs[0]}
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(__file__), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--only", choices=list(BENCHMARKS), action="append")
+    parser.add_argument("--output", help="file the result is appended to as one JSON line")
+    parser.add_argument("--startup-time", type=int, default=1)
+    parser.add_argument("--connect-delay", type=float, default=0.2)
+    parser.add_argument("--disconnect-delay", type=float, default=0.05)
+    parser.add_argument("--cooling-rate", type=float, default=0.5)
+    parser.add_argument("--overheat", type=float, default=5, help="degrees above the cooldown temperature")
+    parser.add_argument("--print-duration", type=float, default=0.5)
+    parser.add_argument("--gpio-latency", type=float, default=0)
+    parser.add_argument("--gpio-backend", choices=BACKENDS, default="mock", help="backend of the gpio benchmark")
+    parser.add_argument("--gpio-chip", default="/dev/gpiochip0")
+    parser.add_argument("--gpio-socket", help="socket of the GPIO daemon for the daemon backend")
+    parser.add_argument("--gpio-pin", type=int, help="pin toggled by the gpio benchmark on a real backend")
+    parser.add_argument("--switches", type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    result = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "runs": args.runs,
+        "gpioBackend": args.gpio_backend,
+        "results": {}
+    }
+    for name in args.only or BENCHMARKS:
+        result["results"][name] = summarize([BENCHMARKS[name](args) for _ in range(args.runs)])
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import logging
+from datetime import datetime
+
+import pytest
+
+from octoprint_autoprint.autoprinter import AutoPrinterTimer
+from octoprint_autoprint.clock import SimulatedClock
+from octoprint_autoprint.journal import JobJournal
+from octoprint_autoprint.printjob import PrintJobTooEarly
+from octoprint_autoprint.recurrence import (MAX_SKIPPED, CronRule, InvalidRecurrence, RecurringJob,
+                                            RecurringSchedule, RRule, parseRule)
+
+LOGGER = logging.getLogger(__name__)
+TEMPLATE = {"path": "part.gcode", "startFinish": "start"}
+
+
+class Job:
+
+    def __init__(self, id, time):
+        self.id = id
+        self.startTime = self.endTime = time
+
+
+class AnalysedJob(Job):
+    """Occurrence estimated provisionally until OctoPrint analysed its file"""
+
+    fileToPrint = "part.gcode"
+    secondsToStart = 3600
+    estimateAccuracy = "analysis"
+
+    def __init__(self, id, time):
+        super().__init__(id, time)
+        self.pendingAnalysis = [self.fileToPrint]
+
+    def analysisFinished(self, path):
+        self.pendingAnalysis = []
+        return True
+
+    def __dict__(self):
+        return {"id": self.id, "file": self.fileToPrint}
+
+
+class Timer:
+    """Stands in for the AutoPrinterTimer, keeping the scheduled jobs by id"""
+
+    def __init__(self):
+        self.jobs = {}
+
+    def scheduleJob(self, job, persist=True):
+        self.jobs[job.id] = job
+
+    def cancelJob(self, jobId):
+        return self.jobs.pop(jobId, None)
+
+    def getJob(self, jobId):
+        return self.jobs.get(jobId)
+
+
+def createJob(template, time):
+    return Job(f"job-{time:%Y%m%d%H%M}", time)
+
+
+def schedule(now, journal=None, create=createJob):
+    timer = Timer()
+    return RecurringSchedule(LOGGER, timer, create, journal, SimulatedClock(now)), timer
+
+
+def occurrences(rule, after, number):
+    times = []
+    for _ in range(number):
+        after = rule.next(after)
+        times.append(after)
+    return times
+
+
+def test_cron_weekdays():
+    rule = CronRule("0 6 * * 1-5")
+    assert occurrences(rule, datetime(2026, 10, 16, 7, 0), 3) == [
+        datetime(2026, 10, 19, 6, 0), datetime(2026, 10, 20, 6, 0), datetime(2026, 10, 21, 6, 0)]
+
+
+def test_cron_starts_at_the_start_time():
+    rule = parseRule("0 6 * * *", datetime(2026, 11, 1, 12, 0))
+    assert rule.next(datetime(2026, 10, 18, 7, 0)) == datetime(2026, 11, 2, 6, 0)
+
+
+def test_cron_day_of_month_or_weekday():
+    rule = CronRule("0 6 13 * FRI")
+    assert occurrences(rule, datetime(2026, 11, 11), 3) == [
+        datetime(2026, 11, 13, 6, 0), datetime(2026, 11, 20, 6, 0), datetime(2026, 11, 27, 6, 0)]
+
+
+def test_rrule_skips_months_without_the_day():
+    rule = RRule("FREQ=MONTHLY;BYMONTHDAY=31;BYHOUR=6;BYMINUTE=0", datetime(2026, 1, 1))
+    assert occurrences(rule, datetime(2026, 1, 1), 3) == [
+        datetime(2026, 1, 31, 6, 0), datetime(2026, 3, 31, 6, 0), datetime(2026, 5, 31, 6, 0)]
+
+
+def test_rrule_until_and_interval():
+    rule = RRule("FREQ=WEEKLY;INTERVAL=2;BYDAY=MO;UNTIL=20261110", datetime(2026, 10, 19, 6, 0))
+    assert rule.next(datetime(2026, 10, 18)) == datetime(2026, 10, 19, 6, 0)
+    assert rule.next(datetime(2026, 10, 19, 6, 0)) == datetime(2026, 11, 2, 6, 0)
+    assert rule.next(datetime(2026, 11, 2, 6, 0)) is None
+
+
+def test_wall_clock_times_across_daylight_saving_changes():
+    # times are local wall clock times, the occurrences keep their time of day across the changes
+    rule = CronRule("30 2 * * *")
+    assert occurrences(rule, datetime(2026, 3, 28, 3, 0), 2) == [
+        datetime(2026, 3, 29, 2, 30), datetime(2026, 3, 30, 2, 30)]
+    rule = RRule("FREQ=DAILY;BYHOUR=2;BYMINUTE=30", datetime(2026, 10, 24))
+    assert occurrences(rule, datetime(2026, 10, 24, 3, 0), 2) == [
+        datetime(2026, 10, 25, 2, 30), datetime(2026, 10, 26, 2, 30)]
+
+
+@pytest.mark.parametrize("rule", ["", "0 6 * *", "61 6 * * *", "FREQ=YEARLY", "FREQ=DAILY;BYSETPOS=1",
+                                  "FREQ=WEEKLY;BYDAY=1MO"])
+def test_invalid_rules(rule):
+    with pytest.raises(InvalidRecurrence):
+        parseRule(rule, datetime(2026, 10, 18))
+
+
+def test_occurrence_too_early_is_skipped():
+    def create(template, time):
+        if time < datetime(2026, 10, 19):
+            raise PrintJobTooEarly(10)
+        return createJob(template, time)
+
+    recurring, timer = schedule(datetime(2026, 10, 18, 5, 55), create=create)
+    assert recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    assert list(timer.jobs) == ["job-202610190600"]
+    assert recurring.series[0].__dict__()["count"] == 2
+
+
+def test_series_is_removed_when_no_occurrence_can_be_scheduled():
+    def create(template, time):
+        raise PrintJobTooEarly(10)
+
+    calls = []
+    recurring, timer = schedule(datetime(2026, 10, 18), create=lambda t, time: calls.append(time) or create(t, time))
+    assert not recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    assert len(calls) == MAX_SKIPPED
+    assert recurring.series == []
+
+
+def test_next_occurrence_after_the_job_was_started():
+    recurring, timer = schedule(datetime(2026, 10, 18, 7, 0))
+    recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    job = timer.cancelJob("job-202610190600")
+    recurring.onJobStarted(job)
+    assert list(timer.jobs) == ["job-202610200600"]
+
+
+def test_cancelled_occurrence_is_skipped():
+    recurring, timer = schedule(datetime(2026, 10, 18, 7, 0))
+    recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    timer.cancelJob("job-202610190600")
+    assert recurring.skip("job-202610190600")
+    assert list(timer.jobs) == ["job-202610200600"]
+    assert not recurring.skip("job-202610190600")
+
+
+def test_removing_all_series_cancels_their_occurrences():
+    recurring, timer = schedule(datetime(2026, 10, 18, 7, 0))
+    recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    recurring.add(RecurringJob("0 18 * * *", datetime(2026, 10, 18), TEMPLATE))
+    recurring.removeAll()
+    assert recurring.series == []
+    assert timer.jobs == {}
+
+
+def test_pending_occurrence_is_rescheduled_after_a_restart(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    recurring, timer = schedule(datetime(2026, 10, 18, 7, 0), journal)
+    recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    assert list(timer.jobs) == ["job-202610190600"]
+
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    restored, timer = schedule(datetime(2026, 10, 18, 8, 0), journal)
+    restored.restore(journal.recurringJobs)
+    assert list(timer.jobs) == ["job-202610190600"]
+    assert restored.series[0].__dict__()["count"] == 1
+
+
+def test_missed_occurrence_is_not_rescheduled_after_a_restart(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    recurring, timer = schedule(datetime(2026, 10, 18, 7, 0), journal)
+    recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    restored, timer = schedule(datetime(2026, 10, 19, 8, 0), journal)
+    restored.restore(journal.recurringJobs)
+    assert list(timer.jobs) == ["job-202610200600"]
+
+
+def test_ended_series_is_removed_from_the_journal(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    recurring, timer = schedule(datetime(2026, 10, 18, 7, 0), journal)
+    recurring.add(RecurringJob("FREQ=DAILY;BYHOUR=6;BYMINUTE=0;COUNT=1", datetime(2026, 10, 18), TEMPLATE))
+    recurring.onJobStarted(timer.cancelJob("job-202610190600"))
+    assert recurring.series == []
+
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    assert journal.recurringJobs == []
+
+
+def test_reestimated_occurrence_is_not_journaled(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = JobJournal(LOGGER, path)
+    journal.replay()
+    clock = SimulatedClock(datetime(2026, 10, 18, 7, 0))
+    timer = AutoPrinterTimer(LOGGER, None, None, journal=journal, clock=clock)
+    recurring = RecurringSchedule(LOGGER, timer, lambda template, time: AnalysedJob(f"job-{time:%Y%m%d%H%M}", time),
+                                  journal, clock)
+    recurring.add(RecurringJob("0 6 * * *", datetime(2026, 10, 18), TEMPLATE))
+    assert [job.id for job in timer.analysisFinished("part.gcode")] == ["job-202610190600"]
+
+    # the occurrence is re-created from the series after a restart, it must not be restored as a job too
+    journal = JobJournal(LOGGER, path)
+    pending, _ = journal.replay()
+    assert pending == []